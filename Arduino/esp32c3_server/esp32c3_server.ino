@@ -12,6 +12,56 @@ WiFiServer server(8080);
 WiFiClient client;
 bool clientConnected = false;
 
+// 二進位取樣協定（Python 連線後送 'b' 協商；未協商時維持 ASCII 一行一筆）
+// 封包：同步碼 0x5AA5 + 序號 + 16 筆取樣，全部為 uint16 little-endian
+const uint16_t PACKET_SYNC = 0x5AA5;
+// 二進位模式下執行氣泵指令後回送確認封包：同步碼 ACK_SYNC，序號欄位為指令字元，第一筆取樣為繼電器狀態
+const uint16_t ACK_SYNC = 0x5AA6;
+// 二進位模式下收到 'p' 時回送時間封包供 Python 估計時脈偏移及來回時間：同步碼 TIME_SYNC，序號欄位為回應次數，
+// 前四筆取樣為收到指令及送出回應時的 micros()（各拆成低/高 16 位元）
+const uint16_t TIME_SYNC = 0x5AA7;
+const int PACKET_SAMPLES = 16;
+
+struct __attribute__((packed)) SamplePacket {
+  uint16_t sync;
+  uint16_t seq;
+  uint16_t samples[PACKET_SAMPLES];
+};
+
+bool binaryMode = false;
+SamplePacket packet;
+SamplePacket ackPacket;
+SamplePacket timePacket;
+uint16_t timeReplies = 0;
+int packetFill = 0;
+
+void sendAck(char command, int relayState) {
+  if (!binaryMode) {
+    return;  // ASCII 模式維持舊行為，不回送確認
+  }
+  memset(&ackPacket, 0, sizeof(ackPacket));
+  ackPacket.sync = ACK_SYNC;
+  ackPacket.seq = (uint16_t)command;
+  ackPacket.samples[0] = (uint16_t)relayState;
+  client.write((const uint8_t*)&ackPacket, sizeof(ackPacket));
+}
+
+void sendTimeSync(uint32_t received) {
+  if (!binaryMode) {
+    return;
+  }
+  memset(&timePacket, 0, sizeof(timePacket));
+  timePacket.sync = TIME_SYNC;
+  timePacket.seq = timeReplies++;
+  timePacket.samples[0] = (uint16_t)(received & 0xFFFF);
+  timePacket.samples[1] = (uint16_t)(received >> 16);
+  // 送出時間盡量接近實際寫入
+  uint32_t sent = micros();
+  timePacket.samples[2] = (uint16_t)(sent & 0xFFFF);
+  timePacket.samples[3] = (uint16_t)(sent >> 16);
+  client.write((const uint8_t*)&timePacket, sizeof(timePacket));
+}
+
 void setup() {
   pinMode(relayPin, OUTPUT);
   digitalWrite(relayPin, LOW);  // 一開始氣泵關閉
@@ -78,6 +128,7 @@ void loop() {
       Serial.print("客戶端IP: ");
       Serial.println(client.remoteIP());
       clientConnected = true;
+      binaryMode = false;  // 每個新連線預設 ASCII，等待協商
     }
   }
   
@@ -85,17 +136,42 @@ void loop() {
   if (clientConnected && client.connected()) {
     // 1. 讀取麥克風數值並傳給 Python
     int micValue = analogRead(micPin);
-    client.println(micValue);  // 透過TCP發送數據
+    if (binaryMode) {
+      // 湊滿一個封包才送出
+      packet.samples[packetFill++] = (uint16_t)micValue;
+      if (packetFill == PACKET_SAMPLES) {
+        client.write((const uint8_t*)&packet, sizeof(packet));
+        packet.seq++;
+        packetFill = 0;
+      }
+    } else {
+      client.println(micValue);  // 透過TCP發送數據
+    }
     
     // 2. 檢查是否有從 Python 傳來的指令
     if (client.available() > 0) {
       char input = client.read(); 
+      uint32_t received = micros();
       if (input == 's') {
         digitalWrite(relayPin, HIGH);  // 吸氣 -> 開啟氣泵
+        sendAck(input, HIGH);
         Serial.println("🌪️ 氣泵開啟 (指令: s)");
       } else if (input == 'x') {
         digitalWrite(relayPin, LOW);   // 吐氣 -> 關閉氣泵
+        sendAck(input, LOW);
         Serial.println("⏹️ 氣泵關閉 (指令: x)");
+      } else if (input == 'p') {
+        // 時間同步：不輸出序列埠訊息，避免影響回應時間
+        sendTimeSync(received);
+      } else if (input == 'b') {
+        // 切換為二進位取樣封包
+        client.print("BIN1\n");
+        binaryMode = true;
+        packet.sync = PACKET_SYNC;
+        packet.seq = 0;
+        packetFill = 0;
+        timeReplies = 0;
+        Serial.println("📦 切換為二進位取樣格式");
       }
     }
   } else if (clientConnected) {
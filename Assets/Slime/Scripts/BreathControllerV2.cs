@@ -19,6 +19,12 @@ public class BreathControllerV2 : MonoBehaviour
     // 模式設定
     public enum Mode { breath_control, unity_control, breath_detection }
     public Mode currentMode = Mode.unity_control;
+    // Python可同時連接多個Unity；只有控制端 (最早連線者) 的 character_state 會被採用
+    public bool isController = true;
+
+    [Header("遙測")]
+    [Tooltip("連線後向Python訂閱的遙測頻率 (Hz)，0 表示不訂閱")]
+    public int telemetryRate = 0;
 
 
     // 網路相關
@@ -34,9 +40,60 @@ public class BreathControllerV2 : MonoBehaviour
     private string currentBreathState = "undecided";
     
     // 消息隊列（線程安全）
-    private Queue<string> messageQueue = new Queue<string>();
+    private Queue<Dictionary<string, object>> messageQueue = new Queue<Dictionary<string, object>>();
     private readonly object queueLock = new object();
     
+    // 傳輸協定：JSON 一行一則；二進位 frame = 0x02 + 種類 + 長度(uint16 LE) + 內容
+    private const byte FrameMarker = 0x02;
+    private const int FrameHeaderSize = 4;
+    private const byte KindBreathUpdate = 1;
+    private const byte KindTelemetry = 2;
+    private const int TelemetrySize = 21;  // 狀態(uint8) + RMS + AMP + ZCR (float32) + 時間戳(float64)
+    private static readonly string[] BreathStates = { "undecided", "likely_INHALE", "likely_EXHALE" };
+    private static readonly string[] BreathSources = { "keyboard", "breath_detection" };
+    
+    // 最新遙測（網路線程寫入，主線程讀取；不經過消息隊列及JSON）
+    private readonly object telemetryLock = new object();
+    private readonly byte[] telemetryBuffer = new byte[TelemetrySize];
+    private float telemetryRms;
+    private float telemetryAmplitude;
+    private float telemetryZcr;
+    private string telemetryState = "undecided";
+    private double telemetryTimestamp;
+    
+    public float BreathRms { get { lock (telemetryLock) { return telemetryRms; } } }
+    public float BreathAmplitude { get { lock (telemetryLock) { return telemetryAmplitude; } } }
+    public float BreathZcr { get { lock (telemetryLock) { return telemetryZcr; } } }
+    public string TelemetryState { get { lock (telemetryLock) { return telemetryState; } } }
+    public double TelemetryTimestamp { get { lock (telemetryLock) { return telemetryTimestamp; } } }
+    
+    // 時脈同步：本機時間為 Stopwatch 秒數，以 ping/pong 估計 Python 時脈 (time.monotonic()) 減本機時脈的偏移
+    // 保留最近 ClockHistory 次交換，以來回時間最短的一次為準
+    public float clockSyncInterval = 2f;
+    private const int ClockHistory = 8;
+    private static readonly System.Diagnostics.Stopwatch clock = System.Diagnostics.Stopwatch.StartNew();
+    private readonly object clockLock = new object();
+    private readonly object sendLock = new object();
+    private readonly double[] clockRtts = new double[ClockHistory];
+    private readonly double[] clockOffsets = new double[ClockHistory];
+    private int clockExchanges;
+    private double pythonOffset;
+    private double pythonRtt;
+    private double nextPingTime;
+    private int pingId;
+    
+    public static double ClockNow { get { return clock.Elapsed.TotalSeconds; } }
+    public int ClockExchanges { get { lock (clockLock) { return clockExchanges; } } }
+    public double PythonClockOffset { get { lock (clockLock) { return pythonOffset; } } }
+    public double PythonRttMs { get { lock (clockLock) { return pythonRtt * 1000.0; } } }
+    
+    // 最近一次 breath_update 的各階段延遲 (毫秒)：視窗 → Python 判斷 → Unity 收到 → Update 套用
+    // 跨機器的階段 (判斷 → 收到) 需要先完成時脈同步，否則為 NaN
+    public double LatencyWindowToDecisionMs { get; private set; } = double.NaN;
+    public double LatencyTransportMs { get; private set; } = double.NaN;
+    public double LatencyApplyMs { get; private set; } = double.NaN;
+    public double LatencyTotalMs { get; private set; } = double.NaN;
+    
     
     void Start()
     {
@@ -49,6 +106,13 @@ public class BreathControllerV2 : MonoBehaviour
         // 處理網路消息
         ProcessMessages();
         
+        // 定期與Python同步時脈
+        if (isConnected && ClockNow >= nextPingTime)
+        {
+            nextPingTime = ClockNow + clockSyncInterval;
+            SendPing();
+        }
+        
         // 根據模式處理輸入
         if (currentMode == Mode.unity_control)
         {
@@ -91,17 +155,16 @@ public class BreathControllerV2 : MonoBehaviour
         {
             while (messageQueue.Count > 0)
             {
-                string message = messageQueue.Dequeue();
+                var message = messageQueue.Dequeue();
                 ProcessPythonMessage(message);
             }
         }
     }
     
-    void ProcessPythonMessage(string jsonMessage)
+    void ProcessPythonMessage(Dictionary<string, object> messageData)
     {
         try
         {
-            var messageData = JsonConvert.DeserializeObject<Dictionary<string, object>>(jsonMessage);
             string messageType = messageData["type"].ToString();
             
             switch (messageType)
@@ -110,7 +173,9 @@ public class BreathControllerV2 : MonoBehaviour
                     // 接收模式設定
                     string pythonMode = messageData["mode"].ToString();
                     string description = messageData["description"].ToString();
-                    Debug.Log($"收到模式設定: {pythonMode} - {description}");
+                    // 舊版Python不帶 controller 欄位，視為控制端
+                    isController = !messageData.ContainsKey("controller") || Convert.ToBoolean(messageData["controller"]);
+                    Debug.Log($"收到模式設定: {pythonMode} - {description} ({(isController ? "控制端" : "訂閱者")})");
 
                     // 將Python傳來的mode與Unity的Mode列舉同步
                     if (Enum.TryParse(pythonMode, out Mode parsedMode))
@@ -131,6 +196,7 @@ public class BreathControllerV2 : MonoBehaviour
                         string source = messageData["source"].ToString();
                         Debug.Log($"收到呼吸資料: {currentBreathState} (來源: {source})");
                         UpdateBreathState(currentBreathState);
+                        RecordLatency(messageData);
                     }
                     break;
                     
@@ -138,6 +204,10 @@ public class BreathControllerV2 : MonoBehaviour
                     // 收到ping回應
                     Debug.Log("收到Python pong回應");
                     break;
+                    
+                case "telemetry_status":
+                    Debug.Log($"遙測頻率: {messageData["rate"]} Hz");
+                    break;
             }
         }
         catch (Exception e)
@@ -146,6 +216,38 @@ public class BreathControllerV2 : MonoBehaviour
         }
     }
     
+    void RecordLatency(Dictionary<string, object> messageData)
+    {
+        if (!messageData.TryGetValue("window_time", out object windowValue) ||
+            !messageData.TryGetValue("decision_time", out object decisionValue) ||
+            !messageData.TryGetValue("received_time", out object receivedValue))
+        {
+            return;  // 舊版Python沒有視窗時間
+        }
+        
+        double windowTime = Convert.ToDouble(windowValue);
+        double decisionTime = Convert.ToDouble(decisionValue);
+        double received = Convert.ToDouble(receivedValue);
+        double applied = ClockNow;
+        LatencyWindowToDecisionMs = (decisionTime - windowTime) * 1000.0;
+        LatencyApplyMs = (applied - received) * 1000.0;
+        
+        double offset;
+        lock (clockLock)
+        {
+            if (clockExchanges == 0)
+            {
+                LatencyTransportMs = double.NaN;
+                LatencyTotalMs = double.NaN;
+                return;
+            }
+            offset = pythonOffset;
+        }
+        // Python 時間換算成本機時間
+        LatencyTransportMs = (received - (decisionTime - offset)) * 1000.0;
+        LatencyTotalMs = (applied - (windowTime - offset)) * 1000.0;
+    }
+    
     void UpdateBreathState(string breathState)
     {
         switch (breathState)
@@ -212,54 +314,33 @@ public class BreathControllerV2 : MonoBehaviour
             
             Debug.Log($"已連接到Python: {pythonHost}:{pythonPort}");
             
+            if (telemetryRate > 0)
+            {
+                SendTelemetrySubscribe(telemetryRate);
+            }
+            
             // 持續監聽消息
-            byte[] buffer = new byte[1024];
-            StringBuilder messageBuilder = new StringBuilder();
+            byte[] buffer = new byte[4096];
+            List<byte> pending = new List<byte>();
             
             while (!shouldStop && tcpClient.Connected)
             {
                 try
                 {
                     int bytesRead = stream.Read(buffer, 0, buffer.Length);
-                    if (bytesRead > 0)
+                    if (bytesRead <= 0)
                     {
-                        string data = Encoding.UTF8.GetString(buffer, 0, bytesRead);
-                        messageBuilder.Append(data);
-                        
-                        // 處理完整的JSON消息
-                        string messages = messageBuilder.ToString();
-                        int braceCount = 0;
-                        int startIndex = 0;
-                        
-                        for (int i = 0; i < messages.Length; i++)
-                        {
-                            if (messages[i] == '{') braceCount++;
-                            else if (messages[i] == '}') braceCount--;
-                            
-                            if (braceCount == 0 && messages[i] == '}')
-                            {
-                                string completeMessage = messages.Substring(startIndex, i - startIndex + 1);
-                                
-                                lock (queueLock)
-                                {
-                                    messageQueue.Enqueue(completeMessage);
-                                }
-                                
-                                startIndex = i + 1;
-                            }
-                        }
-                        
-                        // 保留未完整的消息
-                        if (startIndex < messages.Length)
-                        {
-                            messageBuilder.Clear();
-                            messageBuilder.Append(messages.Substring(startIndex));
-                        }
-                        else
-                        {
-                            messageBuilder.Clear();
-                        }
+                        break;
                     }
+                    
+                    for (int i = 0; i < bytesRead; i++)
+                    {
+                        pending.Add(buffer[i]);
+                    }
+                    
+                    // 處理完整的frame，保留未完整的部分
+                    int consumed = ParseFrames(pending);
+                    pending.RemoveRange(0, consumed);
                 }
                 catch (Exception e)
                 {
@@ -278,8 +359,160 @@ public class BreathControllerV2 : MonoBehaviour
         }
     }
     
+    int ParseFrames(List<byte> data)
+    {
+        int pos = 0;
+        while (pos < data.Count)
+        {
+            if (data[pos] == FrameMarker)
+            {
+                // 二進位frame
+                if (data.Count - pos < FrameHeaderSize) break;
+                byte kind = data[pos + 1];
+                int length = data[pos + 2] | (data[pos + 3] << 8);
+                if (data.Count - pos < FrameHeaderSize + length) break;
+                
+                if (kind == KindTelemetry && length >= TelemetrySize)
+                {
+                    // 高頻率資料：直接更新欄位，不建立消息
+                    data.CopyTo(pos + FrameHeaderSize, telemetryBuffer, 0, TelemetrySize);
+                    ApplyTelemetry(telemetryBuffer);
+                    pos += FrameHeaderSize + length;
+                    continue;
+                }
+                
+                byte[] payload = data.GetRange(pos + FrameHeaderSize, length).ToArray();
+                EnqueueMessage(DecodeBinaryFrame(kind, payload));
+                pos += FrameHeaderSize + length;
+                continue;
+            }
+            
+            // JSON frame，以換行結尾
+            int newline = data.IndexOf((byte)'\n', pos);
+            if (newline < 0) break;
+            
+            string json = Encoding.UTF8.GetString(data.GetRange(pos, newline - pos).ToArray()).Trim();
+            if (json.Length > 0)
+            {
+                try
+                {
+                    EnqueueMessage(JsonConvert.DeserializeObject<Dictionary<string, object>>(json));
+                }
+                catch (Exception e)
+                {
+                    Debug.LogError($"解析Python消息錯誤: {e.Message}");
+                }
+            }
+            pos = newline + 1;
+        }
+        return pos;
+    }
+    
+    Dictionary<string, object> DecodeBinaryFrame(byte kind, byte[] payload)
+    {
+        if (kind == KindBreathUpdate && payload.Length >= 10)
+        {
+            // 損壞或新版Python的未知狀態/來源：略過這個 frame，不讓例外中斷接收迴圈
+            if (payload[0] >= BreathStates.Length || payload[1] >= BreathSources.Length)
+            {
+                Debug.LogWarning($"未知的呼吸狀態或來源: {payload[0]}/{payload[1]}，略過");
+                return null;
+            }
+            var message = new Dictionary<string, object>
+            {
+                ["type"] = "breath_update",
+                ["state"] = BreathStates[payload[0]],
+                ["source"] = BreathSources[payload[1]],
+                ["timestamp"] = BitConverter.ToDouble(payload, 2)
+            };
+            // 新版附加視窗時間及判斷時間 (Python time.monotonic())
+            if (payload.Length >= 26 && !double.IsNaN(BitConverter.ToDouble(payload, 10)))
+            {
+                message["window_time"] = BitConverter.ToDouble(payload, 10);
+                message["decision_time"] = BitConverter.ToDouble(payload, 18);
+            }
+            return message;
+        }
+        
+        Debug.LogWarning($"未知的二進位消息種類: {kind}");
+        return null;
+    }
+    
+    void ApplyTelemetry(byte[] payload)
+    {
+        lock (telemetryLock)
+        {
+            telemetryState = payload[0] < BreathStates.Length ? BreathStates[payload[0]] : "undecided";
+            telemetryRms = BitConverter.ToSingle(payload, 1);
+            telemetryAmplitude = BitConverter.ToSingle(payload, 5);
+            telemetryZcr = BitConverter.ToSingle(payload, 9);
+            telemetryTimestamp = BitConverter.ToDouble(payload, 13);
+        }
+    }
+    
+    void EnqueueMessage(Dictionary<string, object> message)
+    {
+        if (message == null) return;
+        
+        // 時間同步消息在網路執行緒直接處理，不等下一個 Update，以免影響時間量測
+        double received = ClockNow;
+        object type;
+        message.TryGetValue("type", out type);
+        if ("ping".Equals(type) && message.ContainsKey("t0"))
+        {
+            SendMessage(new Dictionary<string, object>
+            {
+                ["type"] = "pong",
+                ["id"] = message.TryGetValue("id", out object id) ? id : null,
+                ["t0"] = message["t0"],
+                ["t1"] = received,
+                ["t2"] = ClockNow
+            });
+            return;
+        }
+        if ("pong".Equals(type) && message.ContainsKey("t1"))
+        {
+            UpdateClock(Convert.ToDouble(message["t0"]), Convert.ToDouble(message["t1"]),
+                        Convert.ToDouble(message["t2"]), received);
+            return;
+        }
+        message["received_time"] = received;
+        
+        lock (queueLock)
+        {
+            messageQueue.Enqueue(message);
+        }
+    }
+    
+    void UpdateClock(double t0, double t1, double t2, double t3)
+    {
+        // NTP 公式：t0/t3 為本機送出/收到，t1/t2 為Python收到/送出
+        double rtt = (t3 - t0) - (t2 - t1);
+        double offset = ((t1 - t0) + (t2 - t3)) / 2.0;
+        lock (clockLock)
+        {
+            int slot = clockExchanges % ClockHistory;
+            clockRtts[slot] = rtt;
+            clockOffsets[slot] = offset;
+            clockExchanges++;
+            pythonRtt = rtt;
+            
+            int best = 0;
+            int count = Math.Min(clockExchanges, ClockHistory);
+            for (int i = 1; i < count; i++)
+            {
+                if (clockRtts[i] < clockRtts[best]) best = i;
+            }
+            pythonOffset = clockOffsets[best];
+        }
+    }
+    
     void SendCharacterState(string state)
     {
+        if (!isController)
+        {
+            return;  // 非控制端送出也會被Python忽略
+        }
         var message = new Dictionary<string, object>
         {
             ["type"] = "character_state",
@@ -290,11 +523,30 @@ public class BreathControllerV2 : MonoBehaviour
         SendMessage(message);
     }
     
+    public void SetTelemetryRate(int rate)
+    {
+        telemetryRate = rate;
+        SendTelemetrySubscribe(rate);
+    }
+    
+    void SendTelemetrySubscribe(int rate)
+    {
+        var message = new Dictionary<string, object>
+        {
+            ["type"] = "telemetry_subscribe",
+            ["rate"] = rate
+        };
+        
+        SendMessage(message);
+    }
+    
     void SendPing()
     {
         var message = new Dictionary<string, object>
         {
             ["type"] = "ping",
+            ["id"] = ++pingId,
+            ["t0"] = ClockNow,
             ["timestamp"] = Time.time
         };
         
@@ -307,10 +559,14 @@ public class BreathControllerV2 : MonoBehaviour
         
         try
         {
-            string json = JsonConvert.SerializeObject(message);
+            string json = JsonConvert.SerializeObject(message) + "\n";
             byte[] data = Encoding.UTF8.GetBytes(json);
-            stream.Write(data, 0, data.Length);
-            stream.Flush();
+            // 主執行緒及網路執行緒 (回應ping) 都會送出，避免兩則消息交錯
+            lock (sendLock)
+            {
+                stream.Write(data, 0, data.Length);
+                stream.Flush();
+            }
         }
         catch (Exception e)
         {
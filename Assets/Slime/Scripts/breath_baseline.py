@@ -0,0 +1,117 @@
+import json
+import math
+import os
+import time
+import numpy as np
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.breath_simulator', 'adc_calibration.json')
+
+
+def detect_adc_range(samples):
+    """判斷是否為 10-bit 或 12-bit ADC"""
+    return 4095 if int(np.max(samples)) > 2048 else 1023
+
+
+class AdaptiveBaseline:
+    """
+    不阻塞的基準值校正：先以開頭的取樣決定初始基準值，之後在安靜的視窗以指數移動平均追蹤漂移
+    ADC 位元數只判斷一次，連同最後的基準值依裝置快取；有快取時一開始就能正規化，不必等校正完成
+    seed_samples: 初始校正使用的取樣數
+    tau: 漂移追蹤的時間常數（秒）
+    device: 快取鍵（例如 ESP32 的 host:port），None 表示不使用快取
+    """
+
+    def __init__(self, seed_samples=200, tau=10.0, cache_path=DEFAULT_CACHE_PATH, device=None):
+        self.seed_samples = seed_samples
+        self.tau = tau
+        self.cache_path = cache_path
+        self.device = device
+
+        self.baseline = 0.0
+        self.adc_range = None
+        self.seeded = False
+        self.count = 0          # 已收集的初始校正取樣數
+        self.drift = 0.0        # 初始校正後累計追蹤的漂移（ADC 原始值）
+        self._seed = np.empty(seed_samples, dtype=np.int32)
+
+        cached = self._load_cache()
+        self.cached = cached is not None
+        if cached:
+            self.adc_range = int(cached['adc_range'])
+            self.baseline = float(cached['baseline'])
+
+    @property
+    def ready(self):
+        """是否已可正規化（完成初始校正，或有快取的基準值暫用）"""
+        return self.seeded or self.cached
+
+    def feed(self, values):
+        """
+        送入 ADC 原始值，回傳可用於判斷的正規化取樣
+        初始校正期間沒有快取時，回傳空陣列
+        """
+        normalized = self.normalize(values) if self.cached and not self.seeded else None
+        if not self.seeded:
+            take = min(values.size, self.seed_samples - self.count)
+            self._seed[self.count:self.count + take] = values[:take]
+            self.count += take
+            if self.count < self.seed_samples:
+                return normalized if normalized is not None else np.empty(0)
+            self._finish_seed()
+            if normalized is not None:
+                return normalized
+            values = values[take:]
+        return self.normalize(values)
+
+    def normalize(self, values):
+        norm = (values - self.baseline) / self.adc_range
+        np.clip(norm, -1.0, 1.0, out=norm)
+        return norm
+
+    def track(self, offset, elapsed):
+        """
+        以安靜視窗的平均值更新基準值
+        offset: 視窗平均（正規化單位，即目前基準值的偏差）
+        elapsed: 距離上次更新的秒數
+        """
+        if not self.seeded:
+            return
+        alpha = 1.0 - math.exp(-elapsed / self.tau)
+        step = alpha * offset * self.adc_range
+        self.baseline += step
+        self.drift += step
+
+    def save(self):
+        """把 ADC 位元數及目前基準值寫入快取"""
+        if not self.device or not self.cache_path or not self.seeded:
+            return
+        try:
+            cache = self._read_cache_file()
+            cache[self.device] = {'adc_range': self.adc_range, 'baseline': self.baseline, 'updated': time.time()}
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, indent=2)
+        except OSError:
+            pass
+
+    def _finish_seed(self):
+        self.baseline = float(np.mean(self._seed))
+        if self.adc_range is None:
+            self.adc_range = detect_adc_range(self._seed)
+        self.seeded = True
+        self.save()
+
+    def _read_cache_file(self):
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_cache(self):
+        if not self.device or not self.cache_path:
+            return None
+        entry = self._read_cache_file().get(self.device)
+        if not isinstance(entry, dict) or 'adc_range' not in entry or 'baseline' not in entry:
+            return None
+        return entry
@@ -0,0 +1,443 @@
+import argparse
+import glob
+import json
+import os
+import shlex
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import numpy as np
+from breath_ingest import ACK_SYNC, BINARY_ACK, BINARY_REQUEST, PACKET_SAMPLES, PACKET_SYNC, TIME_REQUEST, TIME_SYNC
+from breath_protocol import FrameDecoder
+from breath_recorder import SessionRecording
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SIMULATOR = os.path.join(SCRIPT_DIR, 'breath_simulator_v2.py')
+MULTI_ENGINE = os.path.join(SCRIPT_DIR, 'breath_multi.py')
+
+# 合成波形參數（ADC 原始值）
+BASELINE = 2100
+ADC_RANGE = 4095
+
+
+def synthetic_waveform(rate, cycles, warmup, seed=0):
+    """
+    產生合成 ADC 波形：暖機靜音後重複「靜音 → 吸氣 → 靜音 → 吐氣」
+    回傳 (ADC 取樣陣列, [(起始取樣編號, 預期判斷)])
+    """
+    rng = np.random.default_rng(seed)
+    segments = [np.zeros(int(warmup * rate))]
+    onsets = []
+    position = segments[0].size
+
+    def add(duration, signal=None, expected=None):
+        nonlocal position
+        n = int(duration * rate)
+        data = np.zeros(n) if signal is None else signal(n)
+        if expected:
+            onsets.append((position, expected))
+        segments.append(data)
+        position += n
+
+    t_inhale = lambda n: 0.12 * np.sin(2 * np.pi * 40 * np.arange(n) / rate)
+    t_exhale = lambda n: rng.uniform(-0.6, 0.6, n)
+    for _ in range(cycles):
+        add(1.0)
+        add(1.5, t_inhale, 'likely_INHALE')
+        add(1.0)
+        add(1.5, t_exhale, 'likely_EXHALE')
+    add(1.0)
+
+    normalized = np.concatenate(segments)
+    adc = np.clip(np.round(BASELINE + normalized * ADC_RANGE), 0, ADC_RANGE).astype(np.int32)
+    return adc, onsets
+
+
+def recorded_waveform(path, warmup, rate):
+    """由錄製檔還原 ADC 波形（沒有已知的起始點，只量測吞吐量與CPU）"""
+    recording = SessionRecording(path)
+    _, samples = recording.samples()
+    baseline = recording.baseline or BASELINE
+    adc_range = recording.adc_range if recording.adc_range > 1 else ADC_RANGE
+    recording.close()
+    adc = np.clip(np.round(baseline + samples * adc_range), 0, ADC_RANGE).astype(np.int32)
+    silence = np.full(int(warmup * rate), int(baseline), dtype=np.int32)
+    return np.concatenate([silence, adc]), []
+
+
+class FakeEsp32:
+    """
+    本機 ESP32 替身：依取樣率送出波形並記錄收到的氣泵指令
+    paced=False 時不依取樣率，只受 TCP 背壓限制，盡快送出 (用來找出處理能力上限)
+    送完後連線保持開啟並持續回應指令，直到 stop()
+    """
+
+    UNPACED_CHUNK = 4096
+    # 比 open_adc_reader 等待 BIN1 的時間長；模擬器協商期間收到的 ASCII 取樣會被捨棄
+    NEGOTIATION_WAIT = 0.7
+
+    def __init__(self, waveform, rate, binary, paced=True):
+        self.waveform = waveform
+        self.rate = rate
+        self.binary = binary
+        self.paced = paced
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+
+        self.send_times = np.full(waveform.size, np.nan)  # 每筆取樣送出的時間
+        self.commands = []  # (time.monotonic(), 指令)
+        self.time_replies = 0
+        self.binary_requested = None  # 收到二進位請求的時間
+        self._micros_epoch = time.monotonic()  # 韌體 micros() 從開機起算
+        self.sent = 0
+        self._pending = np.empty(0, dtype=np.int32)  # 二進位模式下不滿一個封包的取樣
+        self.stream_start = None
+        self.stream_end = None
+        self.connected = threading.Event()
+        self.streamed = threading.Event()
+        self.finished = threading.Event()
+        self._stop = False
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stop = True
+
+    @property
+    def delivered(self):
+        """實際送出的取樣數（二進位模式下最後不滿一個封包的取樣不會送出，與韌體相同）"""
+        return self.sent - self._pending.size
+
+    def _run(self):
+        client, _ = self.server.accept()
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connected.set()
+        binary_active = False
+        seq = 0
+        try:
+            if not self.paced:
+                # 不限速時先等協商結束 (切換為二進位，或舊韌體模式下等模擬器放棄)，避免整段波形在協商期間送完被捨棄
+                deadline = time.monotonic() + self.NEGOTIATION_WAIT
+                while not binary_active and time.monotonic() < deadline:
+                    binary_active = self._poll_commands(client, binary_active)
+                    if self.binary_requested and not self.binary:
+                        deadline = self.binary_requested + self.NEGOTIATION_WAIT
+                    time.sleep(0.001)
+            start = time.monotonic()
+            self.stream_start = start
+            while self.sent < self.waveform.size and not self._stop:
+                now = time.monotonic()
+                if self.paced:
+                    due = min(self.waveform.size, int((now - start) * self.rate) + 1)
+                else:
+                    due = min(self.waveform.size, self.sent + self.UNPACED_CHUNK)
+                if due > self.sent:
+                    batch = self.waveform[self.sent:due]
+                    if binary_active:
+                        payload, seq = self._encode_packets(batch, seq)
+                    else:
+                        payload = b''.join(b'%d\r\n' % v for v in batch.tolist())
+                    self.send_times[self.sent:due] = now
+                    client.sendall(payload)
+                    self.sent = due
+
+                binary_active = self._poll_commands(client, binary_active) or binary_active
+                if self.paced:
+                    next_due = start + self.sent / self.rate
+                    time.sleep(max(0.0005, next_due - time.monotonic()))
+        except OSError:
+            pass
+        finally:
+            self.stream_end = time.monotonic()
+            self.streamed.set()
+            # 繼續收取指令並回應時間同步，直到基準測試結束
+            while not self._stop:
+                try:
+                    self._poll_commands(client, binary_active)
+                except OSError:
+                    break
+                time.sleep(0.01)
+            client.close()
+            self.server.close()
+            self.finished.set()
+
+    def _encode_packets(self, batch, seq):
+        """依韌體格式組成封包；不滿一個封包的取樣先暫存"""
+        self._pending = np.concatenate([self._pending, batch])
+        count = self._pending.size // PACKET_SAMPLES
+        chunks = []
+        for i in range(count):
+            samples = self._pending[i * PACKET_SAMPLES:(i + 1) * PACKET_SAMPLES]
+            chunks.append(struct.pack('<HH', PACKET_SYNC, seq & 0xFFFF) + samples.astype('<u2').tobytes())
+            seq += 1
+        self._pending = self._pending[count * PACKET_SAMPLES:]
+        return b''.join(chunks), seq
+
+    def _poll_commands(self, client, binary_active):
+        """讀取Python送來的指令，回傳是否切換為二進位"""
+        switched = False
+        client.setblocking(False)
+        try:
+            data = client.recv(64)
+        except BlockingIOError:
+            data = b''
+        finally:
+            client.setblocking(True)
+        now = time.monotonic()
+        for byte in data:
+            command = chr(byte)
+            if command in 'sx':
+                self.commands.append((now, command))
+                if binary_active:
+                    # 與韌體相同回送確認封包
+                    client.sendall(struct.pack('<HH', ACK_SYNC, byte) + struct.pack('<H', command == 's')
+                                   + bytes(2 * (PACKET_SAMPLES - 1)))
+            elif byte == TIME_REQUEST[0] and binary_active:
+                # 與韌體相同回送收到及送出時的 micros()
+                received = self._micros(now)
+                sent = self._micros(time.monotonic())
+                client.sendall(struct.pack('<HHHHHH', TIME_SYNC, self.time_replies & 0xFFFF, received & 0xFFFF,
+                                           received >> 16, sent & 0xFFFF, sent >> 16)
+                               + bytes(2 * (PACKET_SAMPLES - 4)))
+                self.time_replies += 1
+            elif byte == BINARY_REQUEST[0] and not binary_active:
+                self.binary_requested = self.binary_requested or now
+                if self.binary:
+                    client.sendall(BINARY_ACK + b'\n')
+                    switched = True
+        return switched
+
+    def _micros(self, t):
+        return int((t - self._micros_epoch) * 1e6) & 0xFFFFFFFF
+
+
+class FakeUnity:
+    """本機 Unity 替身：連線後替每則消息標上收到的時間"""
+
+    def __init__(self, port):
+        self.port = port
+        self.messages = []  # (time.monotonic(), 消息)
+        self.decoder = FrameDecoder()
+        self._stop = False
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stop = True
+
+    def _run(self):
+        sock = None
+        while sock is None and not self._stop:
+            try:
+                sock = socket.create_connection(('localhost', self.port), timeout=1.0)
+            except OSError:
+                time.sleep(0.05)
+        if sock is None:
+            return
+        sock.settimeout(0.2)
+        while not self._stop:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not data:
+                break
+            now = time.monotonic()
+            for message in self.decoder.feed(data):
+                self.messages.append((now, message))
+        sock.close()
+
+
+def read_cpu_seconds(pid):
+    """由 /proc 讀取行程及其子行程（例如 --dsp_process）累計 CPU 時間（使用者 + 系統）"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0.0
+    ticks = int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf('SC_CLK_TCK') + sum(read_cpu_seconds(child) for child in child_pids(pid))
+
+
+def child_pids(pid):
+    children = []
+    for task in glob.glob(f'/proc/{pid}/task/*/children'):
+        try:
+            with open(task) as f:
+                children.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return children
+
+
+def match_latencies(onset_times, onset_states, events):
+    """每個起始點找出之後（下一個起始點前）第一個符合的事件，回傳延遲秒數及漏掉的數量"""
+    latencies = []
+    missed = 0
+    boundaries = list(onset_times[1:]) + [np.inf]
+    for onset, state, limit in zip(onset_times, onset_states, boundaries):
+        hit = next((t for t, value in events if onset <= t < limit and value == state), None)
+        if hit is None:
+            missed += 1
+        else:
+            latencies.append(hit - onset)
+    return np.array(latencies), missed
+
+
+def report_latency(name, latencies, missed):
+    if latencies.size == 0:
+        print(f"  {name}: 沒有量測值 (漏掉 {missed})")
+        return
+    p50, p90, p99 = np.percentile(latencies * 1000, [50, 90, 99])
+    print(f"  {name}: p50={p50:.1f}ms p90={p90:.1f}ms p99={p99:.1f}ms "
+          f"max={latencies.max() * 1000:.1f}ms (n={latencies.size}, 漏掉 {missed})")
+
+
+def processed_samples(port):
+    """由模擬器的指標端點讀取已處理的取樣數 (samples 計數器)；讀取失敗時為 None"""
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics.json', timeout=1.0) as response:
+            return json.load(response)['counters'].get('samples', 0)
+    except (OSError, ValueError):
+        return None
+
+
+def wait_processed(port, pid, target, idle_timeout=1.0):
+    """
+    等待模擬器處理完 target 筆取樣；超過 idle_timeout 秒沒有進展就放棄
+    回傳最後一次有進展時的 (時間, 已處理數, 行程 CPU 秒數)，不把放棄前的閒置時間算進去
+    """
+    last = None
+    progress = (time.monotonic(), 0, read_cpu_seconds(pid))
+    while True:
+        now = time.monotonic()
+        count = processed_samples(port)
+        if count != last:
+            last = count
+            progress = (now, count or 0, read_cpu_seconds(pid))
+            if count is not None and count >= target:
+                return progress
+        elif now - progress[0] > idle_timeout:
+            return progress
+        time.sleep(0.02)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='呼吸模擬器端到端延遲與吞吐量基準測試')
+    parser.add_argument('--rate', type=int, default=500, help='ESP32 替身每秒送出的取樣數 (預設 500)')
+    parser.add_argument('--unpaced', action='store_true',
+                        help='不依取樣率，盡快送出全部取樣以量測處理能力上限 (不量測延遲)')
+    parser.add_argument('--cycles', type=int, default=10, help='合成波形的呼吸循環數 (預設 10)')
+    parser.add_argument('--warmup', type=float, default=4.0, help='開頭靜音秒數，涵蓋校正及啟動 (預設 4)')
+    parser.add_argument('--waveform', type=str, default=None, help='改用錄製檔作為波形 (只量測吞吐量與CPU)')
+    parser.add_argument('--esp32_format', choices=['ascii', 'binary'], default='binary',
+                        help='ESP32 替身支援的取樣格式 (預設 binary)')
+    parser.add_argument('--sensors', type=int, default=1,
+                        help='ESP32 替身數量；大於 1 時改測 breath_multi.py，延遲只量測第一個感測站 (預設 1)')
+    parser.add_argument('--sim_args', type=str, default='', help='額外傳給 breath_simulator_v2.py (或 breath_multi.py) 的參數')
+    args = parser.parse_args()
+
+    if args.waveform:
+        waveform, onsets = recorded_waveform(args.waveform, args.warmup, args.rate)
+    else:
+        waveform, onsets = synthetic_waveform(args.rate, args.cycles, args.warmup)
+
+    sensors = [FakeEsp32(waveform, args.rate, binary=args.esp32_format == 'binary', paced=not args.unpaced)
+               for _ in range(args.sensors)]
+    for sensor in sensors:
+        sensor.start()
+    esp32 = sensors[0]
+    unity_ports = [free_port() for _ in sensors]
+    unity_port = unity_ports[0]
+    if args.sensors > 1:
+        command = [sys.executable, MULTI_ENGINE, '--calibration_cache', '']
+        for sensor, port in zip(sensors, unity_ports):
+            command += ['--sensor', f'127.0.0.1:{sensor.port}:{port}']
+    else:
+        command = [sys.executable, SIMULATOR, '--mode', 'breath_detection',
+                   '--esp32_host', '127.0.0.1', '--esp32_port', str(esp32.port),
+                   '--unity_port', str(unity_port), '--calibration_cache', '']
+    # 已處理的取樣數由模擬器自己的指標端點取得
+    metrics_port = free_port()
+    command += shlex.split(args.sim_args) + ['--metrics_port', str(metrics_port)]
+    print(f"🚀 啟動: {' '.join(command)}")
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, cwd=SCRIPT_DIR)
+
+    unity = FakeUnity(unity_port)
+    unity.start()
+    try:
+        if not all(sensor.connected.wait(timeout=30) for sensor in sensors):
+            print("❌ 模擬器沒有連上 ESP32 替身")
+            return 1
+        # CPU 從開頭靜音送完才開始計算，不含啟動、校正及 DSP 子行程載入模組的成本
+        # 不限速時模擬器還在處理開頭靜音，從處理完暖機取樣開始計算
+        warmup_samples = int(args.warmup * args.rate)
+        measured_start, processed_start, cpu_start = wait_processed(metrics_port, process.pid,
+                                                                    warmup_samples * len(sensors), idle_timeout=10.0)
+        for sensor in sensors:
+            sensor.streamed.wait()
+        sent = sum(sensor.delivered for sensor in sensors)
+        measured_end, processed_end, cpu_end = wait_processed(metrics_port, process.pid, sent)
+        # 多等一下收取最後的指令及消息
+        time.sleep(0.3)
+    finally:
+        unity.stop()
+        for sensor in sensors:
+            sensor.stop()
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+        try:
+            _, stderr = process.communicate(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            _, stderr = process.communicate()
+        if process.returncode not in (0, -signal.SIGINT) and stderr:
+            print(stderr.decode('utf-8', 'replace'))
+
+    pacing = "不限速" if args.unpaced else f"各 {args.rate} 筆/秒"
+    print(f"\n📊 結果 ({args.esp32_format}, {args.sensors} 個感測站，{pacing})")
+    print(f"  已處理取樣: {processed_end}/{sent}"
+          + (f" (未處理 {sent - processed_end}，含協商二進位格式期間捨棄的 ASCII 取樣)" if processed_end < sent else ""))
+    measured_samples = processed_end - processed_start
+    measured_seconds = max(measured_end - measured_start, 1e-9)
+    print(f"  處理吞吐量: {measured_samples / measured_seconds:.0f} 筆/秒"
+          + ("" if args.unpaced else f" (受送出速度 {args.rate * args.sensors} 筆/秒限制)"))
+    print(f"  CPU: {(cpu_end - cpu_start) * 1e6 / max(measured_samples, 1):.2f} µs/筆 "
+          f"({(cpu_end - cpu_start) / measured_seconds * 100:.1f}% 單核，不含開頭 {args.warmup:g} 秒)")
+
+    if args.unpaced:
+        print("  不限速模式不量測延遲")
+        return 0
+    if not onsets:
+        print("  錄製波形沒有已知起始點，略過延遲量測")
+        return 0
+
+    onset_times = [esp32.send_times[index] for index, _ in onsets]
+    onset_states = [state for _, state in onsets]
+    pump_events = [(t, 'likely_INHALE' if c == 's' else 'likely_EXHALE') for t, c in esp32.commands]
+    unity_events = [(t, m.get('state')) for t, m in unity.messages if m.get('type') == 'breath_update']
+    report_latency("起始 → 氣泵指令", *match_latencies(onset_times, onset_states, pump_events))
+    report_latency("起始 → Unity breath_update", *match_latencies(onset_times, onset_states, unity_events))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import math
+import os
+from collections import deque, namedtuple
+from functools import lru_cache
+import numpy as np
+from breath_protocol import BREATH_STATES
+from breath_rules import DEFAULT_THRESHOLDS, inhale_history_length
+
+# classify_nose_breath 的回傳值；仍是 tuple，依位置拆解的舊寫法照常可用
+Classification = namedtuple('Classification', 'state rms amp zcr low_energy high_energy total_energy')
+
+# 學習模型的輸入特徵（順序即模型權重的欄位順序）
+FEATURE_NAMES = ('rms', 'amp', 'zcr', 'log_low', 'log_high', 'low_ratio')
+
+# 每次判斷的時間預算（微秒）
+DECISION_BUDGET_US = 50.0
+
+
+def feature_matrix(rms, amp, zcr, low_energy, high_energy):
+    """多個視窗的特徵 (N,) 組成模型輸入 (N, len(FEATURE_NAMES))"""
+    low_energy = np.asarray(low_energy, dtype=np.float64)
+    high_energy = np.asarray(high_energy, dtype=np.float64)
+    return np.column_stack((rms, amp, zcr, np.log1p(low_energy), np.log1p(high_energy),
+                            low_energy / (low_energy + high_energy + 1e-12)))
+
+
+class RuleClassifier:
+    """原本的規則判斷：AMP 過濾雜訊，連續吸氣特徵判斷吸氣，RMS 判斷吐氣"""
+
+    name = 'rules'
+    uses_spectrum = False  # 不需要頻帶能量，呼叫端可略過 FFT
+    hop_ms = None
+
+    def __init__(self, thresholds=None, hops_per_block=1):
+        self.thresholds = dict(thresholds or DEFAULT_THRESHOLDS)
+        # 吸氣需在連續 inhale_blocks 個區塊內成立；重疊視窗時換算為對應的 hop 數
+        self.inhale_history = deque(maxlen=inhale_history_length(self.thresholds['inhale_blocks'],
+                                                                 hops_per_block))
+
+    def classify(self, rms, amp, zcr, low_energy=0.0, high_energy=0.0):
+        thresholds = self.thresholds
+
+        # === 雜訊過濾條件（AMP 太低就略過）===
+        if amp < thresholds['amp_min']:
+            self.inhale_history.clear()
+            return 'undecided'
+
+        # === 吸氣條件：ZCR 夠高且 RMS 夠低 ===
+        is_inhale = (thresholds['inhale_zcr_min'] <= zcr) and (rms < thresholds['inhale_rms_max'])
+        self.inhale_history.append(is_inhale)
+
+        # === 判斷邏輯 ===
+        if all(self.inhale_history):  # 連續吸氣特徵成立
+            return 'likely_INHALE'
+        if rms > thresholds['exhale_rms_min']:  # 吹氣只看 RMS
+            return 'likely_EXHALE'
+        return 'undecided'
+
+
+class LearnedClassifier:
+    """
+    離線訓練的 softmax 回歸或小型 MLP（ReLU 隱藏層），推論只用 NumPy
+    權重在建立時載入並轉成連續陣列，單次判斷重複使用預先配置的輸入陣列
+    """
+
+    uses_spectrum = True
+
+    def __init__(self, model, name='model'):
+        self.name = name
+        # 訓練時的判斷間隔；舊模型沒有記錄時為 None
+        self.hop_ms = int(model['hop_ms']) if 'hop_ms' in model else None
+        self.mean = np.ascontiguousarray(model['mean'], dtype=np.float64)
+        self.scale = np.ascontiguousarray(model['scale'], dtype=np.float64)
+        count = int(model['layers'])
+        self.layers = [(np.ascontiguousarray(model[f'W{i}'], dtype=np.float64),
+                        np.ascontiguousarray(model[f'b{i}'], dtype=np.float64)) for i in range(count)]
+        if self.layers[-1][0].shape[1] != len(BREATH_STATES):
+            raise ValueError(f"模型輸出數 {self.layers[-1][0].shape[1]} 與狀態數 {len(BREATH_STATES)} 不符")
+        self._x = np.empty(len(FEATURE_NAMES))
+
+    def predict_batch(self, features):
+        """features: (N, len(FEATURE_NAMES))；回傳狀態索引 (N,)"""
+        h = (features - self.mean) / self.scale
+        for W, b in self.layers[:-1]:
+            h = np.maximum(h @ W + b, 0.0)
+        W, b = self.layers[-1]
+        return np.argmax(h @ W + b, axis=1).astype(np.uint8)
+
+    def classify(self, rms, amp, zcr, low_energy=0.0, high_energy=0.0):
+        x = self._x
+        x[0] = rms
+        x[1] = amp
+        x[2] = zcr
+        x[3] = math.log1p(low_energy)
+        x[4] = math.log1p(high_energy)
+        x[5] = low_energy / (low_energy + high_energy + 1e-12)
+        h = (x - self.mean) / self.scale
+        for W, b in self.layers[:-1]:
+            h = np.maximum(np.dot(h, W) + b, 0.0)
+        W, b = self.layers[-1]
+        return BREATH_STATES[int(np.argmax(np.dot(h, W) + b))]
+
+
+@lru_cache(maxsize=4)
+def _load_model(path, mtime_ns):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def load_model(path):
+    """讀取模型權重；同一檔案未修改時重複使用已載入的陣列"""
+    path = os.path.abspath(path)
+    return _load_model(path, os.stat(path).st_mtime_ns)
+
+
+def save_model(path, mean, scale, layers, **meta):
+    """儲存模型：標準化參數及各層 (W, b)"""
+    arrays = {'mean': mean, 'scale': scale, 'layers': np.array(len(layers)),
+              'features': np.array(FEATURE_NAMES), 'states': np.array(BREATH_STATES)}
+    for i, (W, b) in enumerate(layers):
+        arrays[f'W{i}'] = W
+        arrays[f'b{i}'] = b
+    arrays.update({name: np.asarray(value) for name, value in meta.items()})
+    np.savez(path, **arrays)
+
+
+def create_classifier(spec='rules', thresholds=None, hops_per_block=1):
+    """'rules'（預設）為規則判斷，其他視為模型 .npz 路徑"""
+    if not spec or spec == 'rules':
+        return RuleClassifier(thresholds, hops_per_block)
+    return LearnedClassifier(load_model(spec), name=os.path.basename(spec))
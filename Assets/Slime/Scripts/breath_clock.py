@@ -0,0 +1,109 @@
+from collections import deque
+import numpy as np
+
+
+class SampleClock:
+    """
+    由到達時間及取樣率重建每筆取樣的單調時間戳 (time.monotonic 秒)
+    同一批取樣最後一筆的取樣時間不會晚於到達時間；時間戳沿著到達時間的下緣前進，
+    Wi-Fi 或區塊緩衝晚到的批次不會把時間戳往後推，早到的批次則把時間戳拉回到達時間
+    samplerate: 標稱取樣率；實際取樣率由長時間的到達速度估計
+    slew: 每批時間戳最多比估計取樣率快多少比例，用來追上時脈漂移
+    """
+
+    def __init__(self, samplerate, slew=0.02, rate_span=5.0):
+        self.nominal_rate = samplerate
+        self.rate = float(samplerate)
+        self.slew = slew
+        self.rate_span = rate_span
+        self.count = 0            # 已標記的取樣數 (含掉包)
+        self.last = None          # 最後一筆取樣的時間戳
+        self.delay = 0.0          # 最近一批的到達時間減最後一筆取樣時間 (緩衝延遲)
+        self._first = None        # (到達時間, 取樣數) 用來估計實際取樣率
+
+    def stamp(self, n, arrival, lost=0):
+        """
+        標記一批 n 筆取樣，回傳時間戳 (n,)
+        lost: 這批取樣之前掉包的筆數，時間戳會跳過對應的時間
+        """
+        total = n + lost
+        if total == 0:
+            return np.empty(0)
+        if self.last is None:
+            end = arrival
+            start = arrival - total / self.rate
+            self._first = (arrival, total)
+        else:
+            first_arrival, first_count = self._first
+            span = arrival - first_arrival
+            if span >= self.rate_span:
+                self.rate = (self.count + total - first_count) / span
+            start = self.last
+            end = min(arrival, start + (1.0 + self.slew) * total / self.rate)
+        step = (end - start) / total
+        self.count += total
+        self.last = end
+        self.delay = arrival - end
+        return start + step * np.arange(lost + 1, total + 1)
+
+
+class ClockSync:
+    """
+    NTP 式時脈同步：每次 ping/pong 交換得到 t0 (本地送出)、t1 (遠端收到)、t2 (遠端送出)、t3 (本地收到)
+    offset = ((t1 - t0) + (t2 - t3)) / 2 為遠端時脈減本地時脈，rtt = (t3 - t0) - (t2 - t1)
+    保留最近 history 次交換，以 RTT 最小的一次作為 offset 估計（排隊延遲最少，也最對稱）
+    同時只有一個 ping 在途中，超過 timeout 沒有回應視為遺失
+    """
+
+    def __init__(self, interval=2.0, timeout=1.0, history=8):
+        self.interval = interval
+        self.timeout = timeout
+        self.offset = None
+        self.rtt = None           # 最近一次交換的 RTT
+        self.min_rtt = None
+        self.exchanges = 0
+        self.lost = 0
+        self._history = deque(maxlen=history)
+        self._pending = None      # (ping id, t0)
+        self._next = 0.0
+        self._id = 0
+
+    def due(self, now):
+        """是否該送出下一個 ping"""
+        if self._pending and now - self._pending[1] > self.timeout:
+            self._pending = None
+            self.lost += 1
+        return self._pending is None and now >= self._next
+
+    def time_until_due(self, now):
+        """距離下一個 ping 的秒數，供事件迴圈決定 select 逾時"""
+        if self._pending:
+            return max(0.0, self._pending[1] + self.timeout - now)
+        return max(0.0, self._next - now)
+
+    def begin(self, now):
+        """記錄送出時間，回傳這次 ping 的 id"""
+        self._id = (self._id + 1) & 0xFFFF
+        self._pending = (self._id, now)
+        self._next = now + self.interval
+        return self._id
+
+    def complete(self, t1, t2, t3, ping_id=None):
+        """收到 pong；不是目前在途中的 ping 時忽略並回傳 False"""
+        if self._pending is None or (ping_id is not None and ping_id != self._pending[0]):
+            return False
+        t0 = self._pending[1]
+        self._pending = None
+        rtt = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        self._history.append((rtt, offset))
+        self.rtt = rtt
+        self.min_rtt, self.offset = min(self._history)
+        self.exchanges += 1
+        return True
+
+    def to_remote(self, t):
+        return t + self.offset
+
+    def to_local(self, t):
+        return t - self.offset
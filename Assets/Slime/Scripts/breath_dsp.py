@@ -0,0 +1,326 @@
+import math
+import multiprocessing
+import socket
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from breath_ingest import TIME_REQUEST, open_adc_reader
+from breath_window import SlidingWindow
+from breath_protocol import BREATH_STATES
+from breath_spectrum import band_energy
+from breath_baseline import AdaptiveBaseline
+from breath_classifier import create_classifier
+from breath_clock import ClockSync, SampleClock
+
+# 取樣環：每筆 (取樣時間 time.time(), 正規化取樣)，500Hz 時約可暫存 65 秒
+SAMPLE_RING = 1 << 15
+# 事件環：判斷、氣泵確認及校正結果
+# 判斷事件的 window_time/decision_time 為視窗最後一筆取樣及判斷完成的 time.monotonic()
+EVENT_RING = 4096
+EVENT_FIELDS = ('kind', 'time', 'state', 'rms', 'amp', 'zcr', 'low', 'high', 'total', 'elapsed',
+                'window_time', 'decision_time')
+EVENT_DECISION, EVENT_ACK, EVENT_CALIBRATED = range(3)
+# 事件環標頭中由 DSP 行程更新的統計 (與取樣讀取器的屬性同名)
+READER_STATS = ('samples_received', 'malformed_samples', 'lost_samples', 'sequence_gaps')
+# ESP32 時脈同步及實際取樣率 (標頭只有 int64，以奈秒及 mHz 儲存)
+CLOCK_STATS = ('clock_offset_ns', 'clock_rtt_ns', 'clock_exchanges', 'sample_rate_mhz')
+
+_FIELD = {name: i for i, name in enumerate(EVENT_FIELDS)}
+
+
+class SharedRing:
+    """
+    shared_memory 上單一寫入端、單一讀取端的環狀緩衝區，每筆為 width 個 float64
+    寫入端只更新寫入位置，讀取端只更新讀取位置，不需要鎖；緩衝區滿時丟棄新資料並計入 dropped
+    counters: 標頭中額外的 int64 欄位名稱，由寫入端更新
+    """
+
+    _WRITE, _READ, _DROPPED = range(3)
+
+    def __init__(self, capacity, width, counters=(), name=None):
+        slots = 3 + len(counters)
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=8 * (slots + capacity * width))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.capacity = capacity
+        self.width = width
+        self.counters = {counter: 3 + i for i, counter in enumerate(counters)}
+        self.header = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray((capacity, width), dtype=np.float64, buffer=self.shm.buf, offset=8 * slots)
+        if self.owner:
+            self.header[:] = 0
+
+    @property
+    def spec(self):
+        """在另一個行程以 attach 開啟同一塊記憶體所需的參數"""
+        return self.shm.name, self.capacity, self.width, tuple(self.counters)
+
+    @classmethod
+    def attach(cls, spec):
+        name, capacity, width, counters = spec
+        return cls(capacity, width, counters, name=name)
+
+    @property
+    def dropped(self):
+        return int(self.header[self._DROPPED])
+
+    def qsize(self):
+        return int(self.header[self._WRITE] - self.header[self._READ])
+
+    def put(self, rows):
+        """寫入 (N, width) 筆資料，回傳實際寫入筆數"""
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, self.width)
+        write = int(self.header[self._WRITE])
+        n = min(rows.shape[0], self.capacity - (write - int(self.header[self._READ])))
+        if n < rows.shape[0]:
+            self.header[self._DROPPED] += rows.shape[0] - n
+        start = write % self.capacity
+        first = min(n, self.capacity - start)
+        self.data[start:start + first] = rows[:first]
+        self.data[:n - first] = rows[first:n]
+        # 資料寫完才前進寫入位置，讀取端不會看到寫到一半的紀錄
+        self.header[self._WRITE] = write + n
+        return n
+
+    def get(self):
+        """取出所有可讀的資料 (複本)"""
+        read = int(self.header[self._READ])
+        n = int(self.header[self._WRITE]) - read
+        start = read % self.capacity
+        first = min(n, self.capacity - start)
+        rows = np.concatenate((self.data[start:start + first], self.data[:n - first]))
+        self.header[self._READ] = read + n
+        return rows
+
+    def set(self, counter, value):
+        self.header[self.counters[counter]] = value
+
+    def counter(self, counter):
+        return int(self.header[self.counters[counter]])
+
+    def close(self):
+        # 先釋放指向共享記憶體的陣列，否則無法關閉
+        self.header = None
+        self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class DspProcess:
+    """
+    在獨立行程執行 ESP32 取樣接收、校正及呼吸判斷，避免與 Unity/氣泵 I/O 及鍵盤監聽爭用 GIL
+    結果經由 shared_memory 環狀緩衝區回傳，門鈴 socket 只用來喚醒主行程的事件迴圈
+    提供與取樣讀取器相同的統計屬性，主行程可沿用同一套指標及清理流程
+    """
+
+    format = 'dsp'
+
+    def __init__(self, sock, binary, config, record_samples=False):
+        """
+        sock: 已連線的 ESP32 socket；主行程保留同一個 socket 發送氣泵指令
+        binary: 是否由 DSP 行程協商二進位取樣格式
+        config: 判斷參數 (見 _run_worker)
+        record_samples: 是否把正規化取樣寫入取樣環供主行程錄製
+        """
+        context = multiprocessing.get_context('spawn')
+        self.samples = SharedRing(SAMPLE_RING, 2)
+        self.events = SharedRing(EVENT_RING, len(EVENT_FIELDS), counters=READER_STATS + CLOCK_STATS + ('closed',))
+        self.doorbell, remote = socket.socketpair()
+        self.doorbell.setblocking(False)
+        self._stop = context.Event()
+        self.process = context.Process(target=_run_worker, name='breath-dsp', daemon=True,
+                                       args=(sock, binary, remote, self.samples.spec, self.events.spec,
+                                             config, record_samples, self._stop))
+        self.process.start()
+        remote.close()
+        self.acks = []
+        self._final_stats = None
+
+    def __getattr__(self, name):
+        # samples_received、lost_samples 等統計由 DSP 行程寫在事件環標頭
+        if name in READER_STATS:
+            return self._stat(name)
+        raise AttributeError(name)
+
+    def _stat(self, name):
+        final = self.__dict__.get('_final_stats')
+        return final[name] if final else self.events.counter(name)
+
+    @property
+    def clock_exchanges(self):
+        return self._stat('clock_exchanges')
+
+    @property
+    def clock_offset(self):
+        """ESP32 時脈減本機 time.monotonic() 的秒數，尚未同步時為 None"""
+        return self._stat('clock_offset_ns') / 1e9 if self.clock_exchanges else None
+
+    @property
+    def clock_rtt(self):
+        return self._stat('clock_rtt_ns') / 1e9 if self.clock_exchanges else None
+
+    @property
+    def sample_rate(self):
+        """由到達速度估計的實際取樣率 (Hz)"""
+        return self._stat('sample_rate_mhz') / 1000
+
+    @property
+    def closed(self):
+        """DSP 行程已結束 (ESP32 斷線或發生錯誤)"""
+        return self.events.counter('closed') != 0 or not self.process.is_alive()
+
+    def drain(self):
+        """清空門鈴，回傳 (取樣 (N, 2), 事件 (M, len(EVENT_FIELDS)))"""
+        try:
+            while self.doorbell.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        except OSError:
+            pass
+        return self.samples.get(), self.events.get()
+
+    def close(self, timeout=2.0):
+        if self._final_stats is not None:
+            return
+        self._stop.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        self._final_stats = {name: self.events.counter(name) for name in READER_STATS + CLOCK_STATS}
+        self.doorbell.close()
+        self.samples.close()
+        self.events.close()
+
+
+def event_field(events, name):
+    """事件陣列的某一欄"""
+    return events[:, _FIELD[name]]
+
+
+def _run_worker(sock, binary, doorbell, samples_spec, events_spec, config, record_samples, stop):
+    """
+    DSP 行程主迴圈
+    config: samplerate, block_size, hop_size, hops_per_block, classifier, thresholds,
+            calibration_samples, baseline_tau, calibration_cache, device
+    """
+    samples = SharedRing.attach(samples_spec)
+    events = SharedRing.attach(events_spec)
+    doorbell.setblocking(False)
+    try:
+        reader = open_adc_reader(sock, binary=binary)
+        sock.settimeout(0.2)  # 定期檢查停止旗標
+        print(f"🧮 DSP 行程啟動 (取樣格式: {reader.format})", flush=True)
+
+        samplerate = config['samplerate']
+        hop_seconds = config['hop_size'] / samplerate
+        window = SlidingWindow(config['block_size'], config['hop_size'])
+        classifier = create_classifier(config['classifier'], config['thresholds'], config['hops_per_block'])
+        # 判斷引擎用不到頻帶能量時略過 FFT
+        spectrum = band_energy(config['block_size'], samplerate) if classifier.uses_spectrum else None
+        amp_min = config['thresholds']['amp_min']
+        calibration = AdaptiveBaseline(config['calibration_samples'], config['baseline_tau'],
+                                       config['calibration_cache'], config['device'])
+        if calibration.cached:
+            print(f"⚡ 使用快取基準值：{calibration.baseline:.2f}，ADC 範圍：0–{calibration.adc_range}"
+                  f"（背景重新校正中）", flush=True)
+        else:
+            print("⏳ 校正中，請保持安靜...", flush=True)
+
+        # 取樣時間戳及 ESP32 時脈同步 (二進位格式才支援)
+        sample_clock = SampleClock(samplerate)
+        sync = ClockSync() if reader.format == 'binary' else None
+        lost_seen = 0
+
+        row = np.zeros(len(EVENT_FIELDS))
+        while not stop.is_set():
+            if sync and sync.due(time.monotonic()):
+                sync.begin(time.monotonic())  # 緊接在送出之前記錄 t0
+                try:
+                    sock.sendall(TIME_REQUEST)
+                except OSError:
+                    pass  # 連線中斷由 recv 處理
+            try:
+                n = reader.recv()
+            except socket.timeout:
+                continue
+            arrival = time.monotonic()
+            now = time.time()
+            values = reader.feed(n) if n else np.empty(0, dtype=np.int32)
+
+            for t1, t2, _ in reader.time_replies:
+                sync.complete(t1, t2, arrival)
+            reader.time_replies.clear()
+
+            for command in reader.acks:
+                row[:] = 0
+                row[_FIELD['kind']] = EVENT_ACK
+                row[_FIELD['time']] = now
+                row[_FIELD['state']] = ord(command)
+                events.put(row)
+            reader.acks.clear()
+
+            if values.size:
+                lost = getattr(reader, 'lost_samples', 0)
+                stamps = sample_clock.stamp(values.size, arrival, lost - lost_seen)
+                lost_seen = lost
+                was_seeded = calibration.seeded
+                norm = calibration.feed(values)
+                stamps = stamps[stamps.size - norm.size:]
+                if calibration.seeded and not was_seeded:
+                    print(f"✅ 基準值：{calibration.baseline:.2f}，ADC 範圍：0–{calibration.adc_range}", flush=True)
+                    row[:] = 0
+                    row[_FIELD['kind']] = EVENT_CALIBRATED
+                    row[_FIELD['time']] = now
+                    row[_FIELD['rms']] = calibration.baseline
+                    row[_FIELD['amp']] = calibration.adc_range
+                    events.put(row)
+                if record_samples and norm.size:
+                    # 取樣時間換算成 time.time() 供錄製
+                    samples.put(np.column_stack((stamps + (now - arrival), norm)))
+
+                base = window.count
+                for rms, amp, zcr in window.push(norm):
+                    started = time.perf_counter()
+                    signal = window.view()
+                    low, high, total = spectrum.compute(signal) if spectrum else (math.nan,) * 3
+                    state = classifier.classify(rms, amp, zcr, low, high)
+                    row[:] = (EVENT_DECISION, now, BREATH_STATES.index(state), rms, amp, zcr, low, high, total,
+                              time.perf_counter() - started, stamps[window.count - base - 1], time.monotonic())
+                    events.put(row)
+                    # 安靜的視窗平均值就是基準值的偏差
+                    if amp < amp_min:
+                        calibration.track(float(np.mean(signal)), hop_seconds)
+
+            for name in READER_STATS:
+                events.set(name, getattr(reader, name, 0))
+            if sync and sync.exchanges:
+                events.set('clock_offset_ns', round(sync.offset * 1e9))
+                events.set('clock_rtt_ns', round(sync.rtt * 1e9))
+                events.set('clock_exchanges', sync.exchanges)
+            events.set('sample_rate_mhz', round(sample_clock.rate * 1000))
+            try:
+                doorbell.send(b'\0')
+            except OSError:
+                pass  # 門鈴已經在排隊中
+            if reader.closed:
+                break
+
+        if calibration.seeded:
+            calibration.save()
+            print(f"\n📐 基準值 {calibration.baseline:.2f} (漂移 {calibration.drift:+.2f})", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        events.set('closed', 1)
+        try:
+            doorbell.send(b'\0')
+        except OSError:
+            pass
+        doorbell.close()
+        samples.close()
+        events.close()
@@ -0,0 +1,215 @@
+import selectors
+import socket
+import time
+from breath_clock import ClockSync
+from breath_protocol import FrameDecoder, encode_messages
+
+# 每個訂閱者最多暫存的待送位元組；超過時視為接收太慢，中斷該連線
+MAX_PENDING_BYTES = 256 * 1024
+RECV_SIZE = 1024
+
+
+class UnitySubscriber:
+    """一個 Unity 連線：接收解碼器、非阻塞寫入緩衝區、遙測訂閱及時脈同步"""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.decoder = FrameDecoder()
+        self.pending = bytearray()  # 核心送出緩衝區已滿時暫存的資料
+        self.closed = False
+
+        # 遙測訂閱 (每個訂閱者各自的頻率)
+        self.telemetry_rate = 0
+        self.telemetry_next = None
+        self.telemetry_sent = None
+
+        # 每個 Unity 行程有自己的時脈
+        self.sync = ClockSync()
+
+    def __repr__(self):
+        host, port = self.address[:2]
+        return f"{host}:{port}"
+
+
+class UnityHub:
+    """
+    Unity 訂閱端點：同時接受多個連線（頭戴裝置、觀眾畫面、操作員儀表板…）
+    每則廣播只序列化一次，再寫入每個訂閱者的非阻塞緩衝區；緩衝超過 max_pending 的慢速連線直接中斷，
+    不會拖慢事件迴圈或其他訂閱者
+    最早連線的訂閱者為控制端（unity_control 模式下唯一可以送 character_state 的連線），
+    控制端離線時由下一個最早連線的訂閱者接手
+    """
+
+    def __init__(self, host, port, binary=False, max_clients=8, max_pending=MAX_PENDING_BYTES,
+                 on_connect=None, on_message=None, on_disconnect=None, log=print):
+        """
+        on_connect(subscriber): 新連線
+        on_message(subscriber, message, received): 收到消息 (received 為 time.monotonic())
+        on_disconnect(subscriber, was_controller): 連線中斷或被中斷
+        """
+        self.host = host
+        self.port = port
+        self.binary = binary
+        self.max_clients = max_clients
+        self.max_pending = max_pending
+        self.on_connect = on_connect
+        self.on_message = on_message
+        self.on_disconnect = on_disconnect
+        self.log = log
+
+        self.server = None
+        self.selector = None
+        self.subscribers = []  # 依連線先後排序，第一個是控制端
+        self._by_socket = {}
+
+        # 統計
+        self.slow_dropped = 0  # 因接收太慢被中斷的連線數
+        self.rejected = 0      # 超過連線上限被拒絕的連線數
+        self.broadcasts = 0
+
+    def listen(self):
+        """開始監聽；失敗時拋出 OSError"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((self.host, self.port))
+            server.listen(self.max_clients)
+            server.setblocking(False)
+        except OSError:
+            server.close()
+            raise
+        self.server = server
+
+    def attach(self, selector):
+        """把監聽 socket 註冊到事件迴圈 (callback 為 key.data(key.fileobj))"""
+        self.selector = selector
+        selector.register(self.server, selectors.EVENT_READ, self._on_accept)
+
+    @property
+    def controller(self):
+        return self.subscribers[0] if self.subscribers else None
+
+    def pending_bytes(self):
+        return sum(len(subscriber.pending) for subscriber in self.subscribers)
+
+    def broadcast(self, data):
+        """把已序列化的資料送給所有訂閱者，回傳送達的訂閱者數"""
+        self.broadcasts += 1
+        delivered = 0
+        for subscriber in list(self.subscribers):
+            delivered += self.send_bytes(subscriber, data)
+        return delivered
+
+    def send(self, subscriber, messages):
+        """只送給一個訂閱者的消息 (模式資訊、pong、時間同步等)"""
+        return self.send_bytes(subscriber, encode_messages(messages, self.binary))
+
+    def send_bytes(self, subscriber, data):
+        """
+        先嘗試直接寫入核心緩衝區，寫不完的部分暫存並等待可寫事件
+        回傳是否仍在連線中
+        """
+        if subscriber.closed:
+            return False
+        if not subscriber.pending:
+            try:
+                sent = subscriber.sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError as e:
+                self.close(subscriber, f"⚠️ 發送資料給Unity {subscriber} 失敗: {e}")
+                return False
+            if sent == len(data):
+                return True
+            self.selector.modify(subscriber.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self._on_ready)
+            data = memoryview(data)[sent:]
+        subscriber.pending += data
+        if len(subscriber.pending) > self.max_pending:
+            self.slow_dropped += 1
+            self.close(subscriber, f"🐢 Unity {subscriber} 接收太慢 (待送 {len(subscriber.pending)} 位元組)，中斷連線")
+            return False
+        return True
+
+    def close(self, subscriber, reason=None):
+        if subscriber.closed:
+            return
+        was_controller = subscriber is self.controller
+        subscriber.closed = True
+        self.subscribers.remove(subscriber)
+        del self._by_socket[subscriber.sock]
+        if self.selector:
+            self.selector.unregister(subscriber.sock)
+        subscriber.sock.close()
+        subscriber.pending.clear()
+        if reason:
+            self.log(reason)
+        if self.on_disconnect:
+            self.on_disconnect(subscriber, was_controller)
+
+    def close_all(self):
+        for subscriber in list(self.subscribers):
+            subscriber.closed = True
+            subscriber.sock.close()
+        self.subscribers.clear()
+        self._by_socket.clear()
+        if self.server:
+            self.server.close()
+
+    def _on_accept(self, sock):
+        try:
+            client, address = sock.accept()
+        except BlockingIOError:
+            return
+        if len(self.subscribers) >= self.max_clients:
+            self.rejected += 1
+            client.close()
+            self.log(f"⚠️ Unity連線數已達上限 ({self.max_clients})，拒絕 {address[0]}:{address[1]}")
+            return
+        client.setblocking(False)
+        subscriber = UnitySubscriber(client, address)
+        self.subscribers.append(subscriber)
+        self._by_socket[client] = subscriber
+        self.selector.register(client, selectors.EVENT_READ, self._on_ready)
+        if self.on_connect:
+            self.on_connect(subscriber)
+
+    def _on_ready(self, sock):
+        """可讀或可寫：先送出暫存資料，再讀取 Unity 送來的消息"""
+        subscriber = self._by_socket.get(sock)
+        if subscriber is None:
+            return  # 同一批事件中已被關閉
+        if subscriber.pending:
+            self._write_pending(subscriber)
+            if subscriber.closed:
+                return
+
+        try:
+            data = sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.log(f"⚠️ 接收Unity資料錯誤: {e}")
+            data = b''
+        if not data:
+            self.close(subscriber, f"\n❌ Unity {subscriber} 連線中斷")
+            return
+
+        received = time.monotonic()
+        # TCP可能黏包或拆包，由decoder重組完整frame
+        for message in subscriber.decoder.feed(data):
+            if subscriber.closed:
+                break
+            self.on_message(subscriber, message, received)
+
+    def _write_pending(self, subscriber):
+        try:
+            sent = subscriber.sock.send(subscriber.pending)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.close(subscriber, f"⚠️ 發送資料給Unity {subscriber} 失敗: {e}")
+            return
+        del subscriber.pending[:sent]
+        if not subscriber.pending:
+            self.selector.modify(subscriber.sock, selectors.EVENT_READ, self._on_ready)
@@ -0,0 +1,367 @@
+import socket
+import time
+import numpy as np
+
+# ASCII 位元組常數
+_NEWLINE = 0x0A
+_ZERO = 0x30
+_PLUS = 0x2B
+_MINUS = 0x2D
+# 與 int() 一樣忽略每行前後的空白 (空格、\t、\r、\v、\f)
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[[0x20, 0x09, 0x0D, 0x0B, 0x0C]] = True
+
+# 每行最多允許的位數（ADC 最大 4095，保留餘裕）
+_MAX_DIGITS = 6
+_COLUMNS = np.arange(_MAX_DIGITS)
+_POW10 = 10 ** np.arange(_MAX_DIGITS - 1, -1, -1, dtype=np.int32)
+# 向量化解析每次呼叫有約 70 µs 的固定成本，小於這個位元組數 (約 170 行 "2048\r\n") 時逐行 int() 較快
+SMALL_CHUNK_BYTES = 1024
+
+
+def parse_adc_lines(chunk):
+    """
+    解析完整的換行分隔十進位整數區塊；小區塊逐行解析，大區塊一次向量化解析
+    接受的格式與 int(line) 相同：前後可有空白，可帶 +/- 號
+    chunk: 只包含完整行（以 \n 結尾）的 uint8 陣列
+    回傳 (取樣值 int32 陣列, 格式錯誤行數)
+    """
+    if chunk.size < SMALL_CHUNK_BYTES:
+        return _parse_lines_scalar(chunk.tobytes())
+    return _parse_lines_vectorized(chunk)
+
+
+def _parse_lines_scalar(data):
+    """逐行 int()，事件迴圈每次只讀到幾行時使用"""
+    lines = data.split(b'\n')
+    lines.pop()
+    # 常見情況：每行都是短整數，一次 map(int) 即可；有空白行、底線或過長的行時才逐行檢查
+    if lines and b'_' not in data and max(map(len, lines)) <= _MAX_DIGITS:
+        try:
+            return np.array(list(map(int, lines)), dtype=np.int32), 0
+        except ValueError:
+            pass
+    values = []
+    malformed = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        digits = line[1:] if line[:1] in (b'+', b'-') else line
+        # isdigit 排除 int() 也接受的底線，與向量化解析一致
+        if 0 < len(digits) <= _MAX_DIGITS and digits.isdigit():
+            values.append(int(line))
+        else:
+            malformed += 1
+    return np.array(values, dtype=np.int32), malformed
+
+
+def _parse_lines_vectorized(chunk):
+    """組成 (行數, 位數) 矩陣一次轉換"""
+    ends = np.flatnonzero(chunk == _NEWLINE)
+    if ends.size == 0:
+        return np.empty(0, dtype=np.int32), 0
+
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # 去掉 println 產生的 \r 及前後空白；通常只有少數行需要，只對還在修剪的行重複
+    _strip(chunk, starts, ends)
+    # 正負號
+    first = chunk[np.minimum(starts, ends)]
+    signed = (starts < ends) & ((first == _PLUS) | (first == _MINUS))
+    negative = signed & (first == _MINUS)
+    starts += signed
+    lengths = ends - starts
+
+    # 以每行結尾往前取固定寬度，組成 (行數, 位數) 矩陣一次轉換
+    idx = ends[:, None] - _MAX_DIGITS + _COLUMNS
+    inside = idx >= starts[:, None]
+    digits = chunk[np.maximum(idx, 0)].astype(np.int32) - _ZERO
+    digits[~inside] = 0
+    bad_char = ((digits < 0) | (digits > 9)).any(axis=1)
+    values = digits @ _POW10
+    values[negative] *= -1
+
+    blank = (lengths == 0) & ~signed  # 空白行不是取樣，直接略過不計入錯誤；只有正負號則是格式錯誤
+    malformed = ~blank & (bad_char | (lengths == 0) | (lengths > _MAX_DIGITS))
+    valid = ~(blank | malformed)
+    return values[valid], int(np.count_nonzero(malformed))
+
+
+def _strip(chunk, starts, ends):
+    """就地把每行的 [starts, ends) 去掉前後空白"""
+    rows = np.flatnonzero((ends > starts) & _WHITESPACE[chunk[ends - 1]])
+    while rows.size:
+        ends[rows] -= 1
+        rows = rows[(ends[rows] > starts[rows]) & _WHITESPACE[chunk[ends[rows] - 1]]]
+    rows = np.flatnonzero((starts < ends) & _WHITESPACE[chunk[starts]])
+    while rows.size:
+        starts[rows] += 1
+        rows = rows[(starts[rows] < ends[rows]) & _WHITESPACE[chunk[starts[rows]]]]
+
+
+class AdcStreamReader:
+    """ESP32 ADC 串流讀取器：recv_into 預先配置的緩衝區，整塊向量化解析"""
+
+    format = 'ascii'
+
+    def __init__(self, sock, recv_size=4096, max_carry=64):
+        self.sock = sock
+        self.recv_size = recv_size
+        self.max_carry = max_carry
+        self._buf = bytearray(max_carry + recv_size)
+        self._view = memoryview(self._buf)
+        self._array = np.frombuffer(self._buf, dtype=np.uint8)
+        self._carry = 0  # 緩衝區開頭尚未結束的半行位元組數
+
+        # 統計
+        self.samples_received = 0
+        self.malformed_samples = 0
+        self.bytes_received = 0
+        self.closed = False
+        self.acks = []  # ASCII 格式沒有氣泵確認，永遠為空
+        self.time_replies = []  # ASCII 格式沒有時間同步，永遠為空
+
+    def read(self):
+        """
+        讀取一次 socket 並回傳新取樣 (int32 NumPy 陣列)
+        socket.timeout 等例外交由呼叫端處理
+        """
+        n = self.recv()
+        if n == 0:
+            return np.empty(0, dtype=np.int32)
+        return self.feed(n)
+
+    def recv(self):
+        """只讀取 socket 到緩衝區，回傳位元組數（與 feed 分開以便分別計時）"""
+        n = self.sock.recv_into(self._view[self._carry:], self.recv_size)
+        if n == 0:
+            self.closed = True
+        return n
+
+    def prime(self, data):
+        """餵入協商期間已收到的資料（不完整的行保留給下次讀取）"""
+        for start in range(0, len(data), self.recv_size):
+            chunk = data[start:start + self.recv_size]
+            self._view[self._carry:self._carry + len(chunk)] = chunk
+            self.feed(len(chunk))
+
+    def feed(self, n):
+        """處理剛寫入緩衝區 (carry 之後) 的 n 個位元組"""
+        self.bytes_received += n
+        end = self._carry + n
+        last = self._buf.rfind(b'\n', 0, end) + 1
+        if last == 0:
+            self._keep_tail(0, end)
+            return np.empty(0, dtype=np.int32)
+
+        values, malformed = parse_adc_lines(self._array[:last])
+        self.samples_received += values.size
+        self.malformed_samples += malformed
+        self._keep_tail(last, end)
+        return values
+
+    def _keep_tail(self, start, end):
+        """把未結束的半行搬到緩衝區開頭，供下次讀取接續"""
+        tail = end - start
+        if tail > self.max_carry:
+            # 過長且沒有換行的資料必定是雜訊，整段丟棄
+            self.malformed_samples += 1
+            tail = 0
+        elif tail:
+            self._view[:tail] = self._view[start:end]
+        self._carry = tail
+
+
+# === 二進位取樣協定 ===
+# 連線後 Python 送出 BINARY_REQUEST；支援的韌體回覆 BINARY_ACK 一行後改送固定大小封包：
+# 同步碼(uint16 LE) + 序號(uint16 LE) + PACKET_SAMPLES 筆 uint16 LE 取樣
+# 舊韌體會忽略請求並繼續送 ASCII，此時退回 AdcStreamReader
+# 韌體執行氣泵指令後回送同樣大小的確認封包：同步碼 ACK_SYNC，序號欄位為指令字元，第一筆取樣為繼電器狀態
+# 收到 TIME_REQUEST 時回送時間封包：同步碼 TIME_SYNC，序號欄位為第幾次回應，
+# 前四筆取樣為收到請求及送出回應時的 micros() (各為 uint32 的低/高 16 位元)
+BINARY_REQUEST = b'b'
+BINARY_ACK = b'BIN1'
+TIME_REQUEST = b'p'
+PACKET_SYNC = 0x5AA5
+ACK_SYNC = 0x5AA6
+TIME_SYNC = 0x5AA7
+PACKET_SAMPLES = 16
+PACKET_DTYPE = np.dtype([('sync', '<u2'), ('seq', '<u2'), ('samples', '<u2', (PACKET_SAMPLES,))])
+PACKET_SIZE = PACKET_DTYPE.itemsize
+_SYNC_BYTES = PACKET_SYNC.to_bytes(2, 'little')
+_ACK_SYNC_BYTES = ACK_SYNC.to_bytes(2, 'little')
+_TIME_SYNC_BYTES = TIME_SYNC.to_bytes(2, 'little')
+_SYNC_WORDS = (_SYNC_BYTES, _ACK_SYNC_BYTES, _TIME_SYNC_BYTES)
+
+
+class AdcPacketReader:
+    """ESP32 二進位取樣讀取器：整批封包直接以 frombuffer 解碼，並以序號偵測掉包"""
+
+    format = 'binary'
+
+    def __init__(self, sock, recv_packets=128):
+        self.sock = sock
+        self.recv_size = recv_packets * PACKET_SIZE
+        self._buf = bytearray(PACKET_SIZE + self.recv_size)
+        self._view = memoryview(self._buf)
+        self._carry = 0  # 緩衝區開頭尚未湊滿一個封包的位元組數
+        self._next_seq = None
+        self._micros_last = None  # 上一個韌體 micros()，用來展開 32 位元溢位 (約 71 分鐘一次)
+        self._micros_wraps = 0
+
+        # 統計
+        self.samples_received = 0
+        self.malformed_samples = 0
+        self.lost_samples = 0
+        self.sequence_gaps = 0
+        self.bytes_received = 0
+        self.closed = False
+        self.acks = []  # 收到的氣泵確認 (指令字元)，由呼叫端取走
+        self.time_replies = []  # 收到的時間回應 (t1, t2 韌體秒數, 回應序號)，由呼叫端取走
+
+    def read(self):
+        """
+        讀取一次 socket 並回傳新取樣 (int32 NumPy 陣列)
+        socket.timeout 等例外交由呼叫端處理
+        """
+        n = self.recv()
+        if n == 0:
+            return np.empty(0, dtype=np.int32)
+        return self.feed(n)
+
+    def recv(self):
+        """只讀取 socket 到緩衝區，回傳位元組數（與 feed 分開以便分別計時）"""
+        n = self.sock.recv_into(self._view[self._carry:], self.recv_size)
+        if n == 0:
+            self.closed = True
+        return n
+
+    def prime(self, data):
+        """餵入協商期間已收到的資料"""
+        for start in range(0, len(data), self.recv_size):
+            chunk = data[start:start + self.recv_size]
+            self._view[self._carry:self._carry + len(chunk)] = chunk
+            self.feed(len(chunk))
+
+    def feed(self, n):
+        """處理剛寫入緩衝區 (carry 之後) 的 n 個位元組"""
+        self.bytes_received += n
+        end = self._carry + n
+
+        batches = []
+        pos = 0
+        while True:
+            pos = self._resync(pos, end)
+            count = (end - pos) // PACKET_SIZE
+            if count == 0:
+                break
+            packets = np.frombuffer(self._buf, dtype=PACKET_DTYPE, count=count, offset=pos)
+            is_ack = packets['sync'] == ACK_SYNC
+            is_time = packets['sync'] == TIME_SYNC
+            synced = (packets['sync'] == PACKET_SYNC) | is_ack | is_time
+            if not synced.all():
+                # 串流錯位：只取第一個錯誤前的封包，之後重新同步
+                count = int(np.argmin(synced))
+                packets = packets[:count]
+                is_ack = is_ack[:count]
+                is_time = is_time[:count]
+            control = is_ack | is_time
+            if control.any():
+                self.acks.extend(chr(seq) for seq in packets['seq'][is_ack].tolist())
+                self._time_replies(packets[is_time])
+                packets = packets[~control]
+            self._track_sequence(packets['seq'])
+            batches.append(packets['samples'].ravel())
+            pos += count * PACKET_SIZE
+
+        values = np.concatenate(batches).astype(np.int32) if batches else np.empty(0, dtype=np.int32)
+        self.samples_received += values.size
+
+        tail = end - pos
+        if tail:
+            self._view[:tail] = self._view[pos:end]
+        self._carry = tail
+        return values
+
+    def _time_replies(self, packets):
+        """解出時間封包的 (t1, t2)，換算成秒並展開 micros() 溢位"""
+        words = packets['samples'][:, :4].astype(np.int64)
+        micros = words[:, 0::2] | (words[:, 1::2] << 16)
+        for (t1, t2), seq in zip(micros.tolist(), packets['seq'].tolist()):
+            # 兩個時間依序展開：t2 可能剛好在 t1 之後溢位
+            t1, t2 = self._unwrap_micros(t1), self._unwrap_micros(t2)
+            self.time_replies.append((t1 / 1e6, t2 / 1e6, seq))
+
+    def _unwrap_micros(self, value):
+        if self._micros_last is not None and value < self._micros_last - (1 << 31):
+            self._micros_wraps += 1
+        self._micros_last = value
+        return value + (self._micros_wraps << 32)
+
+    def _resync(self, start, end):
+        """找到下一個同步碼的位置，跳過的位元組視為錯誤資料"""
+        if self._buf[start:start + 2] in _SYNC_WORDS:
+            return start
+        candidates = [i for i in (self._buf.find(sync, start + 1, end) for sync in _SYNC_WORDS) if i >= 0]
+        found = min(candidates) if candidates else -1
+        skipped_end = found if found >= 0 else max(start, end - 1)
+        self.malformed_samples += (skipped_end - start + PACKET_SIZE - 1) // PACKET_SIZE
+        return skipped_end
+
+    def _track_sequence(self, seq):
+        """以序號 (uint16 循環) 偵測掉包"""
+        if seq.size == 0:
+            return
+        seq = seq.astype(np.int64)
+        expected = np.empty_like(seq)
+        expected[0] = seq[0] if self._next_seq is None else self._next_seq
+        expected[1:] = (seq[:-1] + 1) & 0xFFFF
+        missing = (seq - expected) & 0xFFFF
+        gaps = np.count_nonzero(missing)
+        if gaps:
+            self.sequence_gaps += int(gaps)
+            self.lost_samples += int(missing.sum()) * PACKET_SAMPLES
+        self._next_seq = int(seq[-1] + 1) & 0xFFFF
+
+
+def open_adc_reader(sock, binary=True, timeout=0.5):
+    """
+    建立 ESP32 取樣讀取器；binary=True 時先協商二進位格式，失敗則退回 ASCII
+    協商期間收到的 ASCII 取樣在校正前，直接捨棄
+    """
+    if not binary:
+        return AdcStreamReader(sock)
+
+    sock.sendall(BINARY_REQUEST)
+    received = bytearray()
+    deadline = time.monotonic() + timeout
+    previous_timeout = sock.gettimeout()
+    try:
+        while True:
+            ack = received.find(BINARY_ACK + b'\n')
+            if ack >= 0 and (ack == 0 or received[ack - 1] == 0x0A):
+                reader = AdcPacketReader(sock)
+                reader.prime(bytes(received[ack + len(BINARY_ACK) + 1:]))
+                return reader
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            received += data
+    finally:
+        sock.settimeout(previous_timeout)
+
+    # 舊韌體：保留最後不完整的一行
+    reader = AdcStreamReader(sock)
+    last = received.rfind(b'\n') + 1
+    reader.prime(bytes(received[last:]))
+    return reader
@@ -0,0 +1,224 @@
+import json
+import queue
+import sys
+import threading
+import time
+import numpy as np
+
+# 每個階段保留最近幾次的耗時，用來計算百分位數
+STAGE_HISTORY = 1024
+PERCENTILES = (50, 90, 99)
+
+
+class Stage:
+    """單一處理階段的耗時統計；只由一個執行緒寫入"""
+
+    def __init__(self, history=STAGE_HISTORY):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = np.zeros(history)
+
+    def observe(self, seconds):
+        self._recent[self.count % self._recent.size] = seconds
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentiles(self):
+        recent = self._recent[:min(self.count, self._recent.size)]
+        if recent.size == 0:
+            return [0.0] * len(PERCENTILES)
+        return np.percentile(recent, PERCENTILES).tolist()
+
+
+class Metrics:
+    """
+    熱路徑只做計數及寫入預先配置的陣列；格式化及輸出留給讀取端
+    stage: 各階段耗時 (秒)
+    count: 累計計數器
+    gauge: 讀取時才呼叫的函式，例如佇列深度
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage()
+        return stage
+
+    def observe(self, name, seconds):
+        self.stage(name).observe(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        """回傳目前所有指標的 dict"""
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception:
+                gauges[name] = None
+        stages = {}
+        for name, stage in list(self.stages.items()):
+            p50, p90, p99 = stage.percentiles()
+            stages[name] = {'count': stage.count, 'total': stage.total, 'max': stage.max,
+                            'p50': p50, 'p90': p90, 'p99': p99}
+        return {'uptime': time.monotonic() - self.started, 'counters': dict(self.counters),
+                'gauges': gauges, 'stages': stages}
+
+    def render(self, snapshot=None):
+        """Prometheus 文字格式"""
+        snapshot = snapshot or self.snapshot()
+        lines = [f"breath_uptime_seconds {snapshot['uptime']:.3f}"]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"breath_{name}_total {value}")
+        for name, value in sorted(snapshot['gauges'].items()):
+            if value is not None:
+                lines.append(f"breath_{name} {value}")
+        for name, stage in sorted(snapshot['stages'].items()):
+            lines.append(f'breath_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+            lines.append(f'breath_stage_seconds_sum{{stage="{name}"}} {stage["total"]:.6f}')
+            lines.append(f'breath_stage_seconds_max{{stage="{name}"}} {stage["max"]:.6f}')
+            for p in PERCENTILES:
+                lines.append(f'breath_stage_seconds{{stage="{name}",quantile="{p / 100}"}} {stage[f"p{p}"]:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, previous=None):
+        """
+        一行文字摘要，供定期輸出；previous 為上次的 snapshot，用來計算每秒速率
+        回傳 (文字, snapshot)
+        """
+        snapshot = self.snapshot()
+        parts = []
+        if previous:
+            elapsed = max(snapshot['uptime'] - previous['uptime'], 1e-9)
+            for name in ('samples', 'decisions'):
+                delta = snapshot['counters'].get(name, 0) - previous['counters'].get(name, 0)
+                parts.append(f"{name}={delta / elapsed:.0f}/s")
+        for name, stage in sorted(snapshot['stages'].items()):
+            parts.append(f"{name} p50={stage['p50'] * 1e6:.0f}µs p99={stage['p99'] * 1e6:.0f}µs")
+        for name, value in sorted(snapshot['gauges'].items()):
+            parts.append(f"{name}={value}")
+        return ' | '.join(parts), snapshot
+
+
+class MetricsServer:
+    """本機 HTTP 指標端點：/metrics 為文字格式，/metrics.json 為 JSON"""
+
+    def __init__(self, metrics, host='127.0.0.1', port=9100):
+        # http.server 載入較慢，只有啟用指標端點時才載入
+        from http.server import ThreadingHTTPServer
+        self.httpd = ThreadingHTTPServer((host, port), _handler_class(metrics))
+        self.httpd.daemon_threads = True
+        self.address = self.httpd.server_address
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _handler_class(metrics):
+    """每個 MetricsServer 各自的請求處理類別"""
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = metrics.render().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            elif self.path == '/metrics.json':
+                body = json.dumps(metrics.snapshot()).encode('utf-8')
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # 不在終端機輸出每次請求
+
+    return MetricsHandler
+
+
+class ConsoleLog:
+    """
+    背景執行緒負責輸出，熱路徑只把字串放進有上限的佇列
+    同一個 key 的訊息在 interval 秒內只輸出第一則，其餘計入 suppressed；佇列滿時直接丟棄
+    """
+
+    def __init__(self, stream=None, max_queue=1000, enabled=True):
+        self.stream = stream or sys.stdout
+        self.enabled = enabled
+        self.suppressed = 0
+        self.dropped = 0
+        self._last = {}
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, text, key=None, interval=0.0, end='\n'):
+        if not self.enabled:
+            return
+        if key is not None and interval > 0:
+            now = time.monotonic()
+            if now - self._last.get(key, -interval) < interval:
+                self.suppressed += 1
+                return
+            self._last[key] = now
+        try:
+            self._queue.put_nowait(text + end)
+        except queue.Full:
+            self.dropped += 1
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def close(self, timeout=1.0):
+        """輸出剩下的訊息後停止"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            text = self._queue.get()
+            if text is None:
+                return
+            # 一次寫出佇列中所有訊息
+            chunks = [text]
+            while True:
+                try:
+                    text = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if text is None:
+                    self._write(chunks)
+                    return
+                chunks.append(text)
+            self._write(chunks)
+
+    def _write(self, chunks):
+        try:
+            self.stream.write(''.join(chunks))
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
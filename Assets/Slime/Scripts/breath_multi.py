@@ -0,0 +1,475 @@
+import argparse
+import functools
+import selectors
+import socket
+import time
+import numpy as np
+from breath_ingest import TIME_REQUEST, open_adc_reader
+from breath_window import MultiChannelWindow, batch_features, hop_samples
+from breath_protocol import BREATH_STATES, OutboundQueue, breath_update_message, encode_messages
+from breath_rules import EXHALE, INHALE, StreamingRules, load_thresholds
+from breath_classifier import create_classifier, feature_matrix
+from breath_spectrum import band_energy
+from breath_baseline import DEFAULT_CACHE_PATH, AdaptiveBaseline
+from breath_pump import PUMP_OFF, PUMP_ON, PumpChannel
+from breath_metrics import ConsoleLog, Metrics, MetricsServer
+from breath_fanout import UnityHub
+from breath_clock import ClockSync, SampleClock
+
+
+def parse_sensor(spec, index, default_esp32_port=8080, default_unity_port=7777):
+    """解析 host[:esp32_port[:unity_port]]；未指定 Unity 埠號時依序遞增"""
+    parts = spec.split(':')
+    host = parts[0]
+    esp32_port = int(parts[1]) if len(parts) > 1 and parts[1] else default_esp32_port
+    unity_port = int(parts[2]) if len(parts) > 2 and parts[2] else default_unity_port + index
+    return host, esp32_port, unity_port
+
+
+class SensorChannel:
+    """一個感測站：ESP32 連線、校正、待處理取樣、氣泵通道及專屬的 Unity 訂閱端點"""
+
+    def __init__(self, index, esp32_host, esp32_port, unity_port, engine):
+        self.index = index
+        self.name = f"{esp32_host}:{esp32_port}"
+        self.esp32_host = esp32_host
+        self.esp32_port = esp32_port
+        self.unity_port = unity_port
+        self.engine = engine
+
+        self.esp32_socket = None
+        self.reader = None
+        self.calibration = None
+        self.pending = np.empty(0)  # 尚未湊滿一個 hop 的正規化取樣
+        self.pending_times = np.empty(0)  # 對應的取樣時間戳 (time.monotonic())
+        self.clock = SampleClock(engine.samplerate)
+        self.esp32_sync = ClockSync()
+        self.decision_times = None  # 最近一次狀態改變的 (視窗時間, 判斷時間)
+        self._lost_seen = 0
+        self.pump = None
+        self.pump_is_on = False
+        self.state = 'undecided'
+
+        self.unity = None  # UnityHub
+        self.queue = OutboundQueue()
+
+    def connect(self, esp32_binary, calibration_samples, baseline_tau, calibration_cache, pump_min_interval):
+        """連接 ESP32 並建立校正及氣泵通道"""
+        try:
+            self.esp32_socket = socket.create_connection((self.esp32_host, self.esp32_port), timeout=5.0)
+            self.esp32_socket.settimeout(1.0)
+            self.reader = open_adc_reader(self.esp32_socket, binary=esp32_binary)
+        except OSError as e:
+            print(f"❌ [{self.name}] ESP32連接失敗: {e}")
+            return False
+        self.calibration = AdaptiveBaseline(calibration_samples, baseline_tau, calibration_cache, self.name)
+        self.pump = PumpChannel(self.send_command, pump_min_interval)
+        cached = "（使用快取基準值）" if self.calibration.cached else ""
+        print(f"✅ [{self.name}] ESP32連接成功 (取樣格式: {self.reader.format}){cached}")
+        return True
+
+    def listen(self, max_clients):
+        """在專屬埠號等待 Unity 連接（可同時有多個訂閱者，與模擬器相同由事件迴圈以非阻塞方式寫入）"""
+        engine = self.engine
+        self.unity = UnityHub('localhost', self.unity_port, engine.unity_binary, max_clients,
+                              on_connect=functools.partial(engine.on_unity_connect, self),
+                              on_message=functools.partial(engine.on_unity_message, self),
+                              on_disconnect=functools.partial(engine.on_unity_disconnect, self),
+                              log=engine.console.log)
+        try:
+            self.unity.listen()
+        except OSError as e:
+            print(f"❌ [{self.name}] Unity伺服器啟動失敗: {e}")
+            self.unity = None
+            return False
+        print(f"🌐 [{self.name}] 等待Unity連接於 localhost:{self.unity_port}")
+        return True
+
+    def send_command(self, command):
+        """氣泵通道執行緒呼叫，可阻塞"""
+        started = time.perf_counter()
+        try:
+            self.esp32_socket.sendall(command.encode())
+            self.engine.console.log(f"📤 [{self.name}] 發送命令: {command}")
+        except OSError as e:
+            self.engine.console.log(f"❌ [{self.name}] 發送命令失敗: {e}", key=f'pump_error_{self.index}', interval=1.0)
+        # Stage 只能由一個執行緒寫入，每個通道的氣泵執行緒各用一個
+        self.engine.metrics.observe(f'pump_send_{self.index}', time.perf_counter() - started)
+
+    def set_state(self, state, times):
+        """
+        狀態改變：通知 Unity 並依狀態控制氣泵（未決定時維持）
+        times: 觸發的 (視窗最後一筆取樣時間, 判斷時間)，time.monotonic()
+        """
+        self.state = state
+        self.decision_times = times
+        self.queue.put(breath_update_message(state, 'breath_detection', times))
+        if state == 'likely_INHALE' and not self.pump_is_on:
+            self.pump_is_on = True
+            self.pump.request(True)
+        elif state == 'likely_EXHALE' and self.pump_is_on:
+            self.pump_is_on = False
+            self.pump.request(False)
+
+    def mode_info(self, subscriber):
+        return {'type': 'mode_setup', 'mode': 'breath_detection', 'description': '真實呼吸檢測',
+                'protocol': 'binary' if self.engine.unity_binary else 'json', 'channel': self.index,
+                'controller': subscriber is self.unity.controller}
+
+    def flush(self):
+        """把排隊的消息序列化一次後廣播給所有訂閱者 (非阻塞，慢速連線由 UnityHub 中斷)；沒有 Unity 時丟棄"""
+        messages = self.queue.drain()
+        if not messages or not self.unity or not self.unity.subscribers:
+            return
+        self.unity.broadcast(encode_messages(messages, self.engine.unity_binary))
+        sent = time.monotonic()
+        for message in messages:
+            if message.get('type') == 'breath_update':
+                self.engine.metrics.observe('decision_to_send', sent - message['decision_time'])
+
+    def stamp(self, values, arrival):
+        """每筆取樣的時間戳；掉包的取樣也佔用時間"""
+        lost = getattr(self.reader, 'lost_samples', 0)
+        stamps = self.clock.stamp(values.size, arrival, lost - self._lost_seen)
+        self._lost_seen = lost
+        return stamps
+
+    def complete_esp32_sync(self, arrival):
+        """韌體回送的時間封包：t1/t2 為韌體 micros() 秒數，arrival 為本機收到的時間"""
+        replies = self.reader.time_replies
+        if replies:
+            for t1, t2, _ in replies:
+                self.esp32_sync.complete(t1, t2, arrival)
+            replies.clear()
+
+    def syncs_esp32(self):
+        """二進位格式的韌體才支援時間同步"""
+        return self.reader is not None and self.reader.format == 'binary' and not self.reader.closed
+
+    def close(self):
+        if self.pump:
+            self.pump.request(False)
+            self.pump.close()
+        if self.unity:
+            self.unity.close_all()
+        if self.esp32_socket:
+            self.esp32_socket.close()
+
+
+class MultiSensorEngine:
+    """
+    單一行程管理多個 ESP32 感測站
+    所有通道的視窗堆疊在同一個二維陣列，每個 hop 以一次向量化運算完成所有通道的特徵計算及判斷
+    """
+
+    def __init__(self, sensors, hop_ms=10, thresholds=None, esp32_binary=True, unity_binary=False,
+                 baseline_tau=10.0, calibration_cache=DEFAULT_CACHE_PATH, pump_min_interval=0.25,
+                 metrics_port=None, stats_interval=0.0, classifier='rules', unity_max_clients=8):
+        """
+        sensors: [(esp32_host, esp32_port, unity_port), ...]
+        classifier: 'rules' 為規則判斷 (預設)，或 breath_train.py 訓練的模型 .npz 路徑
+        其他參數與 BreathSimulatorV2 相同
+        """
+        self.samplerate = 500
+        self.block_duration = 0.25
+        self.block_size = int(self.samplerate * self.block_duration)
+        self.hop_ms = hop_ms
+        self.hop_size = hop_samples(self.samplerate, self.block_size, hop_ms)
+        self.hops_per_block = self.block_size // self.hop_size
+        self.calibration_samples = 200
+
+        self.esp32_binary = esp32_binary
+        self.unity_binary = unity_binary
+        self.unity_max_clients = unity_max_clients
+        self.baseline_tau = baseline_tau
+        self.calibration_cache = calibration_cache
+        self.pump_min_interval = pump_min_interval
+        self.thresholds = thresholds
+
+        self.metrics = Metrics()
+        self.console = ConsoleLog()
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.stats_interval = stats_interval
+
+        self.channels = [SensorChannel(i, host, esp32_port, unity_port, self)
+                         for i, (host, esp32_port, unity_port) in enumerate(sensors)]
+        self.window = MultiChannelWindow(len(self.channels), self.block_size, self.hop_size)
+        self.rules = StreamingRules(len(self.channels), thresholds, self.hops_per_block)
+        # 學習模型一次推論所有通道；規則門檻仍用於安靜視窗的判斷
+        self.model = None if not classifier or classifier == 'rules' else create_classifier(classifier)
+        self.spectrum = band_energy(self.block_size, self.samplerate) if self.model else None
+        self.selector = None
+        self.running = True
+
+    def setup(self):
+        """連接所有感測站；至少一個成功才繼續"""
+        for channel in self.channels:
+            if channel.connect(self.esp32_binary, self.calibration_samples, self.baseline_tau,
+                               self.calibration_cache, self.pump_min_interval):
+                channel.listen(self.unity_max_clients)
+        active = [channel for channel in self.channels if channel.reader]
+        if not active:
+            return False
+
+        self.selector = selectors.DefaultSelector()
+        for channel in active:
+            self.selector.register(channel.esp32_socket, selectors.EVENT_READ,
+                                   functools.partial(self.on_esp32_readable, channel))
+            if channel.unity:
+                channel.unity.attach(self.selector)
+
+        self.metrics.gauge('channels', lambda: len(active))
+        self.metrics.gauge('console_queue_depth', self.console.depth)
+        self.metrics.gauge('unity_queue_depth', lambda: sum(c.queue.qsize() for c in self.channels))
+        hubs = [channel.unity for channel in active if channel.unity]
+        self.metrics.gauge('unity_clients', lambda: sum(len(hub.subscribers) for hub in hubs))
+        self.metrics.gauge('unity_pending_bytes', lambda: sum(hub.pending_bytes() for hub in hubs))
+        self.metrics.gauge('unity_slow_dropped', lambda: sum(hub.slow_dropped for hub in hubs))
+        self.metrics.gauge('malformed_samples', lambda: sum(c.reader.malformed_samples for c in active))
+        self.metrics.gauge('lost_samples', lambda: sum(getattr(c.reader, 'lost_samples', 0) for c in active))
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, port=self.metrics_port)
+            self.metrics_server.start()
+            print(f"📈 指標端點: http://{self.metrics_server.address[0]}:{self.metrics_server.address[1]}/metrics")
+        if self.hop_size * 1000 != self.hop_ms * self.samplerate:
+            print(f"⚠️ 判斷間隔 {self.hop_ms}ms 無法整除 {self.block_size} 筆的視窗，改用最接近的間隔")
+        model_hop = self.model.hop_ms if self.model else None
+        if model_hop is not None and hop_samples(self.samplerate, self.block_size, model_hop) != self.hop_size:
+            print(f"⚠️ 模型以 {model_hop}ms 判斷間隔訓練，與目前的 "
+                  f"{self.hop_size * 1000 / self.samplerate:.0f}ms 不同，判斷結果可能不準確")
+        print(f"🔍 {len(active)} 個感測站，分析視窗 {self.block_size} 筆，每 {self.hop_size} 筆 "
+              f"({self.hop_size * 1000 / self.samplerate:.0f}ms) 判斷一次，判斷引擎: {self.model.name if self.model else 'rules'}")
+        return True
+
+    # === 事件處理 ===
+    def on_esp32_readable(self, channel, sock):
+        metrics = self.metrics
+        started = time.perf_counter()
+        try:
+            n = channel.reader.recv()
+            arrival = time.monotonic()
+        except socket.timeout:
+            return
+        except OSError as e:
+            self.console.log(f"❌ [{channel.name}] 接收數據錯誤: {e}", key=f'recv_error_{channel.index}', interval=1.0)
+            n = 0
+            channel.reader.closed = True
+        parsed = time.perf_counter()
+        metrics.observe('recv', parsed - started)
+
+        if n:
+            values = channel.reader.feed(n)
+            metrics.observe('parse', time.perf_counter() - parsed)
+            channel.complete_esp32_sync(arrival)
+            if values.size:
+                metrics.count('samples', values.size)
+                stamps = channel.stamp(values, arrival)
+                metrics.observe('sample_buffering', channel.clock.delay)
+                # 初始校正期間沒有快取時回傳的是最後 normalized.size 筆
+                normalized = channel.calibration.feed(values)
+                if normalized.size:
+                    stamps = stamps[stamps.size - normalized.size:]
+                    if channel.pending.size:
+                        channel.pending = np.concatenate((channel.pending, normalized))
+                        channel.pending_times = np.concatenate((channel.pending_times, stamps))
+                    else:
+                        channel.pending, channel.pending_times = normalized, stamps
+            for command in channel.reader.acks:
+                channel.pump.acknowledge(command)
+            channel.reader.acks.clear()
+
+        if channel.reader.closed:
+            self.console.log(f"\n❌ [{channel.name}] ESP32連線中斷")
+            self.selector.unregister(channel.esp32_socket)
+
+    def on_unity_connect(self, channel, subscriber):
+        """新的訂閱者：只對它補送模式資訊及目前狀態"""
+        self.console.log(f"✅ [{channel.name}] Unity已連接: {subscriber} (共 {len(channel.unity.subscribers)} 個)")
+        channel.unity.send(subscriber, [channel.mode_info(subscriber),
+                                        breath_update_message(channel.state, 'breath_detection',
+                                                              channel.decision_times)])
+
+    def on_unity_disconnect(self, channel, subscriber, was_controller):
+        if not channel.unity.subscribers:
+            self.console.log(f"[{channel.name}] 等待Unity重新連線...")
+
+    def on_unity_message(self, channel, subscriber, message, received):
+        if message.get('type') == 'ping':
+            # 與模擬器相同：帶回Unity的送出時間 t0 及本機收到/送出時間 t1/t2，讓Unity估計時脈偏移
+            response = {'type': 'pong', 'timestamp': time.time()}
+            if 't0' in message:
+                response.update(id=message.get('id'), t0=message['t0'], t1=received, t2=time.monotonic())
+            channel.unity.send(subscriber, [response])
+        elif message.get('type') == 'pong':
+            # 本機送出的ping的回應：t1/t2 為Unity收到及送出的時間
+            if 't1' in message and 't2' in message:
+                subscriber.sync.complete(message['t1'], message['t2'], received, message.get('id'))
+
+    def sync_clocks(self):
+        """到期時對各感測站的 ESP32 及已連線的Unity送出時間同步 ping"""
+        now = time.monotonic()
+        for channel in self.channels:
+            if channel.syncs_esp32() and channel.esp32_sync.due(now):
+                channel.esp32_sync.begin(now)
+                try:
+                    channel.esp32_socket.sendall(TIME_REQUEST)
+                except OSError as e:
+                    self.console.log(f"⚠️ [{channel.name}] 發送時間同步失敗: {e}",
+                                     key=f'esp32_sync_error_{channel.index}', interval=5.0)
+            for subscriber in list(channel.unity.subscribers) if channel.unity else ():
+                if subscriber.sync.due(now):
+                    ping_id = subscriber.sync.begin(now)
+                    channel.unity.send(subscriber, [{'type': 'ping', 'id': ping_id, 't0': now}])
+
+    def sync_timeout(self):
+        """距離下一次時間同步的秒數，沒有需要同步的連線時為 None"""
+        now = time.monotonic()
+        timeouts = []
+        for channel in self.channels:
+            if channel.syncs_esp32():
+                timeouts.append(channel.esp32_sync.time_until_due(now))
+            if channel.unity:
+                timeouts.extend(subscriber.sync.time_until_due(now) for subscriber in channel.unity.subscribers)
+        return min(timeouts) if timeouts else None
+
+    # === 向量化判斷 ===
+    def process_hops(self):
+        """把各通道湊滿的 hop 寫入共用視窗，依序對所有有新視窗的通道一次判斷"""
+        hop = self.hop_size
+        counts = np.fromiter((c.pending.size // hop for c in self.channels), dtype=np.int64,
+                             count=len(self.channels))
+        rounds = int(counts.max()) if counts.size else 0
+        for j in range(rounds):
+            rows = np.flatnonzero(counts > j)
+            blocks = np.stack([self.channels[r].pending[j * hop:(j + 1) * hop] for r in rows])
+            self.window.push_hops(rows, blocks)
+            rows = rows[self.window.ready(rows)]
+            if rows.size:
+                # 各通道視窗最後一筆取樣的時間戳
+                window_times = [self.channels[r].pending_times[(j + 1) * hop - 1] for r in rows.tolist()]
+                self.classify(rows, window_times)
+        if rounds:
+            for channel, count in zip(self.channels, counts.tolist()):
+                if count:
+                    channel.pending = channel.pending[count * hop:]
+                    channel.pending_times = channel.pending_times[count * hop:]
+
+    def classify(self, rows, window_times):
+        """對 rows 通道的最新視窗一次判斷；window_times 為各視窗最後一筆取樣的時間戳"""
+        started = time.perf_counter()
+        windows = self.window.views(rows)
+        rms, amp, zcr = batch_features(windows)
+        if self.model:
+            low, high, _ = self.spectrum.compute_batch(windows)
+            decisions = self.model.predict_batch(feature_matrix(rms, amp, zcr, low, high))
+        else:
+            decisions = self.rules.step(rows, rms, amp, zcr)
+        self.metrics.observe('classify', time.perf_counter() - started)
+        self.metrics.count('decisions', rows.size)
+        decision_time = time.monotonic()
+        self.metrics.observe('window_to_decision', decision_time - min(window_times))
+
+        # 安靜的視窗平均值就是基準值的偏差
+        quiet = np.flatnonzero(amp < self.rules.thresholds['amp_min'])
+        if quiet.size:
+            offsets = windows[quiet].mean(axis=1)
+            elapsed = self.hop_size / self.samplerate
+            for k, offset in zip(quiet.tolist(), offsets.tolist()):
+                self.channels[rows[k]].calibration.track(offset, elapsed)
+
+        # 只有狀態改變的通道需要逐一處理
+        current = np.fromiter((BREATH_STATES.index(self.channels[r].state) for r in rows.tolist()),
+                              dtype=np.uint8, count=rows.size)
+        for k in np.flatnonzero(decisions != current).tolist():
+            channel = self.channels[rows[k]]
+            channel.set_state(BREATH_STATES[decisions[k]], (window_times[k], decision_time))
+            action = " [🌪️ 開啟氣泵]" if decisions[k] == INHALE else " [⏹️ 關閉氣泵]" if decisions[k] == EXHALE else ""
+            self.console.log(f"🎯 [{channel.name}] {channel.state:<16} | RMS={rms[k]:.4f} AMP={amp[k]:.4f} "
+                             f"ZCR={zcr[k]:.4f}{action}", key=f'state_{channel.index}', interval=0.1)
+
+    def flush(self):
+        started = time.perf_counter()
+        for channel in self.channels:
+            channel.flush()
+        self.metrics.observe('unity_send', time.perf_counter() - started)
+
+    def run(self):
+        print("🚀 多感測站呼吸檢測啟動中...")
+        if not self.setup():
+            print("❌ 沒有可用的ESP32，程式結束")
+            self.cleanup()
+            return
+        previous = self.metrics.snapshot()
+        next_stats = time.monotonic() + self.stats_interval if self.stats_interval > 0 else None
+        try:
+            # 所有ESP32都斷線時結束
+            while self.running and any(c.reader and not c.reader.closed for c in self.channels):
+                timeouts = [t for t in (self.sync_timeout(),
+                                        None if next_stats is None else max(0.0, next_stats - time.monotonic()))
+                            if t is not None]
+                for key, _ in self.selector.select(min(timeouts) if timeouts else None):
+                    key.data(key.fileobj)
+                self.sync_clocks()
+                self.process_hops()
+                self.flush()
+                if next_stats is not None and time.monotonic() >= next_stats:
+                    text, previous = self.metrics.summary(previous)
+                    self.console.log(f"📈 {text}")
+                    next_stats += self.stats_interval
+        except KeyboardInterrupt:
+            print("\n🛑 程式結束")
+        self.cleanup()
+
+    def cleanup(self):
+        self.running = False
+        for channel in self.channels:
+            channel.close()
+            if channel.calibration and channel.calibration.seeded:
+                channel.calibration.save()
+        self.console.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        if self.selector:
+            self.selector.close()
+        if self.metrics.counters:
+            print(f"\n📈 {self.metrics.summary()[0]}")
+        for channel in self.channels:
+            if channel.pump:
+                print(f"🌪️ [{channel.name}] 氣泵切換要求 {channel.pump.requests} 次，實際送出 {channel.pump.commands_sent} 次")
+        print("\n🧹 資源清理完成")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多感測站呼吸檢測（單一行程）')
+    parser.add_argument('--sensor', action='append', required=True,
+                        help='感測站 host[:esp32_port[:unity_port]]，可重複指定；未指定 Unity 埠號時由 --unity_port 起依序遞增')
+    parser.add_argument('--unity_port', type=int, default=7777, help='第一個感測站的 Unity 埠號 (預設 7777)')
+    parser.add_argument('--esp32_ascii', action='store_true', help='不協商二進位格式，強制使用 ASCII 取樣')
+    parser.add_argument('--unity_binary', action='store_true', help='breath_update 以二進位 frame 傳給 Unity')
+    parser.add_argument('--unity_max_clients', type=int, default=8, help='每個感測站同時連線的 Unity 訂閱者上限 (預設 8)')
+    parser.add_argument('--thresholds', type=str, default=None, help='呼吸判斷門檻 JSON')
+    parser.add_argument('--baseline_tau', type=float, default=10.0, help='安靜時追蹤基準值漂移的時間常數秒數 (預設 10)')
+    parser.add_argument('--calibration_cache', type=str, default=DEFAULT_CACHE_PATH,
+                        help='ADC 位元數及基準值快取檔 (設為空字串停用)')
+    parser.add_argument('--pump_min_interval', type=float, default=0.25, help='氣泵兩次切換之間的最小秒數 (預設 0.25)')
+    parser.add_argument('--metrics_port', type=int, default=None, help='在本機此埠號提供 HTTP 指標端點 /metrics')
+    parser.add_argument('--stats_interval', type=float, default=0.0, help='每隔幾秒輸出一次統計摘要')
+    parser.add_argument('--classifier', type=str, default='rules',
+                        help='判斷引擎: rules (預設) 或 breath_train.py 訓練的模型 .npz')
+    parser.add_argument('--hop_ms', type=int, default=10, help='呼吸判斷間隔毫秒數，須整除 250ms 視窗 (預設 10)')
+    args = parser.parse_args()
+
+    sensors = [parse_sensor(spec, i, default_unity_port=args.unity_port) for i, spec in enumerate(args.sensor)]
+    engine = MultiSensorEngine(sensors, hop_ms=args.hop_ms,
+                               thresholds=load_thresholds(args.thresholds) if args.thresholds else None,
+                               esp32_binary=not args.esp32_ascii, unity_binary=args.unity_binary,
+                               baseline_tau=args.baseline_tau, calibration_cache=args.calibration_cache or None,
+                               pump_min_interval=args.pump_min_interval, metrics_port=args.metrics_port,
+                               stats_interval=args.stats_interval, classifier=args.classifier,
+                               unity_max_clients=args.unity_max_clients)
+    engine.run()
+
+
+if __name__ == "__main__":
+    main()
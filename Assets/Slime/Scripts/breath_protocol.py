@@ -0,0 +1,227 @@
+import json
+import math
+import struct
+import threading
+import time
+from collections import deque
+
+# === Unity 傳輸協定 ===
+# JSON 訊息：一行一則，以 '\n' 結尾（每行一定以 '{' 開頭）
+# 二進位訊息：FRAME_MARKER + 種類(uint8) + 內容長度(uint16 LE) + 內容
+FRAME_MARKER = 0x02
+FRAME_HEADER = struct.Struct('<BBH')
+
+KIND_BREATH_UPDATE = 1
+KIND_TELEMETRY = 2
+
+# breath_update 二進位內容：狀態(uint8) + 來源(uint8) + 時間戳(float64) + 視窗時間 + 判斷時間(float64)
+# 視窗時間為觸發判斷的視窗最後一筆取樣的時間，判斷時間為判斷完成的時間，兩者都是 Python 的 time.monotonic()
+# 舊版只有前 10 位元組 (BREATH_UPDATE_V1)，解碼時兩種長度都接受
+BREATH_UPDATE = struct.Struct('<BBddd')
+BREATH_UPDATE_V1 = struct.Struct('<BBd')
+# telemetry 只有二進位格式：狀態(uint8) + RMS + AMP + ZCR (float32) + 時間戳(float64)
+# Unity 以 {"type": "telemetry_subscribe", "rate": Hz} 開啟，rate 為 0 時關閉
+TELEMETRY = struct.Struct('<Bfffd')
+TELEMETRY_MAX_RATE = 120
+BREATH_STATES = ('undecided', 'likely_INHALE', 'likely_EXHALE')
+BREATH_SOURCES = ('keyboard', 'breath_detection')
+
+# 只需要最新一則的消息種類（狀態快照），其他如 mode_setup、pong 為控制消息，依序保留
+COALESCED_TYPES = ('breath_update', 'telemetry')
+
+_json_encoder = json.JSONEncoder(separators=(',', ':'))
+_json_decoder = json.JSONDecoder()
+
+
+def breath_update_message(state, source, times=None):
+    """
+    組成 breath_update 消息（模擬器與多感測站共用，欄位一致）
+    times: 觸發的 (視窗時間, 判斷時間)，time.monotonic()；鍵盤輸入等省略時兩者都是現在
+    """
+    if times is None:
+        now = time.monotonic()
+        times = (now, now)
+    return {
+        'type': 'breath_update',
+        'state': state,
+        'source': source,
+        'timestamp': time.time(),
+        'window_time': times[0],
+        'decision_time': times[1]
+    }
+
+
+def encode_message(message, binary=False):
+    """把一則消息編碼成一個 frame（binary=True 時 breath_update 使用二進位格式；telemetry 一律為二進位）"""
+    if message.get('type') == 'telemetry':
+        return message['frame']
+    if binary and message.get('type') == 'breath_update':
+        try:
+            payload = BREATH_UPDATE.pack(BREATH_STATES.index(message['state']),
+                                         BREATH_SOURCES.index(message['source']),
+                                         message['timestamp'],
+                                         message.get('window_time', math.nan),
+                                         message.get('decision_time', math.nan))
+        except ValueError:
+            pass  # 未知的狀態或來源，改用 JSON
+        else:
+            return FRAME_HEADER.pack(FRAME_MARKER, KIND_BREATH_UPDATE, len(payload)) + payload
+    return (_json_encoder.encode(message) + '\n').encode('utf-8')
+
+
+def encode_telemetry(state, rms, amp, zcr, timestamp):
+    """直接組成 telemetry frame（不經過 dict 及 JSON）"""
+    payload = TELEMETRY.pack(state, rms, amp, zcr, timestamp)
+    return FRAME_HEADER.pack(FRAME_MARKER, KIND_TELEMETRY, len(payload)) + payload
+
+
+def encode_messages(messages, binary=False):
+    """把多則消息串成一次 sendall 的資料"""
+    return b''.join(encode_message(m, binary) for m in messages)
+
+
+def decode_binary(kind, payload):
+    """解碼二進位 frame 內容成消息 dict"""
+    if kind == KIND_BREATH_UPDATE:
+        if len(payload) == BREATH_UPDATE_V1.size:
+            state, source, timestamp = BREATH_UPDATE_V1.unpack(payload)
+            window_time = decision_time = math.nan
+        else:
+            state, source, timestamp, window_time, decision_time = BREATH_UPDATE.unpack(payload)
+        message = {
+            'type': 'breath_update',
+            'state': BREATH_STATES[state],
+            'source': BREATH_SOURCES[source],
+            'timestamp': timestamp
+        }
+        if not math.isnan(window_time):
+            message['window_time'] = window_time
+            message['decision_time'] = decision_time
+        return message
+    if kind == KIND_TELEMETRY:
+        state, rms, amp, zcr, timestamp = TELEMETRY.unpack(payload)
+        return {
+            'type': 'telemetry',
+            'state': BREATH_STATES[state],
+            'rms': rms,
+            'amp': amp,
+            'zcr': zcr,
+            'timestamp': timestamp
+        }
+    raise ValueError(f"未知的二進位消息種類: {kind}")
+
+
+class FrameDecoder:
+    """從TCP串流重組完整消息（處理黏包與拆包）"""
+
+    def __init__(self, max_buffer=65536):
+        self.max_buffer = max_buffer
+        self._buffer = bytearray()
+        self.errors = 0
+
+    def feed(self, data):
+        """加入收到的資料，回傳所有已完整的消息"""
+        self._buffer += data
+        messages = []
+        pos = 0
+        buf = self._buffer
+        while pos < len(buf):
+            if buf[pos] == FRAME_MARKER:
+                if len(buf) - pos < FRAME_HEADER.size:
+                    break
+                _, kind, length = FRAME_HEADER.unpack_from(buf, pos)
+                end = pos + FRAME_HEADER.size + length
+                if len(buf) < end:
+                    break
+                try:
+                    messages.append(decode_binary(kind, bytes(buf[pos + FRAME_HEADER.size:end])))
+                except (ValueError, IndexError, struct.error):
+                    self.errors += 1
+                pos = end
+                continue
+
+            newline = buf.find(b'\n', pos)
+            if newline < 0:
+                # 舊版Unity不送換行：嘗試解出已完整的JSON物件
+                pos = self._decode_json(buf, pos, len(buf), messages, partial=True)
+                break
+            self._decode_json(buf, pos, newline, messages)
+            pos = newline + 1
+
+        del self._buffer[:pos]
+        if len(self._buffer) > self.max_buffer:
+            # 沒有結尾的超長資料，丟棄避免無限成長
+            self.errors += 1
+            self._buffer.clear()
+        return messages
+
+    def _decode_json(self, buf, start, end, messages, partial=False):
+        """解出 [start, end) 中連續的 JSON 物件，回傳已處理到的位置"""
+        try:
+            text = buf[start:end].decode('utf-8')
+        except UnicodeDecodeError:
+            if partial:
+                return start  # 多位元組字元被切斷，等待更多資料
+            self.errors += 1
+            return end
+
+        index = 0
+        while index < len(text):
+            while index < len(text) and text[index].isspace():
+                index += 1
+            if index >= len(text):
+                break
+            try:
+                message, index = _json_decoder.raw_decode(text, index)
+            except ValueError:
+                if partial:
+                    return start + len(text[:index].encode('utf-8'))
+                self.errors += 1
+                break
+            if isinstance(message, dict):
+                messages.append(message)
+            else:
+                self.errors += 1
+        return end
+
+
+class OutboundQueue:
+    """
+    有上限的送出佇列（可跨執行緒使用）
+    COALESCED_TYPES 的消息只保留最新一則；控制消息依序保留，超過上限時捨棄最舊的並計數
+    """
+
+    def __init__(self, max_control=256, coalesced_types=COALESCED_TYPES):
+        self.coalesced_types = coalesced_types
+        self._control = deque()
+        self._max_control = max_control
+        self._latest = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0  # 被較新狀態取代的消息數
+        self.dropped = 0    # 因超過上限而捨棄的控制消息數
+
+    def put(self, message):
+        with self._lock:
+            kind = message.get('type')
+            if kind in self.coalesced_types:
+                if kind in self._latest:
+                    self.coalesced += 1
+                self._latest[kind] = message
+                return
+            if len(self._control) >= self._max_control:
+                self._control.popleft()
+                self.dropped += 1
+            self._control.append(message)
+
+    def drain(self):
+        """取出全部消息：控制消息在前，接著各種類最新的狀態"""
+        with self._lock:
+            messages = list(self._control)
+            messages.extend(self._latest.values())
+            self._control.clear()
+            self._latest.clear()
+        return messages
+
+    def qsize(self):
+        with self._lock:
+            return len(self._control) + len(self._latest)
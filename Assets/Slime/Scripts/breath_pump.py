@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import deque
+import numpy as np
+
+PUMP_ON = 's'
+PUMP_OFF = 'x'
+
+
+class PumpChannel:
+    """
+    氣泵指令通道：呼叫端只設定想要的狀態，由專用執行緒送出，慢速 Wi-Fi 寫入不會卡住判斷
+    同一段最小間隔內的多次切換只保留最後的狀態；切回原狀態則完全不送
+    send: 實際送出指令字元的函式（在通道執行緒中呼叫，可阻塞）
+    min_interval: 兩次切換之間的最小秒數
+    """
+
+    def __init__(self, send, min_interval=0.25, max_latencies=1000):
+        self.send = send
+        self.min_interval = min_interval
+
+        self.desired = False
+        self.applied = False     # 最後送出的狀態
+        self._last_toggle = -np.inf
+        self._in_flight = deque(maxlen=16)  # 已送出、等待確認的 (指令, 送出時間)；舊韌體不確認
+
+        # 統計
+        self.requests = 0
+        self.commands_sent = 0
+        self.latencies = deque(maxlen=max_latencies)  # 送出到韌體確認的秒數
+
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, turn_on):
+        """設定想要的氣泵狀態，立即返回"""
+        with self._cond:
+            if turn_on == self.desired:
+                return
+            self.desired = turn_on
+            self.requests += 1
+            self._cond.notify()
+
+    def acknowledge(self, command):
+        """韌體確認執行了指令；與最早一筆相同的未確認指令配對計算延遲"""
+        now = time.monotonic()
+        with self._cond:
+            while self._in_flight:
+                sent, sent_at = self._in_flight.popleft()
+                if sent == command:
+                    self.latencies.append(now - sent_at)
+                    return
+
+    @property
+    def in_flight(self):
+        """已送出、尚未收到確認的指令數"""
+        with self._cond:
+            return len(self._in_flight)
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """確認延遲的百分位數（秒），沒有資料時回傳 None"""
+        with self._cond:
+            if not self.latencies:
+                return None
+            return np.percentile(np.fromiter(self.latencies, dtype=np.float64), percentiles)
+
+    def close(self, timeout=1.0):
+        """立即送出最後的狀態（不受最小間隔限制）後停止執行緒"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self.desired != self.applied:
+                        wait = 0.0 if self._closing else self._last_toggle + self.min_interval - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    elif self._closing:
+                        return
+                    else:
+                        self._cond.wait()
+                turn_on = self.desired
+                command = PUMP_ON if turn_on else PUMP_OFF
+                self.applied = turn_on
+                self._last_toggle = time.monotonic()
+                self._in_flight.append((command, self._last_toggle))
+                self.commands_sent += 1
+            # 在鎖外送出，寫入期間仍可接受新的狀態
+            self.send(command)
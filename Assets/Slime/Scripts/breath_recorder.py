@@ -0,0 +1,212 @@
+import mmap
+import os
+import numpy as np
+from breath_protocol import BREATH_STATES
+
+# === 錄製檔格式 ===
+# 檔頭 (HEADER_DTYPE) + 固定大小紀錄 (RECORD_DTYPE)，只會往後追加
+# 旁邊的 .idx 檔每 INDEX_STRIDE 筆紀錄存一次 (累計最大時間戳, 紀錄編號)，供依時間快速定位
+MAGIC = b'BREATHR1'
+VERSION = 1
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('samplerate', '<u4'),
+    ('baseline', '<f8'),
+    ('adc_range', '<f8'),
+    ('start_time', '<f8'),
+    ('count', '<u8'),
+    ('reserved', 'V16'),
+])
+HEADER_SIZE = HEADER_DTYPE.itemsize
+
+RECORD_DTYPE = np.dtype([
+    ('t', '<f8'),      # 時間戳 (time.time())
+    ('kind', 'u1'),    # RECORD_*
+    ('code', 'u1'),    # 判斷結果索引 / 氣泵開關
+    ('reserved', '<u2'),
+    ('value', '<f4'),  # 正規化取樣值 / 判斷時的 RMS
+])
+RECORD_SAMPLE = 0
+RECORD_DECISION = 1
+RECORD_PUMP = 2
+
+INDEX_DTYPE = np.dtype([('t_max', '<f8'), ('record', '<u8')])
+INDEX_STRIDE = 4096
+
+
+class SessionRecorder:
+    """把原始取樣、判斷結果及氣泵指令追加寫入記憶體映射檔"""
+
+    def __init__(self, path, samplerate, start_time, grow_records=1 << 16):
+        self.path = path
+        self.grow_records = grow_records
+        self.count = 0
+        self.capacity = 0
+        self._t_max = -np.inf
+        self._mm = None
+        self._header = None
+        self._records = None
+
+        self._file = open(path, 'w+b')
+        self._index_file = open(path + '.idx', 'wb')
+        self._remap(grow_records)
+
+        header = self._header
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['samplerate'] = samplerate
+        header['adc_range'] = 1.0
+        header['start_time'] = start_time
+
+    def set_calibration(self, baseline, adc_range):
+        """記錄校正結果（取樣已正規化，僅供參考）"""
+        self._header['baseline'] = baseline
+        self._header['adc_range'] = adc_range
+
+    def record_samples(self, samples, arrival_time, samplerate, times=None):
+        """追加一批取樣；times 為每筆取樣的時間戳 (time.time())，省略時以到達時間及取樣率往回推算"""
+        n = samples.size
+        if n == 0:
+            return
+        block = self._reserve(n)
+        block['t'] = times if times is not None else arrival_time - np.arange(n - 1, -1, -1) / samplerate
+        block['kind'] = RECORD_SAMPLE
+        block['code'] = 0
+        block['value'] = samples
+        self._commit(n, arrival_time)
+
+    def record_decision(self, t, state, rms):
+        """追加一次呼吸判斷"""
+        block = self._reserve(1)
+        block['t'] = t
+        block['kind'] = RECORD_DECISION
+        block['code'] = BREATH_STATES.index(state)
+        block['value'] = rms
+        self._commit(1, t)
+
+    def record_pump(self, t, turn_on):
+        """追加一次氣泵指令"""
+        block = self._reserve(1)
+        block['t'] = t
+        block['kind'] = RECORD_PUMP
+        block['code'] = int(turn_on)
+        block['value'] = 0
+        self._commit(1, t)
+
+    def close(self):
+        """寫回並截斷到實際大小"""
+        if self._file.closed:
+            return
+        self._mm.flush()
+        self._records = None
+        self._header = None
+        self._mm.close()
+        self._file.truncate(HEADER_SIZE + self.count * RECORD_DTYPE.itemsize)
+        self._file.close()
+        self._index_file.close()
+
+    def _reserve(self, n):
+        if self.count + n > self.capacity:
+            self._remap(max(self.capacity * 2, self.count + n, self.grow_records))
+        return self._records[self.count:self.count + n]
+
+    def _commit(self, n, t_latest):
+        old = self.count
+        self.count += n
+        self._header['count'] = self.count
+        self._t_max = max(self._t_max, t_latest)
+        # 每跨過一個 INDEX_STRIDE 邊界補一筆索引
+        for boundary in range((old // INDEX_STRIDE + 1) * INDEX_STRIDE, self.count + 1, INDEX_STRIDE):
+            entry = np.array([(self._t_max, boundary)], dtype=INDEX_DTYPE)
+            self._index_file.write(entry.tobytes())
+        if self.count // INDEX_STRIDE != old // INDEX_STRIDE:
+            self._index_file.flush()
+
+    def _remap(self, capacity):
+        """擴大檔案並重新映射"""
+        if self._mm is not None:
+            self._mm.flush()
+            self._records = None
+            self._header = None
+            self._mm.close()
+        self._file.truncate(HEADER_SIZE + capacity * RECORD_DTYPE.itemsize)
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        self._header = np.frombuffer(self._mm, dtype=HEADER_DTYPE, count=1)[0]
+        self._records = np.frombuffer(self._mm, dtype=RECORD_DTYPE, count=capacity, offset=HEADER_SIZE)
+        self.capacity = capacity
+
+
+class SessionRecording:
+    """唯讀開啟錄製檔，支援依時間戳定位"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = np.frombuffer(self._mm, dtype=HEADER_DTYPE, count=1)[0]
+        if bytes(header['magic']) != MAGIC:
+            raise ValueError(f"不是呼吸錄製檔: {path}")
+        self.samplerate = int(header['samplerate'])
+        self.baseline = float(header['baseline'])
+        self.adc_range = float(header['adc_range'])
+        self.start_time = float(header['start_time'])
+
+        # 檔頭的 count 之外可能是未寫入的預留空間（程式異常結束時）
+        available = (len(self._mm) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+        count = min(int(header['count']), available)
+        self.records = np.frombuffer(self._mm, dtype=RECORD_DTYPE, count=count, offset=HEADER_SIZE)
+        self.index = self._load_index()
+
+    def __len__(self):
+        return self.records.size
+
+    @property
+    def end_time(self):
+        return float(self.records['t'].max()) if self.records.size else self.start_time
+
+    def seek(self, t):
+        """回傳第一筆時間戳 >= t 的紀錄編號"""
+        block = int(np.searchsorted(self.index['t_max'], t, side='left'))
+        start = block * INDEX_STRIDE
+        # 寫入時的索引可能略為高估，找不到就往後一個區塊繼續
+        while start < self.records.size:
+            end = min(start + INDEX_STRIDE, self.records.size)
+            later = np.flatnonzero(self.records['t'][start:end] >= t)
+            if later.size:
+                return start + int(later[0])
+            start = end
+        return self.records.size
+
+    def samples(self, start=0):
+        """回傳 start 之後的 (時間戳, 正規化取樣)"""
+        records = self.records[start:]
+        mask = records['kind'] == RECORD_SAMPLE
+        return records['t'][mask], records['value'][mask].astype(np.float64)
+
+    def decisions(self, start=0):
+        """回傳 start 之後的 (時間戳, 判斷結果索引)"""
+        records = self.records[start:]
+        mask = records['kind'] == RECORD_DECISION
+        return records['t'][mask], records['code'][mask]
+
+    def close(self):
+        self.records = None
+        self._mm.close()
+
+    def _load_index(self):
+        """讀取 .idx；不存在或不完整時由紀錄重建"""
+        expected = self.records.size // INDEX_STRIDE
+        index_path = self.path + '.idx'
+        if os.path.exists(index_path):
+            index = np.fromfile(index_path, dtype=INDEX_DTYPE)
+            if index.size >= expected:
+                return index[:expected]
+
+        t_max = np.maximum.accumulate(self.records['t']) if self.records.size else np.empty(0)
+        index = np.empty(expected, dtype=INDEX_DTYPE)
+        index['record'] = (np.arange(expected) + 1) * INDEX_STRIDE
+        index['t_max'] = t_max[index['record'] - 1]
+        return index
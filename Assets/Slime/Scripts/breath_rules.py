@@ -0,0 +1,96 @@
+import json
+import numpy as np
+from breath_protocol import BREATH_STATES
+
+# classify_nose_breath 使用的規則門檻
+DEFAULT_THRESHOLDS = {
+    'amp_min': 0.1,          # AMP 低於此值視為雜訊，清空吸氣紀錄
+    'inhale_zcr_min': 0.0,   # 吸氣需 ZCR >= 此值
+    'inhale_rms_max': 0.15,  # 吸氣需 RMS < 此值
+    'exhale_rms_min': 0.3,   # 吐氣需 RMS > 此值
+    'inhale_blocks': 3,      # 吸氣特徵需連續成立的區塊數
+}
+
+INHALE = BREATH_STATES.index('likely_INHALE')
+EXHALE = BREATH_STATES.index('likely_EXHALE')
+UNDECIDED = BREATH_STATES.index('undecided')
+
+
+def inhale_history_length(inhale_blocks, hops_per_block):
+    """連續 N 個區塊換算成重疊視窗下需要的 hop 數"""
+    return (int(inhale_blocks) - 1) * hops_per_block + 1
+
+
+def load_thresholds(path):
+    """讀取門檻 JSON（可為調參工具的輸出），未指定的項目使用預設值"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    data = data.get('thresholds', data)
+    unknown = set(data) - set(DEFAULT_THRESHOLDS)
+    if unknown:
+        raise ValueError(f"未知的門檻參數: {', '.join(sorted(unknown))}")
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    thresholds.update(data)
+    thresholds['inhale_blocks'] = int(thresholds['inhale_blocks'])
+    return thresholds
+
+
+def decide_batch(rms, amp, zcr, params, hops_per_block):
+    """
+    以向量化方式對多組門檻同時套用規則
+    rms, amp, zcr: 依時間排列的每個視窗特徵 (W,)
+    params: 各門檻的陣列 (C,)
+    回傳判斷結果索引 (C, W)，與 classify_nose_breath 逐一處理的結果相同
+    """
+    col = lambda name: np.asarray(params[name], dtype=np.float64)[:, None]
+    quiet = amp[None, :] < col('amp_min')
+    is_inhale = (zcr[None, :] >= col('inhale_zcr_min')) & (rms[None, :] < col('inhale_rms_max')) & ~quiet
+
+    # 吸氣紀錄在雜訊視窗被清空；判斷條件為「紀錄中全部成立」
+    # 等同於：目前連續成立的長度 >= min(上次清空後的視窗數, 紀錄長度)
+    index = np.arange(rms.size)
+    last_quiet = np.maximum.accumulate(np.where(quiet, index, -1), axis=1)
+    last_not_inhale = np.maximum.accumulate(np.where(~is_inhale, index, -1), axis=1)
+    since_reset = index - last_quiet
+    streak = index - last_not_inhale
+    history = np.asarray([inhale_history_length(b, hops_per_block) for b in np.ravel(params['inhale_blocks'])])
+    inhale = is_inhale & (streak >= np.minimum(since_reset, history[:, None]))
+
+    decisions = np.full(quiet.shape, UNDECIDED, dtype=np.uint8)
+    decisions[~quiet & ~inhale & (rms[None, :] > col('exhale_rms_min'))] = EXHALE
+    decisions[inhale] = INHALE
+    return decisions
+
+
+class StreamingRules:
+    """
+    多通道逐步套用規則：每個通道只保留連續吸氣長度及上次清空後的視窗數，不需要 deque
+    與 classify_nose_breath（及 decide_batch）的判斷結果相同
+    """
+
+    def __init__(self, channels, thresholds=None, hops_per_block=1):
+        self.thresholds = dict(thresholds or DEFAULT_THRESHOLDS)
+        self.history = inhale_history_length(self.thresholds['inhale_blocks'], hops_per_block)
+        self.streak = np.zeros(channels, dtype=np.int64)
+        self.since_reset = np.zeros(channels, dtype=np.int64)
+
+    def step(self, rows, rms, amp, zcr):
+        """
+        rows: 這次有新視窗的通道編號 (K,)
+        rms, amp, zcr: 對應的特徵 (K,)
+        回傳判斷結果索引 (K,)
+        """
+        t = self.thresholds
+        quiet = amp < t['amp_min']
+        is_inhale = (zcr >= t['inhale_zcr_min']) & (rms < t['inhale_rms_max']) & ~quiet
+
+        since_reset = np.where(quiet, 0, self.since_reset[rows] + 1)
+        streak = np.where(is_inhale, self.streak[rows] + 1, 0)
+        self.since_reset[rows] = since_reset
+        self.streak[rows] = streak
+
+        inhale = is_inhale & (streak >= np.minimum(since_reset, self.history))
+        decisions = np.full(rows.size, UNDECIDED, dtype=np.uint8)
+        decisions[~quiet & ~inhale & (rms > t['exhale_rms_min'])] = EXHALE
+        decisions[inhale] = INHALE
+        return decisions
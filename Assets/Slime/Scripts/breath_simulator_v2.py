@@ -1,67 +1,192 @@
+import math
+import os
+import signal
 import socket
+import selectors
+import sys
 import threading
 import time
-import json
 import argparse
-from pynput import keyboard
-import queue
 import numpy as np
 import ipaddress
+from breath_ingest import TIME_REQUEST, open_adc_reader
+from breath_window import SlidingWindow, hop_samples
+from breath_protocol import (BREATH_STATES, TELEMETRY_MAX_RATE, OutboundQueue, breath_update_message, encode_messages,
+                             encode_telemetry)
+from breath_recorder import RECORD_SAMPLE, SessionRecorder, SessionRecording
+from breath_spectrum import band_energy
+from breath_rules import DEFAULT_THRESHOLDS, load_thresholds
+from breath_classifier import DECISION_BUDGET_US, Classification, create_classifier
+from breath_baseline import DEFAULT_CACHE_PATH, AdaptiveBaseline
+from breath_pump import PUMP_OFF, PUMP_ON, PumpChannel
+from breath_metrics import ConsoleLog, Metrics, MetricsServer
+from breath_clock import ClockSync, SampleClock
+from breath_fanout import UnityHub
+
+# 各模式啟動完成前需要就緒的項目
+READINESS = {
+    'breath_control': ('unity_listening', 'keyboard'),
+    'unity_control': ('unity_listening', 'esp32_connected'),
+    'breath_detection': ('unity_listening', 'esp32_connected', 'first_decision'),
+    'replay': (),
+}
+
+
+def notify_supervisor(state):
+    """systemd sd_notify (Type=notify)；沒有 NOTIFY_SOCKET 時不做任何事"""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        address = '\0' + address[1:]  # 抽象命名空間
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+    except OSError:
+        pass
+
 
 class BreathSimulatorV2:
-    def __init__(self, mode='breath_control', esp32_host=None, esp32_port=8080, unity_port=7777):
+    def __init__(self, mode='breath_control', esp32_host=None, esp32_port=8080, unity_port=7777, hop_ms=10,
+                 unity_binary=False, esp32_binary=True, record_path=None, replay_file=None,
+                 replay_speed=0.0, replay_seek=0.0, thresholds=None, baseline_tau=10.0,
+                 calibration_cache=DEFAULT_CACHE_PATH, pump_min_interval=0.25, metrics_port=None,
+                 stats_interval=0.0, classifier='rules', dsp_process=False, headless=False, unity_max_clients=8):
         """
         初始化呼吸模擬器
         mode: 'breath_control' (Python主導) 或 'unity_control' (Unity主導) 或 'breath_detection' (真實呼吸檢測)
+              或 'replay' (重播錄製檔)
         esp32_host: ESP32 的 IP 位址 (可選)
         esp32_port: ESP32 的埠號 (可選，預設 8080)
         unity_port: Unity 的埠號 (可選，預設 7777)
+        hop_ms: 每次呼吸判斷的間隔毫秒數 (預設 10ms，等於視窗長度時即為不重疊區塊；不能整除視窗時取最接近的間隔)
+        unity_binary: breath_update 是否以二進位 frame 傳給Unity (可選，預設 JSON)
+        esp32_binary: 連線時是否嘗試協商ESP32二進位取樣格式 (可選，舊韌體自動退回 ASCII)
+        record_path: 錄製取樣、判斷及氣泵指令的檔案路徑 (可選)
+        replay_file: replay 模式要重播的錄製檔
+        replay_speed: 重播速度倍率 (0 = 盡快處理)
+        replay_seek: 從錄製開始後第幾秒開始重播
+        thresholds: 呼吸判斷規則門檻 (可選，預設 DEFAULT_THRESHOLDS)
+        baseline_tau: 安靜時追蹤基準值漂移的時間常數秒數 (可選，預設 10)
+        calibration_cache: ADC 位元數及基準值的快取檔 (可選，None 表示不快取)
+        pump_min_interval: 氣泵兩次切換之間的最小秒數 (可選，預設 0.25)
+        metrics_port: 本機 HTTP 指標端點的埠號 (可選，None 表示不啟動)
+        stats_interval: 定期輸出統計摘要的秒數 (可選，0 表示不輸出)
+        classifier: 'rules' 為規則判斷 (預設)，或 breath_train.py 訓練的模型 .npz 路徑
+        dsp_process: breath_detection 模式下在獨立行程接收取樣及判斷 (可選，主行程只負責Unity及氣泵I/O)
+        headless: 無人值守的服務模式：不使用鍵盤及狀態列，SIGTERM 正常結束，ESP32 斷線時以非零狀態碼結束
+        unity_max_clients: 同時連線的Unity訂閱者上限 (可選，預設 8；最早連線的為控制端)
         """
-        self.mode = mode  # 'breath_control', 'unity_control', 或 'breath_detection'
+        self.mode = mode  # 'breath_control', 'unity_control', 'breath_detection', 或 'replay'
         
         # 呼吸狀態
         self.current_breath_state = 'undecided'
         self.unity_character_state = 'normal'  # Unity角色狀態：'normal', 'enlarged', 'shrunken'
         
-        # TCP設定 - 與Unity通訊
+        # TCP設定 - 與Unity通訊（可同時有多個訂閱者，廣播只序列化一次）
         self.unity_host = 'localhost'
         self.unity_port = unity_port
-        self.unity_socket = None
-        self.unity_client = None
+        self.unity_binary = unity_binary
+        self.unity_max_clients = unity_max_clients
+        self.unity = None  # UnityHub
         
         # ESP32真實設定
         self.esp32_host = esp32_host
         self.esp32_port = esp32_port
         self.esp32_socket = None
+        self.esp32_reader = None
+        self.esp32_binary = esp32_binary
+        self.dsp_process = dsp_process
+        self.dsp = None  # 獨立的取樣/判斷行程 (DspProcess)
+        
+        # 廣播消息隊列：有上限，breath_update 只保留最新一則
+        self.message_queue = OutboundQueue()
         
-        # 消息隊列
-        self.message_queue = queue.Queue()
+        # 事件迴圈：統一管理ESP32、Unity監聽及Unity客戶端socket
+        self.selector = None
+        self._wake_reader = None
+        self._wake_writer = None
+        self._last_status = None
         
         # 狀態標記
         self.running = True
+        self.headless = headless
+        self.exit_code = 0
+        self.keyboard = None  # breath_control 模式才載入 pynput
         
-        # 氣泵狀態
+        # 就緒事件：取代固定的等待時間，全部就緒後通知程序管理員
+        self.readiness = {name: threading.Event() for name in READINESS[mode]}
+        self.startup = time.perf_counter()
+        self.ready_after = None
+        self.first_decision_after = None
+        
+        # 氣泵狀態（想要的狀態；實際送出由 PumpChannel 在背景合併處理）
         self.pump_is_on = False
+        self.pump = None
+        self.pump_min_interval = pump_min_interval
         
         # 呼吸檢測相關參數
         self.samplerate = 500
         self.block_duration = 0.25
         self.block_size = int(self.samplerate * self.block_duration)
-        self.baseline = 0
-        self.adc_range = 4095
-        self.buffer = []
-        self.data_buffer = ""
+        self.hop_size = hop_samples(self.samplerate, self.block_size, hop_ms)
+        self.calibration_samples = 200
+        self.calibration = None  # 開始接收後由 start_calibration 建立
+        self.baseline_tau = baseline_tau
+        self.calibration_cache = calibration_cache
+        self.window = SlidingWindow(self.block_size, self.hop_size)
         self.rms_history = []
-        self.inhale_history = []
+        self.thresholds = dict(thresholds or DEFAULT_THRESHOLDS)
+        self.hops_per_block = self.block_size // self.hop_size
+        # 判斷引擎：規則 (預設) 或離線訓練的模型；安靜視窗的判斷仍使用門檻的 amp_min
+        self.classifier_spec = classifier
+        self.classifier = create_classifier(classifier, self.thresholds, self.hops_per_block)
+        self.hop_count = 0
+        
+        # 時間戳：取樣時間由到達時間及取樣率重建 (time.monotonic())，每次判斷記錄觸發的視窗時間及判斷時間
+        self.sample_clock = SampleClock(self.samplerate)
+        self._lost_seen = 0
+        self.decision_times = None  # 最近一次判斷的 (視窗時間, 判斷時間)
+        # 時脈同步：與 ESP32 及每個Unity訂閱者以 ping/pong 估計時脈偏移及來回時間
+        self.esp32_sync = ClockSync()
+        
+        # 連續遙測（各Unity訂閱者以自己的頻率收到最新特徵，沒有變化則略過）
+        self.latest_features = None   # (狀態索引, rms, amp, zcr)
+        
+        # 指標與日誌：熱路徑只記錄數值，輸出由背景執行緒負責
+        self.metrics = Metrics()
+        self.console = ConsoleLog()
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.stats_interval = stats_interval
+        
+        # 錄製與重播
+        self.record_path = record_path
+        self.recorder = None
+        self.replay_file = replay_file
+        self.replay_speed = replay_speed
+        self.replay_seek = replay_seek
         
         print(f"🎮 啟動模式: {self._get_mode_description()}")
+        if self.mode in ['breath_detection', 'replay']:
+            if self.hop_size * 1000 != hop_ms * self.samplerate:
+                print(f"⚠️ 判斷間隔 {hop_ms}ms 無法整除 {self.block_size} 筆的視窗，改用最接近的間隔")
+            print(f"📐 分析視窗 {self.block_size} 筆，每 {self.hop_size} 筆 "
+                  f"({self.hop_size * 1000 / self.samplerate:.0f}ms) 判斷一次")
+            print(f"🧠 判斷引擎: {self.classifier.name}")
+            model_hop = self.classifier.hop_ms
+            if model_hop is not None and hop_samples(self.samplerate, self.block_size, model_hop) != self.hop_size:
+                print(f"⚠️ 模型以 {model_hop}ms 判斷間隔訓練，與目前的 "
+                      f"{self.hop_size * 1000 / self.samplerate:.0f}ms 不同，判斷結果可能不準確")
         
     def _get_mode_description(self):
         """取得模式描述"""
         descriptions = {
             'breath_control': 'Python呼吸控制',
             'unity_control': 'Unity角色控制(真實ESP32)',
-            'breath_detection': '真實呼吸檢測'
+            'breath_detection': '真實呼吸檢測',
+            'replay': '錄製檔重播'
         }
         return descriptions.get(self.mode, '未知模式')
 
@@ -83,54 +208,60 @@ class BreathSimulatorV2:
             self.esp32_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.esp32_socket.connect((self.esp32_host, self.esp32_port))
             self.esp32_socket.settimeout(1.0)
-            print(f"✅ ESP32連接成功: {self.esp32_host}:{self.esp32_port}")
+            if self.dsp_process and self.mode == 'breath_detection':
+                # 取樣格式協商、接收及判斷都在 DSP 行程；主行程保留同一個 socket 發送氣泵指令
+                from breath_dsp import DspProcess
+                self.dsp = DspProcess(self.esp32_socket, self.esp32_binary, self.dsp_config(),
+                                      record_samples=self.recorder is not None)
+                self.esp32_reader = self.dsp
+                print(f"✅ ESP32連接成功: {self.esp32_host}:{self.esp32_port} (DSP 行程 pid={self.dsp.process.pid})")
+            else:
+                self.esp32_reader = open_adc_reader(self.esp32_socket, binary=self.esp32_binary)
+                print(f"✅ ESP32連接成功: {self.esp32_host}:{self.esp32_port} (取樣格式: {self.esp32_reader.format})")
+            self.mark_ready('esp32_connected')
             return True
         except Exception as e:
             print(f"❌ ESP32連接失敗: {e}")
             return False
 
-    def calibrate_baseline(self):
-        """校正基準值"""
-        if self.mode != 'breath_detection' or not self.esp32_socket:
+    def dsp_config(self):
+        """DSP 行程的判斷參數（可序列化的基本型別）"""
+        return {'samplerate': self.samplerate, 'block_size': self.block_size, 'hop_size': self.hop_size,
+                'hops_per_block': self.hops_per_block, 'classifier': self.classifier_spec,
+                'thresholds': self.thresholds, 'calibration_samples': self.calibration_samples,
+                'baseline_tau': self.baseline_tau, 'calibration_cache': self.calibration_cache,
+                'device': f"{self.esp32_host}:{self.esp32_port}"}
+
+    def start_calibration(self):
+        """開始校正基準值；校正與判斷同時在事件迴圈中進行，不阻塞啟動"""
+        if self.mode != 'breath_detection' or not self.esp32_socket or self.dsp:
             return
-            
-        print("⏳ 校正中，請保持安靜...")
-        baseline_samples = []
         
-        while len(baseline_samples) < 200:
-            try:
-                data = self.esp32_socket.recv(1024).decode('utf-8')
-                if data:
-                    self.data_buffer += data
-                    lines = self.data_buffer.split('\n')
-                    self.data_buffer = lines[-1]
-                    
-                    for line in lines[:-1]:
-                        try:
-                            val = int(line.strip())
-                            baseline_samples.append(val)
-                            if len(baseline_samples) % 50 == 0:
-                                print(f"📊 校正進度: {len(baseline_samples)}/200")
-                        except:
-                            continue
-            except socket.timeout:
-                continue
-            except Exception as e:
-                print(f"❌ 校正錯誤: {e}")
-                break
+        self.calibration = AdaptiveBaseline(self.calibration_samples, self.baseline_tau,
+                                            self.calibration_cache, f"{self.esp32_host}:{self.esp32_port}")
+        if self.calibration.cached:
+            print(f"⚡ 使用快取基準值：{self.calibration.baseline:.2f}，ADC 範圍：0–{self.calibration.adc_range}"
+                  f"（背景重新校正中）")
+        else:
+            print("⏳ 校正中，請保持安靜...")
+        self._next_calibration_report = 50
+    
+    def update_calibration(self, values):
+        """把原始值送入校正，回傳正規化後的取樣（校正完成前可能為空）"""
+        calibration = self.calibration
+        if calibration.seeded:
+            return calibration.normalize(values)
         
-        if baseline_samples:
-            self.baseline = np.mean(baseline_samples)
-            adc_min = min(baseline_samples)
-            adc_max = max(baseline_samples)
-            
-            # 判斷是否為 10-bit 或 12-bit
-            if adc_max > 2048:
-                self.adc_range = 4095
-            else:
-                self.adc_range = 1023
-            
-            print(f"✅ 基準值：{self.baseline:.2f}，ADC 範圍：0–{self.adc_range}")
+        normalized = calibration.feed(values)
+        while calibration.count >= self._next_calibration_report and self._next_calibration_report <= self.calibration_samples:
+            if not calibration.cached:
+                print(f"📊 校正進度: {self._next_calibration_report}/{self.calibration_samples}")
+            self._next_calibration_report += 50
+        if calibration.seeded:
+            print(f"✅ 基準值：{calibration.baseline:.2f}，ADC 範圍：0–{calibration.adc_range}")
+            if self.recorder:
+                self.recorder.set_calibration(calibration.baseline, calibration.adc_range)
+        return normalized
 
     # === 呼吸檢測算法 ===
     def breath_strength(self, amp):
@@ -144,166 +275,429 @@ class BreathSimulatorV2:
         else:
             return "🚨 超強"
 
-    def classify_nose_breath(self, signal):
-        """分類鼻腔呼吸"""
+    def classify_nose_breath(self, signal, features=None):
+        """分類鼻腔呼吸（features 為 SlidingWindow 增量計算的 (rms, amp, zcr)，省略時直接計算）"""
         # === 特徵計算 ===
-        zcr = np.mean(np.diff(np.sign(signal)) != 0)
-        amp = np.max(np.abs(signal))
-        rms = np.sqrt(np.mean(signal ** 2))
-
-        # === 雜訊過濾條件（AMP 太低就略過）===
-        if amp < 0.1:
-            self.inhale_history = []
-            return 'undecided', rms, amp, zcr, 0, 0, 0
-
-        # === 吸氣條件：ZCR 在 0.4~0.55 且 RMS < 0.15 ===
-        is_inhale = (0. <= zcr) and (rms < 0.15)
-
-        # 吸氣狀態追蹤（持續記錄近 3 次）
-        self.inhale_history.append(is_inhale)
-        if len(self.inhale_history) > 3:
-            self.inhale_history.pop(0)
-
-        # === 判斷邏輯 ===
-        if all(self.inhale_history):  # 連續吸氣特徵成立
-            decision = 'likely_INHALE'
-        elif rms > 0.3:          # 吹氣只看 RMS > 0.3
-            decision = 'likely_EXHALE'
+        if features is None:
+            zcr = np.mean(np.diff(np.sign(signal)) != 0)
+            amp = np.max(np.abs(signal))
+            rms = np.sqrt(np.mean(signal ** 2))
+        else:
+            rms, amp, zcr = features
+        # 頻帶能量（窗函數與頻率遮罩依 block_size/samplerate 快取）；判斷引擎用不到時略過 FFT
+        if self.classifier.uses_spectrum:
+            low_energy, high_energy, total_energy = band_energy(len(signal), self.samplerate).compute(signal)
         else:
-            decision = 'undecided'
+            low_energy = high_energy = total_energy = math.nan
 
-        return decision, rms, amp, zcr, 0, 0, 0
+        decision = self.classifier.classify(rms, amp, zcr, low_energy, high_energy)
+        return Classification(decision, rms, amp, zcr, low_energy, high_energy, total_energy)
 
     def process_breath_detection(self):
         """處理呼吸檢測"""
         if self.mode != 'breath_detection' or not self.esp32_socket:
             return
             
+        metrics = self.metrics
+        reader = self.esp32_reader
         try:
-            data = self.esp32_socket.recv(1024).decode('utf-8')
-            if data:
-                self.data_buffer += data
-                lines = self.data_buffer.split('\n')
-                self.data_buffer = lines[-1]
-                
-                for line in lines[:-1]:
-                    try:
-                        val = int(line.strip())
-                        # 正規化
-                        norm_val = (val - self.baseline) / self.adc_range
-                        norm_val = max(min(norm_val, 1.0), -1.0)
-                        self.buffer.append(norm_val)
-                    except:
-                        continue
+            started = time.perf_counter()
+            n = reader.recv()
+            arrival = time.monotonic()
+            parsed = time.perf_counter()
+            metrics.observe('recv', parsed - started)
+            if n == 0:
+                return
+            values = reader.feed(n)
+            metrics.observe('parse', time.perf_counter() - parsed)
+            self.complete_esp32_sync(arrival)
+            if values.size:
+                metrics.count('samples', values.size)
+                # 每筆取樣的時間戳；掉包的取樣也佔用時間
+                lost = getattr(reader, 'lost_samples', 0)
+                stamps = self.sample_clock.stamp(values.size, arrival, lost - self._lost_seen)
+                self._lost_seen = lost
+                metrics.observe('sample_buffering', self.sample_clock.delay)
+                # 正規化（整塊向量化）；初始校正期間沒有快取時不做判斷，回傳的是最後 norm.size 筆
+                norm = self.update_calibration(values)
+                stamps = stamps[stamps.size - norm.size:]
+                if norm.size and self.recorder:
+                    self.recorder.record_samples(norm, time.time(), self.samplerate,
+                                                 stamps + (time.time() - time.monotonic()))
+                # 每湊滿一個 hop 就對最新視窗做一次判斷
+                base = self.window.count
+                for features in self.window.push(norm):
+                    self.process_breath_window(self.window.view(), features, stamps[self.window.count - base - 1])
         except socket.timeout:
             pass
         except Exception as e:
-            print(f"❌ 接收數據錯誤: {e}")
+            self.console.log(f"❌ 接收數據錯誤: {e}", key='recv_error', interval=1.0)
 
-        # 如果緩衝區有足夠的數据，進行分析
-        if len(self.buffer) >= self.block_size:
-            signal = np.array(self.buffer[:self.block_size])
-            self.buffer = self.buffer[self.block_size:]
+    def process_breath_window(self, signal, features=None, window_time=None):
+        """對一個分析視窗做呼吸判斷、通知Unity並控制氣泵（window_time 為視窗最後一筆取樣的時間戳）"""
+        started = time.perf_counter()
+        result = self.classify_nose_breath(signal, features)
+        # 安靜的視窗平均值就是基準值的偏差，用來追蹤漂移
+        if self.calibration and result.amp < self.thresholds['amp_min']:
+            self.calibration.track(float(np.mean(signal)), self.hop_size / self.samplerate)
+        self.apply_decision(result, time.perf_counter() - started, time.time(), window_time)
 
-            old_state = self.current_breath_state
-            self.current_breath_state, rms, max_amp, zcr, low_energy, high_energy, total_energy = self.classify_nose_breath(signal)
-            strength = self.breath_strength(max_amp)
+    def apply_decision(self, result, elapsed, timestamp, window_time=None, decision_time=None):
+        """
+        套用一次判斷結果：通知Unity、控制氣泵及輸出日誌
+        result: Classification
+        elapsed: 判斷耗時 (秒)
+        timestamp: 判斷時間 (time.time())
+        window_time: 觸發判斷的視窗最後一筆取樣時間 (time.monotonic()，可選，省略時視為判斷時間)
+        decision_time: 判斷完成時間 (time.monotonic()，可選，DSP 行程會帶入自己的判斷時間)
+        """
+        if decision_time is None:
+            decision_time = time.monotonic()
+        if window_time is None:
+            window_time = decision_time
+        else:
+            self.metrics.observe('window_to_decision', decision_time - window_time)
+        self.decision_times = (window_time, decision_time)
+        old_state = self.current_breath_state
+        self.current_breath_state, rms, max_amp, zcr, low_energy, high_energy, total_energy = result
+        self.metrics.observe('classify', elapsed)
+        if elapsed * 1e6 > DECISION_BUDGET_US:
+            self.metrics.count('classify_over_budget')
+        self.metrics.count('decisions')
+        self.hop_count += 1
+        if self.first_decision_after is None:
+            self.first_decision_after = time.perf_counter() - self.startup
+            self.console.log(f"⏱️ 啟動 → 第一次判斷 {self.first_decision_after * 1000:.0f}ms")
+            self.mark_ready('first_decision')
+        self.latest_features = (BREATH_STATES.index(self.current_breath_state), rms, max_amp, zcr)
+        if self.recorder:
+            self.recorder.record_decision(timestamp, self.current_breath_state, rms)
 
-            # 如果狀態改變，發送給Unity
-            if old_state != self.current_breath_state:
-                self.send_to_unity(self.current_breath_state, 'breath_detection')
+        # 如果狀態改變，發送給Unity
+        if old_state != self.current_breath_state:
+            self.send_to_unity(self.current_breath_state, 'breath_detection', self.decision_times)
 
-            # 控制氣泵
-            command_sent = ""
-            if self.current_breath_state == 'likely_INHALE':
-                if not self.pump_is_on:
-                    self.control_pump(True)
-                    command_sent = " [🌪️ 開啟氣泵]"
-                else:
-                    command_sent = " [🌪️ 氣泵保持開啟]"
-            elif self.current_breath_state == 'likely_EXHALE':
-                if self.pump_is_on:
-                    self.control_pump(False)
-                    command_sent = " [⏹️ 關閉氣泵]"
-                else:
-                    command_sent = " [⏹️ 氣泵保持關閉]"
-            elif self.current_breath_state == 'undecided':
-                if self.pump_is_on:
-                    command_sent = " [🌪️ 氣泵保持開啟]"
-                else:
-                    command_sent = " [⏹️ 氣泵保持關閉]"
+        # 控制氣泵
+        command_sent = ""
+        if self.current_breath_state == 'likely_INHALE':
+            if not self.pump_is_on:
+                self.control_pump(True)
+                command_sent = " [🌪️ 開啟氣泵]"
+            else:
+                command_sent = " [🌪️ 氣泵保持開啟]"
+        elif self.current_breath_state == 'likely_EXHALE':
+            if self.pump_is_on:
+                self.control_pump(False)
+                command_sent = " [⏹️ 關閉氣泵]"
+            else:
+                command_sent = " [⏹️ 氣泵保持關閉]"
+        elif self.current_breath_state == 'undecided':
+            if self.pump_is_on:
+                command_sent = " [🌪️ 氣泵保持開啟]"
+            else:
+                command_sent = " [⏹️ 氣泵保持關閉]"
 
-            print(f"🎯 {self.current_breath_state:<16} | RMS={rms:.4f} AMP={max_amp:.4f} ZCR={zcr:.4f} | "
-                  f"Low={low_energy:.2f} High={high_energy:.2f} Total={total_energy:.2f} | {strength}{command_sent}")
+        # 狀態改變時或每個區塊長度輸出一次，避免 hop 頻率下洗版；實際輸出由背景執行緒處理
+        changed = old_state != self.current_breath_state
+        if changed or self.hop_count % self.hops_per_block == 0:
+            bands = "" if math.isnan(low_energy) else \
+                f"Low={low_energy:.2f} High={high_energy:.2f} Total={total_energy:.2f} | "
+            self.console.log(f"🎯 {self.current_breath_state:<16} | RMS={rms:.4f} AMP={max_amp:.4f} ZCR={zcr:.4f} | "
+                             f"{bands}{self.breath_strength(max_amp)}{command_sent}",
+                             key='state' if changed else 'decision', interval=0.1 if changed else self.block_duration)
 
     def start_unity_server(self):
-        """啟動TCP伺服器等待Unity連接"""
+        """啟動TCP伺服器監聽Unity連接（由事件迴圈負責accept，可同時有多個訂閱者）"""
+        self.unity = UnityHub(self.unity_host, self.unity_port, self.unity_binary, self.unity_max_clients,
+                              on_connect=self.on_unity_connect, on_message=self.on_unity_message,
+                              on_disconnect=self.on_unity_disconnect, log=self.console.log)
         try:
-            self.unity_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.unity_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.unity_socket.bind((self.unity_host, self.unity_port))
-            self.unity_socket.listen(1)
-            print(f"🌐 等待Unity連接於 {self.unity_host}:{self.unity_port}")
-            
-            self.unity_client, addr = self.unity_socket.accept()
-            print(f"✅ Unity已連接: {addr}")
-            
-            # 發送模式資訊給Unity
-            self.send_mode_info()
-            
-            # 啟動Unity通訊線程
-            unity_thread = threading.Thread(target=self.handle_unity_communication, daemon=True)
-            unity_thread.start()
-            
+            self.unity.listen()
+            print(f"🌐 等待Unity連接於 {self.unity_host}:{self.unity_port} (最多 {self.unity_max_clients} 個訂閱者)")
+            self.mark_ready('unity_listening')
+            return True
         except Exception as e:
             print(f"❌ Unity伺服器啟動失敗: {e}")
+            self.unity = None
+            return False
     
-    def send_mode_info(self):
-        """發送模式資訊給Unity"""
-        message = {
-            'type': 'mode_setup',
-            'mode': self.mode,
-            'description': self._get_mode_description()
-        }
-        self.message_queue.put(message)
+    def setup_event_loop(self):
+        """建立事件迴圈並註冊所有socket"""
+        self.selector = selectors.DefaultSelector()
+        
+        # 其他線程（鍵盤監聽）放入消息時，透過這組socket喚醒事件迴圈
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self.selector.register(self._wake_reader, selectors.EVENT_READ, self.on_wakeup)
+        
+        if self.dsp:
+            self.selector.register(self.dsp.doorbell, selectors.EVENT_READ, self.on_dsp_ready)
+        elif self.esp32_socket:
+            self.selector.register(self.esp32_socket, selectors.EVENT_READ, self.on_esp32_readable)
+        if self.unity:
+            self.unity.attach(self.selector)
     
-    def handle_unity_communication(self):
-        """處理與Unity的雙向通訊"""
+    def start_metrics(self):
+        """註冊佇列深度等即時指標，依設定啟動 HTTP 端點及定期摘要"""
+        reader_stat = lambda name: lambda: getattr(self.esp32_reader, name, 0)
+        self.metrics.gauge('unity_queue_depth', self.message_queue.qsize)
+        self.metrics.gauge('unity_coalesced', lambda: self.message_queue.coalesced)
+        self.metrics.gauge('unity_dropped', lambda: self.message_queue.dropped)
+        self.metrics.gauge('console_queue_depth', self.console.depth)
+        self.metrics.gauge('console_suppressed', lambda: self.console.suppressed)
+        self.metrics.gauge('console_dropped', lambda: self.console.dropped)
+        self.metrics.gauge('malformed_samples', reader_stat('malformed_samples'))
+        self.metrics.gauge('lost_samples', reader_stat('lost_samples'))
+        self.metrics.gauge('pump_in_flight', lambda: self.pump.in_flight if self.pump else 0)
+        self.metrics.gauge('pump_commands_sent', lambda: self.pump.commands_sent if self.pump else 0)
+        self.metrics.gauge('pump_on', lambda: int(self.pump_is_on))
+        milliseconds = lambda read: lambda: None if read() is None else round(read() * 1000, 3)
+        self.metrics.gauge('esp32_clock_offset_ms', milliseconds(lambda: self.esp32_clock()[0]))
+        self.metrics.gauge('esp32_rtt_ms', milliseconds(lambda: self.esp32_clock()[1]))
+        self.metrics.gauge('unity_clock_offset_ms', milliseconds(lambda: self.unity_controller_sync().offset))
+        self.metrics.gauge('unity_rtt_ms', milliseconds(lambda: self.unity_controller_sync().rtt))
+        self.metrics.gauge('unity_clients', lambda: len(self.unity.subscribers) if self.unity else 0)
+        self.metrics.gauge('unity_pending_bytes', lambda: self.unity.pending_bytes() if self.unity else 0)
+        self.metrics.gauge('unity_slow_dropped', lambda: self.unity.slow_dropped if self.unity else 0)
+        self.metrics.gauge('unity_rejected', lambda: self.unity.rejected if self.unity else 0)
+        if self.mode == 'breath_detection':
+            self.metrics.gauge('sample_rate_hz', lambda: round(self.dsp.sample_rate if self.dsp else self.sample_clock.rate, 2))
+        if self.mode in ['breath_detection', 'replay']:
+            self.metrics.gauge('time_to_first_decision_seconds',
+                               lambda: None if self.first_decision_after is None else round(self.first_decision_after, 4))
+        
+        if self.metrics_port is not None:
+            try:
+                self.metrics_server = MetricsServer(self.metrics, port=self.metrics_port)
+                self.metrics_server.start()
+                host, port = self.metrics_server.address
+                print(f"📈 指標端點: http://{host}:{port}/metrics")
+            except OSError as e:
+                print(f"⚠️ 指標端點啟動失敗: {e}")
+        if self.stats_interval > 0:
+            threading.Thread(target=self.stats_loop, daemon=True).start()
+    
+    def stats_loop(self):
+        """定期把統計摘要交給背景日誌輸出"""
+        previous = self.metrics.snapshot()
         while self.running:
+            time.sleep(self.stats_interval)
+            text, previous = self.metrics.summary(previous)
+            self.console.log(f"\n📈 {text}")
+    
+    def wake(self):
+        """喚醒事件迴圈"""
+        if self._wake_writer:
             try:
-                # 接收Unity資料
-                if self.unity_client:
-                    self.unity_client.settimeout(0.1)
-                    try:
-                        data = self.unity_client.recv(1024)
-                        if data:
-                            message = json.loads(data.decode('utf-8'))
-                            self.handle_unity_message(message)
-                    except socket.timeout:
-                        pass
-                    except Exception as e:
-                        print(f"⚠️ 接收Unity資料錯誤: {e}")
-                
-                # 發送資料給Unity
-                if not self.message_queue.empty():
-                    message = self.message_queue.get()
-                    if self.unity_client:
-                        try:
-                            self.unity_client.send(json.dumps(message).encode('utf-8'))
-                        except Exception as e:
-                            print(f"⚠️ 發送資料給Unity失敗: {e}")
-                
-                time.sleep(0.01)  # 避免CPU過載
-                
-            except Exception as e:
-                print(f"❌ Unity通訊錯誤: {e}")
-                break
+                self._wake_writer.send(b'\0')
+            except OSError:
+                pass  # 喚醒位元組已經在排隊中
+    
+    def stop(self):
+        """要求事件迴圈結束"""
+        self.running = False
+        self.wake()
+    
+    def mark_ready(self, name):
+        """標記一個就緒項目；全部就緒時記錄啟動耗時並通知程序管理員"""
+        event = self.readiness.get(name)
+        if event is None or event.is_set():
+            return
+        event.set()
+        if self.ready_after is None and all(e.is_set() for e in self.readiness.values()):
+            self.ready_after = time.perf_counter() - self.startup
+            self.console.log(f"✅ 服務就緒 ({self.ready_after * 1000:.0f}ms)")
+            notify_supervisor('READY=1')
     
-    def handle_unity_message(self, message):
-        """處理Unity傳來的消息"""
-        if self.mode == 'unity_control':
+    def wait_ready(self, timeout=None):
+        """等待所有就緒項目（供嵌入或測試使用），回傳是否全部就緒"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for event in self.readiness.values():
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not event.wait(remaining):
+                return False
+        return True
+    
+    def handle_signal(self, signum, frame):
+        """SIGTERM/SIGHUP：與 Ctrl+C 相同，正常關閉氣泵並清理"""
+        self.console.log(f"\n🛑 收到訊號 {signal.Signals(signum).name}，程式結束")
+        self.stop()
+    
+    def on_wakeup(self, sock):
+        """清空喚醒socket"""
+        try:
+            while sock.recv(4096):
+                pass
+        except OSError:
+            pass
+    
+    def on_esp32_readable(self, sock):
+        """ESP32有資料可讀"""
+        if self.mode == 'breath_detection':
+            self.process_breath_detection()
+        else:
+            # Unity控制模式不需要麥克風數據，但仍要讀走以免ESP32端寫入阻塞
+            try:
+                self.metrics.count('samples', self.esp32_reader.read().size)
+                self.complete_esp32_sync(time.monotonic())
+            except OSError as e:
+                self.console.log(f"❌ 接收數據錯誤: {e}", key='recv_error', interval=1.0)
+        
+        # 韌體回送的氣泵確認
+        if self.esp32_reader.acks:
+            for command in self.esp32_reader.acks:
+                self.pump.acknowledge(command)
+            self.esp32_reader.acks.clear()
+        
+        if self.esp32_reader.closed:
+            print("\n❌ ESP32連線中斷")
+            self.selector.unregister(sock)
+            self.on_esp32_lost()
+    
+    def on_dsp_ready(self, sock):
+        """DSP 行程寫入新的取樣或事件"""
+        from breath_dsp import EVENT_ACK, EVENT_CALIBRATED, EVENT_DECISION
+        samples, events = self.dsp.drain()
+        if samples.size and self.recorder:
+            self.recorder.record_samples(samples[:, 1], samples[-1, 0], self.samplerate, samples[:, 0])
+        received = self.dsp.samples_received
+        self.metrics.count('samples', received - self.metrics.counters.get('samples', 0))
+        
+        for kind, t, state, *features, elapsed, window_time, decision_time in events.tolist():
+            if kind == EVENT_DECISION:
+                self.apply_decision(Classification(BREATH_STATES[int(state)], *features), elapsed, t,
+                                    window_time, decision_time)
+            elif kind == EVENT_ACK:
+                self.pump.acknowledge(chr(int(state)))
+            elif kind == EVENT_CALIBRATED and self.recorder:
+                self.recorder.set_calibration(features[0], int(features[1]))
+        
+        if self.dsp.closed:
+            print("\n❌ ESP32連線中斷 (DSP 行程結束)")
+            self.selector.unregister(sock)
+            self.on_esp32_lost()
+    
+    def complete_esp32_sync(self, arrival):
+        """韌體回送的時間封包：t1/t2 為韌體 micros() 秒數，arrival 為本機收到的時間"""
+        replies = self.esp32_reader.time_replies
+        if replies:
+            for t1, t2, _ in replies:
+                self.esp32_sync.complete(t1, t2, arrival)
+            replies.clear()
+    
+    def esp32_clock(self):
+        """ESP32 的 (時脈偏移秒數, 最近一次來回秒數, 同步次數)；DSP 模式由 DSP 行程估計"""
+        if self.dsp:
+            return self.dsp.clock_offset, self.dsp.clock_rtt, self.dsp.clock_exchanges
+        return self.esp32_sync.offset, self.esp32_sync.rtt, self.esp32_sync.exchanges
+    
+    def sync_clocks(self):
+        """到期時送出時間同步 ping：ESP32 (二進位格式才支援；DSP 模式由 DSP 行程負責) 及已連線的Unity"""
+        now = time.monotonic()
+        reader = self.esp32_reader
+        if reader and reader.format == 'binary' and not reader.closed and self.esp32_sync.due(now):
+            self.esp32_sync.begin(now)
+            try:
+                self.esp32_socket.sendall(TIME_REQUEST)
+            except OSError as e:
+                self.console.log(f"⚠️ 發送時間同步失敗: {e}", key='esp32_sync_error', interval=5.0)
+        for subscriber in list(self.unity.subscribers) if self.unity else ():
+            if subscriber.sync.due(now):
+                ping_id = subscriber.sync.begin(now)
+                self.unity.send(subscriber, [{'type': 'ping', 'id': ping_id, 't0': now}])
+    
+    def sync_timeout(self):
+        """距離下一次時間同步的秒數，沒有需要同步的連線時為 None"""
+        now = time.monotonic()
+        timeouts = []
+        if self.esp32_reader and self.esp32_reader.format == 'binary' and not self.esp32_reader.closed:
+            timeouts.append(self.esp32_sync.time_until_due(now))
+        if self.unity:
+            timeouts.extend(subscriber.sync.time_until_due(now) for subscriber in self.unity.subscribers)
+        return min(timeouts) if timeouts else None
+    
+    def unity_controller_sync(self):
+        """控制端Unity的時脈同步（指標及摘要使用），沒有連線時為未同步的空估計"""
+        controller = self.unity.controller if self.unity else None
+        return controller.sync if controller else ClockSync()
+    
+    def on_esp32_lost(self):
+        """服務模式下 ESP32 斷線即結束，交由程序管理員重新啟動"""
+        if self.headless:
+            self.exit_code = 1
+            self.stop()
+    
+    def on_unity_connect(self, subscriber):
+        """新的Unity訂閱者：只對它補送模式資訊及目前狀態，不重送之前的消息；遙測需由它自己訂閱"""
+        role = "控制端" if subscriber is self.unity.controller else "訂閱者"
+        self.console.log(f"✅ Unity已連接: {subscriber} ({role}，共 {len(self.unity.subscribers)} 個)")
+        messages = [self.mode_info(subscriber)]
+        if self.mode != 'unity_control':
+            messages.append(self.breath_update(self.current_breath_state,
+                                               'keyboard' if self.mode == 'breath_control' else 'breath_detection',
+                                               self.decision_times))
+        self.unity.send(subscriber, messages)
+    
+    def on_unity_disconnect(self, subscriber, was_controller):
+        """訂閱者離線；控制端離線時由最早連線的訂閱者接手，並通知它"""
+        controller = self.unity.controller
+        if was_controller and controller:
+            self.console.log(f"🎮 Unity控制端改為 {controller}")
+            self.unity.send(controller, [self.mode_info(controller)])
+        elif not self.unity.subscribers:
+            self.console.log("等待Unity重新連線...")
+    
+    def on_unity_message(self, subscriber, message, received):
+        try:
+            self.handle_unity_message(message, received, subscriber)
+        except Exception as e:
+            self.console.log(f"⚠️ 處理Unity消息錯誤: {e}", key='unity_message_error', interval=1.0)
+    
+    def flush_unity_messages(self):
+        """把排隊中的消息全部取出，序列化一次後廣播給所有Unity訂閱者"""
+        # 沒有訂閱者時直接丟棄，新連線時由 on_unity_connect 補送目前狀態
+        messages = self.message_queue.drain()
+        if not messages or not self.unity or not self.unity.subscribers:
+            return
+        
+        started = time.perf_counter()
+        delivered = self.unity.broadcast(encode_messages(messages, self.unity_binary))
+        self.metrics.count('unity_messages', len(messages) * delivered)
+        sent = time.monotonic()
+        for message in messages:
+            if message.get('type') == 'breath_update':
+                self.metrics.observe('decision_to_send', sent - message['decision_time'])
+        self.metrics.observe('unity_send', time.perf_counter() - started)
+    
+    def mode_info(self, subscriber):
+        """給某個訂閱者的模式資訊；controller 表示它是否為控制端"""
+        return {
+            'type': 'mode_setup',
+            'mode': self.mode,
+            'description': self._get_mode_description(),
+            'protocol': 'binary' if self.unity_binary else 'json',
+            'controller': subscriber is self.unity.controller
+        }
+    
+    def handle_unity_message(self, message, received=None, subscriber=None):
+        """
+        處理Unity傳來的消息
+        received: 收到的時間 time.monotonic()
+        subscriber: 送出的訂閱者；回應只送給它，省略時 (測試或嵌入使用) 視為控制端並廣播回應
+        """
+        if received is None:
+            received = time.monotonic()
+        reply = (lambda response: self.unity.send(subscriber, [response])) if subscriber else self.message_queue.put
+        kind = message.get('type')
+        if kind == 'character_state':
+            if subscriber and subscriber is not self.unity.controller:
+                # 只有控制端可以控制角色及氣泵，其他訂閱者 (觀眾畫面、儀表板) 的控制消息忽略
+                self.metrics.count('unity_control_rejected')
+                self.console.log(f"⚠️ 忽略非控制端 {subscriber} 的 character_state", key='unity_control_rejected',
+                                 interval=1.0)
             # Unity控制模式：接收Unity的角色狀態
-            if message.get('type') == 'character_state':
+            elif self.mode == 'unity_control':
                 old_state = self.unity_character_state
                 self.unity_character_state = message.get('state', 'normal')
                 
@@ -311,53 +705,105 @@ class BreathSimulatorV2:
                 if old_state != self.unity_character_state:
                     if self.unity_character_state == 'enlarged':
                         self.control_pump(True)  # 角色變大時開氣泵
-                        print(f"🎮 Unity狀態變化: {old_state} → {self.unity_character_state} [開啟氣泵]")
+                        self.console.log(f"🎮 Unity狀態變化: {old_state} → {self.unity_character_state} [開啟氣泵]")
                     else:
                         self.control_pump(False)  # 其他狀態關氣泵
-                        print(f"🎮 Unity狀態變化: {old_state} → {self.unity_character_state} [關閉氣泵]")
+                        self.console.log(f"🎮 Unity狀態變化: {old_state} → {self.unity_character_state} [關閉氣泵]")
                 
-        # 兩種模式都可以接收的通用消息
-        elif message.get('type') == 'ping':
-            # 回應ping
+        # 所有模式都可以接收的通用消息
+        elif kind == 'ping':
+            # 回應ping；帶回Unity的送出時間 t0 及本機收到/送出時間 t1/t2，讓Unity估計時脈偏移
             response = {'type': 'pong', 'timestamp': time.time()}
-            self.message_queue.put(response)
+            if 't0' in message:
+                response.update(id=message.get('id'), t0=message['t0'], t1=received, t2=time.monotonic())
+            reply(response)
+        elif kind == 'pong':
+            # 本機送出的ping的回應：t1/t2 為Unity收到及送出的時間
+            if subscriber and 't1' in message and 't2' in message:
+                subscriber.sync.complete(message['t1'], message['t2'], received, message.get('id'))
+        elif kind == 'telemetry_subscribe' and subscriber:
+            self.set_telemetry_rate(subscriber, message.get('rate', 0))
+    
+    def set_telemetry_rate(self, subscriber, rate):
+        """設定某個訂閱者的遙測頻率 (Hz)，0 表示關閉"""
+        rate = min(max(float(rate or 0), 0.0), TELEMETRY_MAX_RATE)
+        subscriber.telemetry_rate = rate
+        subscriber.telemetry_next = time.monotonic() if rate else None
+        subscriber.telemetry_sent = None
+        self.unity.send(subscriber, [{'type': 'telemetry_status', 'rate': rate}])
+        self.console.log(f"📡 {subscriber} 遙測頻率: {rate:g} Hz" if rate else f"📡 {subscriber} 遙測已關閉")
     
-    def send_to_unity(self, breath_state, source='keyboard'):
-        """發送呼吸狀態給Unity"""
-        if self.mode not in ['breath_control', 'breath_detection']:
+    def telemetry_timeout(self):
+        """距離下一個遙測 frame 的秒數，沒有訂閱時為 None（事件迴圈無限等待）"""
+        due = [s.telemetry_next for s in self.unity.subscribers if s.telemetry_next is not None] if self.unity else ()
+        if not due:
+            return None
+        return max(0.0, min(due) - time.monotonic())
+    
+    def send_telemetry(self):
+        """到期的訂閱者送出最新特徵的二進位 frame (同一輪只編碼一次)；與上次送給它的相同則略過"""
+        if not self.unity:
             return
+        now = time.monotonic()
+        frame = None
+        for subscriber in list(self.unity.subscribers):
+            if subscriber.telemetry_next is None or now < subscriber.telemetry_next:
+                continue
+            interval = 1.0 / subscriber.telemetry_rate
+            # 以固定節拍前進；落後太多時從現在重新起算，不補送
+            subscriber.telemetry_next += interval
+            if subscriber.telemetry_next < now:
+                subscriber.telemetry_next = now + interval
             
-        message = {
-            'type': 'breath_update',
-            'state': breath_state,
-            'source': source,
-            'timestamp': time.time()
-        }
-        self.message_queue.put(message)
+            features = self.latest_features
+            if features is None or features == subscriber.telemetry_sent:
+                self.metrics.count('telemetry_skipped')
+                continue
+            subscriber.telemetry_sent = features
+            if frame is None:
+                frame = encode_telemetry(*features, time.time())
+            self.unity.send_bytes(subscriber, frame)
+            self.metrics.count('telemetry_frames')
+    
+    def send_to_unity(self, breath_state, source='keyboard', times=None):
+        """發送呼吸狀態給所有Unity訂閱者"""
+        if self.mode not in ['breath_control', 'breath_detection', 'replay']:
+            return
+        self.message_queue.put(self.breath_update(breath_state, source, times))
+        self.wake()
+    
+    def breath_update(self, breath_state, source, times=None):
+        """組成 breath_update 消息；times 為觸發的 (視窗時間, 判斷時間)，省略時兩者都是現在"""
+        return breath_update_message(breath_state, source, times)
     
     def control_pump(self, turn_on):
-        """控制氣泵開關"""
-        if turn_on and not self.pump_is_on:
-            self.send_to_esp32('s')
-            self.pump_is_on = True
-        elif not turn_on and self.pump_is_on:
-            self.send_to_esp32('x')
-            self.pump_is_on = False
+        """控制氣泵開關（不阻塞；重播模式沒有通道，直接處理）"""
+        if turn_on == self.pump_is_on:
+            return
+        self.pump_is_on = turn_on
+        if self.recorder:
+            self.recorder.record_pump(time.time(), turn_on)
+        if self.pump:
+            self.pump.request(turn_on)
+        else:
+            self.send_to_esp32(PUMP_ON if turn_on else PUMP_OFF)
     
     def send_to_esp32(self, command):
-        """發送控制命令到ESP32"""
-        action = "開啟氣泵" if command == 's' else "關閉氣泵"
+        """發送控制命令到ESP32（由氣泵通道執行緒呼叫，可阻塞）"""
+        action = "開啟氣泵" if command == PUMP_ON else "關閉氣泵"
         
         if self.mode in ['breath_detection', 'unity_control'] and self.esp32_socket:
             # 真實模式：發送到真實ESP32
+            started = time.perf_counter()
             try:
-                self.esp32_socket.send(command.encode())
-                print(f"📤 [ESP32真實] 發送命令: {command} ({action})")
+                self.esp32_socket.sendall(command.encode())
+                self.console.log(f"📤 [ESP32真實] 發送命令: {command} ({action})")
             except Exception as e:
-                print(f"❌ 發送命令失敗: {e}")
+                self.console.log(f"❌ 發送命令失敗: {e}", key='pump_send_error', interval=1.0)
+            self.metrics.observe('pump_send', time.perf_counter() - started)
         else:
             # 模擬模式
-            print(f"📤 [ESP32模擬] 發送命令: {command} ({action})")
+            self.console.log(f"📤 [ESP32模擬] 發送命令: {command} ({action})")
     
     def on_key_press(self, key):
         """鍵盤按鍵處理（僅在breath_control模式有效）"""
@@ -385,21 +831,27 @@ class BreathSimulatorV2:
                 
         except AttributeError:
             # 特殊按鍵（如Ctrl, Alt等）
-            if key == keyboard.Key.esc:
+            if key == self.keyboard.Key.esc:
                 print("🛑 程式結束")
-                self.running = False
+                self.stop()
                 return False
     
     def display_status(self):
-        """顯示當前狀態"""
+        """顯示當前狀態（僅在狀態改變時重繪；服務模式沒有終端機，不顯示）"""
+        if self.headless:
+            return
+        status = (self.current_breath_state, self.unity_character_state, self.pump_is_on)
+        if status == self._last_status:
+            return
+        self._last_status = status
         pump_status = "🌪️ 開啟" if self.pump_is_on else "⏹️ 關閉"
         
         if self.mode == 'breath_control':
-            print(f"\r🎯 呼吸狀態: {self.current_breath_state:<16} | 氣泵: {pump_status}", end='', flush=True)
+            self.console.log(f"\r🎯 呼吸狀態: {self.current_breath_state:<16} | 氣泵: {pump_status}", end='')
         elif self.mode == 'unity_control':
-            print(f"\r🎮 Unity角色: {self.unity_character_state:<12} | 氣泵: {pump_status}", end='', flush=True)
+            self.console.log(f"\r🎮 Unity角色: {self.unity_character_state:<12} | 氣泵: {pump_status}", end='')
         elif self.mode == 'breath_detection':
-            print(f"\r🔍 呼吸檢測: {self.current_breath_state:<16} | 氣泵: {pump_status}", end='', flush=True)
+            self.console.log(f"\r🔍 呼吸檢測: {self.current_breath_state:<16} | 氣泵: {pump_status}", end='')
     
     def control_loop(self):
         """主控制迴圈"""
@@ -425,94 +877,260 @@ class BreathSimulatorV2:
             
         print("-" * 50)
         
+        # 事件迴圈：只在socket有資料或被喚醒時才處理，沒有固定sleep
         while self.running:
-            if self.mode == 'breath_detection':
-                self.process_breath_detection()
-            
-            elif self.mode == 'breath_control':
-                pass
-
-            elif self.mode == 'unity_control':
-                # Unity控制模式：等待Unity發送狀態
-                if self.unity_client:
-                    try:
-                        data = self.unity_client.recv(1024)
-                        if data:
-                            message = json.loads(data.decode('utf-8'))
-                            self.handle_unity_message(message)
-                    except socket.timeout:
-                        pass
-                    except Exception as e:
-                        print(f"⚠️ Unity通訊錯誤: {e}")
-            time.sleep(0.1)
+            timeouts = [t for t in (self.telemetry_timeout(), self.sync_timeout()) if t is not None]
+            for key, _ in self.selector.select(min(timeouts) if timeouts else None):
+                key.data(key.fileobj)
+            self.sync_clocks()
+            self.send_telemetry()
+            self.flush_unity_messages()
             self.display_status()
     
+    def run_replay(self):
+        """重播錄製檔：不需要ESP32或Unity，依速度倍率或盡快送進判斷及氣泵邏輯"""
+        recording = SessionRecording(self.replay_file)
+        start = recording.seek(recording.start_time + self.replay_seek)
+        first = int(np.count_nonzero(recording.records['kind'][:start] == RECORD_SAMPLE))  # 起點的取樣序號
+        times, samples = recording.samples()
+        _, recorded = recording.decisions()
+        recording.close()
+        
+        speed_text = f"{self.replay_speed}x" if self.replay_speed > 0 else "盡快"
+        print(f"⏯️ 重播 {self.replay_file}: {samples.size - first} 筆取樣，速度 {speed_text}")
+        if samples.size <= first:
+            return
+        
+        # 錄製時第 k 次判斷的視窗結束於第 block_size + k * hop_size 筆取樣；
+        # 從起點前一個視窗、對齊 hop 的位置開始填入視窗，讓判斷時間點與錄製時相同，暖機的判斷不送出也不比對
+        warmup = max(0, first - self.block_size)
+        warmup -= warmup % self.hop_size
+        for features in self.window.push(samples[warmup:first]):
+            self.current_breath_state = self.classify_nose_breath(self.window.view(), features).state
+        
+        decisions = []  # (錄製的判斷序號, 判斷結果索引)
+        chunk = 64  # 與真實接收時每次到達的取樣數相近
+        wall_start = time.perf_counter()
+        # 依速度倍率重播時，把錄製的取樣時間對應到現在的 time.monotonic()，視窗到判斷的延遲才有意義
+        clock_start = time.monotonic()
+        for i in range(first, samples.size, chunk):
+            if not self.running:
+                break
+            if self.replay_speed > 0:
+                # 與真實接收相同，一批取樣在最後一筆取樣之後才到達
+                last = min(i + chunk, samples.size) - 1
+                delay = (times[last] - times[first]) / self.replay_speed - (time.perf_counter() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            
+            for features in self.window.push(samples[i:i + chunk]):
+                end = warmup + self.window.count  # 視窗最後一筆取樣的序號 + 1
+                window_time = None
+                if self.replay_speed > 0:
+                    window_time = clock_start + (times[end - 1] - times[first]) / self.replay_speed
+                self.process_breath_window(self.window.view(), features, window_time)
+                decisions.append(((end - self.block_size) // self.hop_size,
+                                  BREATH_STATES.index(self.current_breath_state)))
+            self.flush_unity_messages()
+        
+        elapsed = time.perf_counter() - wall_start
+        duration = (samples.size - first) / self.samplerate
+        print(f"\n⏱️ 重播完成: {duration:.1f}s 資料耗時 {elapsed:.2f}s "
+              f"({duration / max(elapsed, 1e-9):.0f}x 即時)，共 {len(decisions)} 次判斷")
+        
+        # 依判斷序號與錄製時同一個視窗的判斷比對
+        if decisions:
+            index, replayed = (np.array(column) for column in zip(*decisions))
+            matched = index < recorded.size
+            compared = int(np.count_nonzero(matched))
+            if compared:
+                mismatches = np.count_nonzero(replayed[matched] != recorded[index[matched]])
+                print(f"🔁 與錄製判斷比對: {compared - mismatches}/{compared} 相同")
+    
     def run(self):
-        """啟動模擬器"""
+        """啟動模擬器，回傳程序結束狀態碼"""
         print("🚀 呼吸模擬器 V2 啟動中...")
+        self.startup = time.perf_counter()
+        
+        if self.record_path and self.mode != 'replay':
+            self.recorder = SessionRecorder(self.record_path, self.samplerate, time.time())
+            print(f"⏺️ 錄製到 {self.record_path}")
+        self.start_metrics()
+        
+        if self.mode == 'replay':
+            try:
+                self.run_replay()
+            except KeyboardInterrupt:
+                print("\n🛑 程式結束")
+            self.cleanup()
+            return 0
+        
+        # 程序管理員以 SIGTERM 要求結束時，與 Ctrl+C 一樣關閉氣泵並清理
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.handle_signal)
+            if self.headless:
+                signal.signal(signal.SIGHUP, self.handle_signal)
+        
+        # 鍵盤監聽只有 breath_control 模式需要，其他模式不載入 pynput（無顯示伺服器時也能執行）
+        if self.mode == 'breath_control':
+            try:
+                from pynput import keyboard
+            except Exception as e:
+                print(f"❌ 無法載入鍵盤監聽 (pynput): {e}")
+                return 1
+            self.keyboard = keyboard
         
-        # 啟動Unity伺服器
-        unity_server_thread = threading.Thread(target=self.start_unity_server, daemon=True)
-        unity_server_thread.start()
+        # 啟動Unity伺服器；Unity可以在之後任何時間連上，不需要等待
+        if not self.start_unity_server() and self.headless:
+            return 1
         
         # 如果是呼吸檢測模式或Unity控制模式，設置ESP32連接
         if self.mode in ['breath_detection', 'unity_control']:
             if not self.setup_esp32_connection():
                 print("❌ ESP32連接失敗，程式結束")
-                return
+                return 1
             
             # 只有呼吸檢測模式需要校正
             if self.mode == 'breath_detection':
-                self.calibrate_baseline()
+                self.start_calibration()
+        
+        self.pump = PumpChannel(self.send_to_esp32, self.pump_min_interval)
         
-        # 等待Unity連接
-        time.sleep(2)
+        self.setup_event_loop()
         
         if self.mode == 'breath_control':
-            # 呼吸控制模式：啟動鍵盤監聽
+            # 呼吸控制模式：啟動鍵盤監聽，監聽器就緒後才開始控制迴圈
             print("⌨️ 啟動鍵盤監聽...")
-            with keyboard.Listener(on_press=self.on_key_press) as listener:
+            with self.keyboard.Listener(on_press=self.on_key_press) as listener:
+                listener.wait()
+                self.mark_ready('keyboard')
                 # 啟動控制迴圈
                 control_thread = threading.Thread(target=self.control_loop, daemon=True)
                 control_thread.start()
                 
                 listener.join()
+            self.stop()
+            control_thread.join(timeout=1.0)
         else:
             # Unity控制模式或呼吸檢測模式：只運行控制迴圈
             try:
                 self.control_loop()
             except KeyboardInterrupt:
                 print("\n🛑 程式結束")
-                self.running = False
+                self.stop()
         
         # 清理資源
         self.cleanup()
+        return self.exit_code
     
     def cleanup(self):
         """清理資源"""
         self.running = False
+        notify_supervisor('STOPPING=1')
         self.control_pump(False)  # 確保氣泵關閉
+        if self.pump:
+            self.pump.close()
+        if self.dsp:
+            self.dsp.close()
+        self.console.close()  # 先輸出排隊中的日誌，之後的摘要直接印出
+        if self.metrics_server:
+            self.metrics_server.close()
+        if self.metrics.counters:
+            print(f"\n📈 {self.metrics.summary()[0]}")
+        if self.ready_after is not None or self.first_decision_after is not None:
+            startup = [f"{label} {seconds * 1000:.0f}ms" for label, seconds in
+                       (('就緒', self.ready_after), ('第一次判斷', self.first_decision_after)) if seconds is not None]
+            print(f"\n⏱️ 啟動 → {'，'.join(startup)}")
+        unity_sync = self.unity_controller_sync()
+        for name, (offset, rtt, exchanges) in (('ESP32', self.esp32_clock()),
+                                               ('Unity', (unity_sync.offset, unity_sync.rtt, unity_sync.exchanges))):
+            if offset is not None:
+                print(f"\n🕒 {name} 時脈偏移 {offset * 1000:+.3f}ms，最近來回 {rtt * 1000:.2f}ms (n={exchanges})")
+        if self.pump:
+            latency = self.pump.latency_percentiles()
+            print(f"\n🌪️ 氣泵切換要求 {self.pump.requests} 次，實際送出 {self.pump.commands_sent} 次")
+            if latency is not None:
+                print(f"⏱️ 氣泵確認延遲 p50={latency[0] * 1000:.1f}ms p90={latency[1] * 1000:.1f}ms "
+                      f"p99={latency[2] * 1000:.1f}ms (n={len(self.pump.latencies)})")
         
-        if self.unity_client:
-            self.unity_client.close()
-        if self.unity_socket:
-            self.unity_socket.close()
+        if self.unity:
+            if self.unity.slow_dropped or self.unity.rejected:
+                print(f"\n⚠️ Unity訂閱者: {self.unity.slow_dropped} 個因接收太慢中斷，{self.unity.rejected} 個超過上限被拒絕")
+            self.unity.close_all()
         if self.esp32_socket:
             self.esp32_socket.close()
+        if self.calibration and self.calibration.seeded:
+            self.calibration.save()
+            print(f"\n📐 基準值 {self.calibration.baseline:.2f} (漂移 {self.calibration.drift:+.2f})")
+        if self.recorder:
+            self.recorder.close()
+            print(f"\n💾 已錄製 {self.recorder.count} 筆紀錄到 {self.record_path}")
+        if self.selector:
+            self.selector.close()
+        if self._wake_reader:
+            self._wake_reader.close()
+            self._wake_writer.close()
+        if self.esp32_reader and self.esp32_reader.malformed_samples:
+            print(f"\n⚠️ 格式錯誤取樣: {self.esp32_reader.malformed_samples} / "
+                  f"{self.esp32_reader.samples_received + self.esp32_reader.malformed_samples}")
+        if getattr(self.esp32_reader, 'lost_samples', 0):
+            print(f"\n⚠️ 掉包: {self.esp32_reader.sequence_gaps} 次，共 {self.esp32_reader.lost_samples} 筆取樣")
         print("\n🧹 資源清理完成")
 
 def main():
     parser = argparse.ArgumentParser(description='呼吸檢測模擬器 V2')
-    parser.add_argument('--mode', choices=['breath_control', 'unity_control', 'breath_detection'], 
+    parser.add_argument('--mode', choices=['breath_control', 'unity_control', 'breath_detection', 'replay'], 
                         default='breath_control',
-                        help='選擇運行模式: breath_control (Python主導), unity_control (Unity主導+真實ESP32), 或 breath_detection (真實呼吸檢測)')
+                        help='選擇運行模式: breath_control (Python主導), unity_control (Unity主導+真實ESP32), breath_detection (真實呼吸檢測), 或 replay (重播錄製檔)')
     parser.add_argument('--esp32_host', type=str, default="192.168.1.129", help='ESP32 的 IP 位址 (可選)')
+    parser.add_argument('--esp32_port', type=int, default=8080, help='ESP32 的埠號 (可選，預設 8080)')
+    parser.add_argument('--esp32_ascii', action='store_true', help='不協商二進位格式，強制使用 ASCII 取樣 (可選)')
     parser.add_argument('--unity_port', type=int, default=7777, help='Unity 的埠號 (可選，預設 7777)')
+    parser.add_argument('--unity_binary', action='store_true', help='breath_update 以二進位 frame 傳給 Unity (可選)')
+    parser.add_argument('--unity_max_clients', type=int, default=8,
+                        help='同時連線的 Unity 訂閱者上限，最早連線的為控制端 (可選，預設 8)')
+    parser.add_argument('--record', type=str, default=None, help='錄製原始取樣、判斷及氣泵指令到檔案 (可選)')
+    parser.add_argument('--replay_file', type=str, default=None, help='replay 模式要重播的錄製檔')
+    parser.add_argument('--replay_speed', type=float, default=0.0, help='重播速度倍率 (可選，預設 0 = 盡快處理)')
+    parser.add_argument('--replay_seek', type=float, default=0.0, help='從錄製開始後第幾秒開始重播 (可選)')
+    parser.add_argument('--thresholds', type=str, default=None, help='呼吸判斷門檻 JSON (可選，例如 breath_tuning.py 的輸出)')
+    parser.add_argument('--baseline_tau', type=float, default=10.0, help='安靜時追蹤基準值漂移的時間常數秒數 (可選，預設 10)')
+    parser.add_argument('--calibration_cache', type=str, default=DEFAULT_CACHE_PATH,
+                        help='ADC 位元數及基準值快取檔 (可選，設為空字串停用)')
+    parser.add_argument('--pump_min_interval', type=float, default=0.25, help='氣泵兩次切換之間的最小秒數 (可選，預設 0.25)')
+    parser.add_argument('--metrics_port', type=int, default=None, help='在本機此埠號提供 HTTP 指標端點 /metrics (可選)')
+    parser.add_argument('--stats_interval', type=float, default=0.0, help='每隔幾秒輸出一次統計摘要 (可選，預設不輸出)')
+    parser.add_argument('--classifier', type=str, default='rules',
+                        help='判斷引擎: rules (預設) 或 breath_train.py 訓練的模型 .npz (可選)')
+    parser.add_argument('--dsp_process', action='store_true',
+                        help='breath_detection 模式下在獨立行程接收取樣及判斷，降低 I/O 對判斷的干擾 (可選)')
+    parser.add_argument('--headless', action='store_true',
+                        help='無人值守服務模式：不載入鍵盤監聽、不顯示狀態列，適合 systemd 等程序管理員 (可選)')
+    parser.add_argument('--hop_ms', type=int, default=10,
+                        help='呼吸判斷間隔毫秒數，須整除 250ms 視窗，否則取最接近的間隔 (可選，預設 10；設為 250 即為不重疊區塊)')
     args = parser.parse_args()
+    if args.mode == 'replay' and not args.replay_file:
+        parser.error('replay 模式需要 --replay_file')
+    if args.headless and args.mode == 'breath_control':
+        parser.error('breath_control 模式需要鍵盤，不能搭配 --headless')
+    if args.headless:
+        # 輸出導向日誌檔或 journald 時仍逐行寫出
+        sys.stdout.reconfigure(line_buffering=True)
     print("🎯 呼吸檢測模擬器 V2")
     print(f"🎮 模式: {args.mode}")
-    simulator = BreathSimulatorV2(mode=args.mode, esp32_host=args.esp32_host, unity_port=args.unity_port)
-    simulator.run()
+    simulator = BreathSimulatorV2(mode=args.mode, esp32_host=args.esp32_host, esp32_port=args.esp32_port,
+                                  unity_port=args.unity_port,
+                                  hop_ms=args.hop_ms, unity_binary=args.unity_binary,
+                                  esp32_binary=not args.esp32_ascii, record_path=args.record,
+                                  replay_file=args.replay_file, replay_speed=args.replay_speed,
+                                  replay_seek=args.replay_seek,
+                                  thresholds=load_thresholds(args.thresholds) if args.thresholds else None,
+                                  baseline_tau=args.baseline_tau, calibration_cache=args.calibration_cache or None,
+                                  pump_min_interval=args.pump_min_interval, metrics_port=args.metrics_port,
+                                  stats_interval=args.stats_interval, classifier=args.classifier,
+                                  dsp_process=args.dsp_process, headless=args.headless,
+                                  unity_max_clients=args.unity_max_clients)
+    return simulator.run()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
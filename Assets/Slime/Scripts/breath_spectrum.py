@@ -0,0 +1,47 @@
+from functools import lru_cache
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# 低頻/高頻分界 (Hz)；500Hz 取樣時 Nyquist 為 250Hz
+DEFAULT_SPLIT_HZ = 100.0
+
+
+class BandEnergy:
+    """加窗實數 FFT 的頻帶能量；窗函數及頻率遮罩只在建立時計算一次"""
+
+    def __init__(self, window_size, samplerate, split_hz=DEFAULT_SPLIT_HZ):
+        self.window_size = window_size
+        self.samplerate = samplerate
+        self.split_hz = split_hz
+
+        self.window = np.hanning(window_size)
+        # 以窗函數能量正規化，讓不同視窗長度的能量可比較
+        self.scale = 1.0 / np.sum(self.window ** 2)
+        freqs = np.fft.rfftfreq(window_size, d=1.0 / samplerate)
+        self.low_mask = (freqs > 0) & (freqs < split_hz)  # 略過直流成分
+        self.high_mask = freqs >= split_hz
+
+    def compute(self, signal):
+        """單一視窗，回傳 (low, high, total)"""
+        power = np.abs(np.fft.rfft(signal * self.window)) ** 2 * self.scale
+        low = float(power[self.low_mask].sum())
+        high = float(power[self.high_mask].sum())
+        return low, high, low + high
+
+    def compute_batch(self, windows):
+        """多個視窗 (..., window_size) 一次計算，回傳 (low, high, total) 陣列"""
+        power = np.abs(np.fft.rfft(windows * self.window, axis=-1)) ** 2 * self.scale
+        low = power[..., self.low_mask].sum(axis=-1)
+        high = power[..., self.high_mask].sum(axis=-1)
+        return low, high, low + high
+
+    def sliding(self, signal, hop):
+        """對整段訊號以 hop 滑動的所有視窗計算頻帶能量（不複製資料建立視窗）"""
+        windows = sliding_window_view(signal, self.window_size)[::hop]
+        return self.compute_batch(windows)
+
+
+@lru_cache(maxsize=8)
+def band_energy(window_size, samplerate, split_hz=DEFAULT_SPLIT_HZ):
+    """依 (視窗長度, 取樣率, 分界頻率) 快取 BandEnergy"""
+    return BandEnergy(window_size, samplerate, split_hz)
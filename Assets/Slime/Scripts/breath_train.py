@@ -0,0 +1,180 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from breath_classifier import DECISION_BUDGET_US, FEATURE_NAMES, LearnedClassifier, feature_matrix, save_model
+from breath_protocol import BREATH_STATES
+from breath_rules import DEFAULT_THRESHOLDS, decide_batch
+from breath_tuning import expand_paths, labels_path, load_labels, session_features
+
+
+def load_sessions(paths, hop_ms, refresh=False):
+    """回傳每個標註錄製檔的 (名稱, 特徵矩陣, 預期判斷, rms/amp/zcr 及 hops_per_block)"""
+    sessions = []
+    for path in expand_paths(paths):
+        if not os.path.exists(labels_path(path)):
+            print(f"⚠️ 略過 {path}: 找不到標註檔 {labels_path(path)}")
+            continue
+        features, hops_per_block = session_features(path, hop_ms, refresh)
+        expected = load_labels(labels_path(path), features['times'])
+        X = feature_matrix(features['rms'], features['amp'], features['zcr'], features['low'], features['high'])
+        sessions.append({'name': path, 'X': X, 'y': expected, 'features': features,
+                         'hops_per_block': hops_per_block})
+        print(f"📂 {path}: {expected.size} 個視窗")
+    return sessions
+
+
+def split_sessions(sessions, val_fraction):
+    """
+    每個錄製檔的最後 val_fraction 作為驗證資料
+    重疊視窗相鄰時幾乎相同，依時間切開才不會高估驗證正確率
+    """
+    train_X, train_y, val_X, val_y = [], [], [], []
+    for session in sessions:
+        cut = int(round(session['y'].size * (1.0 - val_fraction)))
+        train_X.append(session['X'][:cut])
+        train_y.append(session['y'][:cut])
+        val_X.append(session['X'][cut:])
+        val_y.append(session['y'][cut:])
+    return np.concatenate(train_X), np.concatenate(train_y), np.concatenate(val_X), np.concatenate(val_y)
+
+
+def init_layers(sizes, rng):
+    layers = []
+    for fan_in, fan_out in zip(sizes[:-1], sizes[1:]):
+        layers.append((rng.normal(0.0, np.sqrt(2.0 / fan_in), (fan_in, fan_out)), np.zeros(fan_out)))
+    return layers
+
+
+def forward(layers, X):
+    """回傳各層輸入 (供反向傳播) 及最後的 logits"""
+    inputs = []
+    h = X
+    for W, b in layers[:-1]:
+        inputs.append(h)
+        h = np.maximum(h @ W + b, 0.0)
+    inputs.append(h)
+    W, b = layers[-1]
+    return inputs, h @ W + b
+
+
+def train(X, y, hidden, epochs, lr, l2, seed):
+    """
+    全批次 Adam 訓練 softmax 回歸 (hidden=0) 或單一隱藏層 MLP
+    各狀態依樣本數反比加權，避免 undecided 佔多數時模型只學會輸出 undecided
+    回傳 [(W, b), ...]
+    """
+    rng = np.random.default_rng(seed)
+    sizes = [X.shape[1]] + ([hidden] if hidden else []) + [len(BREATH_STATES)]
+    layers = init_layers(sizes, rng)
+
+    counts = np.bincount(y, minlength=len(BREATH_STATES)).astype(np.float64)
+    class_weight = np.where(counts > 0, counts.sum() / (len(BREATH_STATES) * np.maximum(counts, 1)), 0.0)
+    sample_weight = class_weight[y] / y.size
+    onehot = np.eye(len(BREATH_STATES))[y]
+
+    params = [p for layer in layers for p in layer]
+    m = [np.zeros_like(p) for p in params]
+    v = [np.zeros_like(p) for p in params]
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+
+    for step in range(1, epochs + 1):
+        inputs, logits = forward(layers, X)
+        logits -= logits.max(axis=1, keepdims=True)
+        prob = np.exp(logits)
+        prob /= prob.sum(axis=1, keepdims=True)
+        delta = (prob - onehot) * sample_weight[:, None]
+
+        grads = []
+        for i in range(len(layers) - 1, -1, -1):
+            W, b = layers[i]
+            grads.append((inputs[i].T @ delta + l2 * W, delta.sum(axis=0)))
+            if i > 0:
+                delta = (delta @ W.T) * (inputs[i] > 0)
+        grads = [g for layer in reversed(grads) for g in layer]
+
+        for i, (p, g) in enumerate(zip(params, grads)):
+            m[i] = beta1 * m[i] + (1 - beta1) * g
+            v[i] = beta2 * v[i] + (1 - beta2) * g * g
+            p -= lr * (m[i] / (1 - beta1 ** step)) / (np.sqrt(v[i] / (1 - beta2 ** step)) + eps)
+    return layers
+
+
+def accuracy(predicted, expected):
+    return float(np.mean(predicted == expected)) if expected.size else float('nan')
+
+
+def decision_time_us(classifier, X, repeat=2000):
+    """單次 classify 呼叫的平均耗時 (微秒)，與模擬器的熱路徑相同"""
+    rows = X[np.arange(repeat) % X.shape[0]]
+    low = np.expm1(rows[:, 3])
+    high = np.expm1(rows[:, 4])
+    started = time.perf_counter()
+    for row, lo, hi in zip(rows, low, high):
+        classifier.classify(row[0], row[1], row[2], lo, hi)
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='以標註過的錄製檔離線訓練呼吸判斷模型 (softmax 回歸或小型 MLP)')
+    parser.add_argument('recordings', nargs='+', help='錄製檔 (可用萬用字元)；標註檔為 <錄製檔>.labels.json')
+    parser.add_argument('--hop_ms', type=int, default=10, help='與模擬器相同的判斷間隔毫秒數 (預設 10)')
+    parser.add_argument('--hidden', type=int, default=0, help='隱藏層單元數 (預設 0 = softmax 回歸)')
+    parser.add_argument('--epochs', type=int, default=500, help='訓練回合數 (預設 500)')
+    parser.add_argument('--lr', type=float, default=0.05, help='學習率 (預設 0.05)')
+    parser.add_argument('--l2', type=float, default=1e-4, help='權重 L2 正則化係數 (預設 1e-4)')
+    parser.add_argument('--val_fraction', type=float, default=0.2, help='每個錄製檔最後多少比例作為驗證資料 (預設 0.2)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--refresh', action='store_true', help='忽略特徵快取重新計算')
+    parser.add_argument('--output', type=str, default='breath_model.npz',
+                        help='模型輸出檔，可直接給 breath_simulator_v2.py --classifier 使用 (預設 breath_model.npz)')
+    args = parser.parse_args()
+
+    sessions = load_sessions(args.recordings, args.hop_ms, args.refresh)
+    if not sessions:
+        print("❌ 沒有可用的標註錄製檔")
+        return 1
+
+    train_X, train_y, val_X, val_y = split_sessions(sessions, args.val_fraction)
+    mean = train_X.mean(axis=0)
+    scale = train_X.std(axis=0)
+    scale[scale < 1e-9] = 1.0
+
+    kind = f"MLP ({args.hidden} 個隱藏單元)" if args.hidden else "softmax 回歸"
+    print(f"🧠 訓練 {kind}: {train_y.size} 個訓練視窗，{val_y.size} 個驗證視窗，特徵 {', '.join(FEATURE_NAMES)}")
+    started = time.perf_counter()
+    layers = train((train_X - mean) / scale, train_y, args.hidden, args.epochs, args.lr, args.l2, args.seed)
+    print(f"⏱️ 訓練 {time.perf_counter() - started:.2f} 秒")
+
+    model = {'mean': mean, 'scale': scale, 'layers': len(layers)}
+    for i, (W, b) in enumerate(layers):
+        model[f'W{i}'] = W
+        model[f'b{i}'] = b
+    classifier = LearnedClassifier(model)
+
+    # 與目前的規則比較（規則依賴連續視窗，以完整錄製檔評估）
+    defaults = {name: [value] for name, value in DEFAULT_THRESHOLDS.items()}
+    rules_correct = sum(np.count_nonzero(decide_batch(s['features']['rms'], s['features']['amp'],
+                                                      s['features']['zcr'], defaults,
+                                                      s['hops_per_block'])[0] == s['y']) for s in sessions)
+    rules_total = sum(s['y'].size for s in sessions)
+    train_accuracy = accuracy(classifier.predict_batch(train_X), train_y)
+    val_accuracy = accuracy(classifier.predict_batch(val_X), val_y)
+    print(f"📊 訓練正確率 {train_accuracy:.1%}，驗證正確率 {val_accuracy:.1%}，"
+          f"預設規則 {rules_correct / rules_total:.1%}")
+    for session in sessions:
+        print(f"  {session['name']}: {accuracy(classifier.predict_batch(session['X']), session['y']):.1%}")
+
+    cost = decision_time_us(classifier, train_X)
+    mark = "✅" if cost <= DECISION_BUDGET_US else "⚠️"
+    print(f"{mark} 單次判斷 {cost:.1f}µs (預算 {DECISION_BUDGET_US:.0f}µs)")
+
+    save_model(args.output, mean, scale, layers, hop_ms=args.hop_ms, hidden=args.hidden,
+               train_accuracy=train_accuracy, val_accuracy=val_accuracy, decision_us=cost)
+    print(f"💾 已寫入 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from breath_protocol import BREATH_STATES
+from breath_recorder import SessionRecording
+from breath_rules import DEFAULT_THRESHOLDS, UNDECIDED, decide_batch
+from breath_spectrum import band_energy
+from breath_window import hop_samples, window_features
+
+# 與 breath_simulator_v2.py 相同的分析視窗 (秒)
+BLOCK_DURATION = 0.25
+
+# 各門檻的搜尋範圍 (下限, 上限)；inhale_blocks 為整數
+SEARCH_SPACE = {
+    'amp_min': (0.02, 0.3),
+    'inhale_zcr_min': (0.0, 0.3),
+    'inhale_rms_max': (0.05, 0.4),
+    'exhale_rms_min': (0.1, 0.6),
+    'inhale_blocks': (1, 5),
+}
+
+# 每個子行程一次評估的門檻組數上限；(組數 × 視窗數) 的中間陣列決定記憶體用量
+CHUNK_SIZE = 64
+# decide_batch 每個 (門檻組, 視窗) 的中間陣列峰值約 43 位元組 (數個 int64 及布林陣列)，保留餘裕
+BYTES_PER_CELL = 48
+# 所有子行程合計的中間陣列記憶體上限 (MB)；長錄製檔或多核心時縮小每次評估的組數
+MEMORY_BUDGET_MB = 1024
+
+# 快取的特徵欄位；缺少任何一個時重新計算
+FEATURE_FIELDS = ('rms', 'amp', 'zcr', 'low', 'high', 'times')
+
+# 頻帶能量一次處理的視窗數，限制 FFT 中間陣列的大小
+SPECTRUM_CHUNK = 4096
+
+
+def labels_path(recording_path):
+    return recording_path + '.labels.json'
+
+
+def load_labels(path, times):
+    """
+    讀取標註檔，回傳每個視窗的預期判斷索引
+    標註格式: {"segments": [{"start": 秒, "end": 秒, "state": "likely_INHALE"}, ...]}
+    時間相對於錄製開始；沒有標註的視窗預期為 undecided
+    """
+    with open(path, encoding='utf-8') as f:
+        segments = json.load(f)['segments']
+    expected = np.full(times.size, UNDECIDED, dtype=np.uint8)
+    for segment in segments:
+        if segment['state'] not in BREATH_STATES:
+            raise ValueError(f"{path}: 未知的狀態 {segment['state']!r}")
+        inside = (times >= segment['start']) & (times < segment['end'])
+        expected[inside] = BREATH_STATES.index(segment['state'])
+    return expected
+
+
+def session_features(path, hop_ms, refresh=False):
+    """
+    計算錄製檔所有視窗的特徵 (rms, amp, zcr)、頻帶能量 (low, high) 及視窗結束時間
+    結果快取在錄製檔旁的 .npz，視窗參數或錄製檔修改時間不同時重新計算
+    """
+    recording = SessionRecording(path)
+    window_size = int(recording.samplerate * BLOCK_DURATION)
+    hop_size = hop_samples(recording.samplerate, window_size, hop_ms)
+    cache = f"{path}.features-{window_size}-{hop_size}.npz"
+    mtime = os.stat(path).st_mtime_ns
+
+    if not refresh and os.path.exists(cache):
+        with np.load(cache) as data:
+            if int(data['mtime']) == mtime and all(name in data.files for name in FEATURE_FIELDS):
+                recording.close()
+                return {name: data[name] for name in FEATURE_FIELDS}, window_size // hop_size
+
+    times, samples = recording.samples()
+    start_time = recording.start_time
+    recording.close()
+    rms, amp, zcr = window_features(samples, window_size, hop_size)
+    low, high = session_band_energy(samples, recording.samplerate, window_size, hop_size)
+    ends = window_size - 1 + hop_size * np.arange(rms.size)
+    features = {'rms': rms, 'amp': amp, 'zcr': zcr, 'low': low, 'high': high, 'times': times[ends] - start_time}
+    np.savez(cache, mtime=mtime, **features)
+    return features, window_size // hop_size
+
+
+def session_band_energy(samples, samplerate, window_size, hop_size):
+    """所有視窗的低頻/高頻能量，與 window_features 的視窗一一對應"""
+    spectrum = band_energy(window_size, samplerate)
+    count = max(0, (samples.size - window_size) // hop_size + 1)
+    low = np.empty(count)
+    high = np.empty(count)
+    for start in range(0, count, SPECTRUM_CHUNK):
+        stop = min(start + SPECTRUM_CHUNK, count)
+        segment = samples[start * hop_size:(stop - 1) * hop_size + window_size]
+        low[start:stop], high[start:stop], _ = spectrum.sliding(segment, hop_size)
+    return low, high
+
+
+def grid_candidates(steps):
+    """每個浮點門檻取 steps 個等距值，inhale_blocks 取範圍內所有整數"""
+    axes = []
+    for name, (low, high) in SEARCH_SPACE.items():
+        if name == 'inhale_blocks':
+            axes.append(np.arange(low, high + 1))
+        else:
+            axes.append(np.linspace(low, high, steps))
+    grid = np.array(list(itertools.product(*axes)))
+    return {name: grid[:, i] for i, name in enumerate(SEARCH_SPACE)}
+
+
+def random_candidates(count, seed):
+    rng = np.random.default_rng(seed)
+    candidates = {}
+    for name, (low, high) in SEARCH_SPACE.items():
+        if name == 'inhale_blocks':
+            candidates[name] = rng.integers(low, high + 1, count)
+        else:
+            candidates[name] = rng.uniform(low, high, count)
+    return candidates
+
+
+def with_defaults(candidates):
+    """把 DEFAULT_THRESHOLDS 放在第 0 組，作為比較基準"""
+    return {name: np.concatenate(([DEFAULT_THRESHOLDS[name]], values)) for name, values in candidates.items()}
+
+
+# 子行程共用的特徵，由 initializer 傳入一次，之後每個任務只傳門檻
+_sessions = None
+
+
+def _init_worker(sessions):
+    global _sessions
+    _sessions = sessions
+
+
+def _evaluate(params):
+    """回傳每組門檻在每個錄製檔正確的視窗數 (C, S)"""
+    correct = np.empty((len(params['amp_min']), len(_sessions)), dtype=np.int64)
+    for i, session in enumerate(_sessions):
+        decisions = decide_batch(session['rms'], session['amp'], session['zcr'], params,
+                                 session['hops_per_block'])
+        correct[:, i] = np.count_nonzero(decisions == session['expected'][None, :], axis=1)
+    return correct
+
+
+def memory_plan(sessions, workers, memory_mb=MEMORY_BUDGET_MB):
+    """
+    依記憶體上限決定 (每次評估的門檻組數, 行程數)：所有行程同時評估最長的錄製檔也不超過 memory_mb
+    錄製檔長到每個行程只評估一組仍超過上限時減少行程數
+    """
+    per_candidate = BYTES_PER_CELL * max(max(session['rms'].size for session in sessions), 1)
+    budget = memory_mb * 2 ** 20
+    workers = int(np.clip(budget // per_candidate, 1, workers))
+    return int(np.clip(budget / workers // per_candidate, 1, CHUNK_SIZE)), workers
+
+
+def evaluate_all(sessions, candidates, workers, chunk_size=CHUNK_SIZE):
+    total = len(candidates['amp_min'])
+    chunks = [{name: values[start:start + chunk_size] for name, values in candidates.items()}
+              for start in range(0, total, chunk_size)]
+    if workers == 1:
+        _init_worker(sessions)
+        return np.concatenate([_evaluate(chunk) for chunk in chunks])
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(sessions,)) as pool:
+        return np.concatenate(list(pool.map(_evaluate, chunks)))
+
+
+def expand_paths(patterns):
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='以標註過的錄製檔離線調整呼吸判斷門檻')
+    parser.add_argument('recordings', nargs='+', help='錄製檔 (可用萬用字元)；標註檔為 <錄製檔>.labels.json')
+    parser.add_argument('--hop_ms', type=int, default=10, help='與模擬器相同的判斷間隔毫秒數 (預設 10)')
+    parser.add_argument('--search', choices=['grid', 'random'], default='random', help='搜尋方式 (預設 random)')
+    parser.add_argument('--samples', type=int, default=20000, help='random 搜尋的門檻組數 (預設 20000)')
+    parser.add_argument('--grid_steps', type=int, default=8, help='grid 搜尋每個浮點門檻的取值數 (預設 8)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='平行行程數 (預設 CPU 核心數)')
+    parser.add_argument('--refresh', action='store_true', help='忽略特徵快取重新計算')
+    parser.add_argument('--memory_mb', type=int, default=MEMORY_BUDGET_MB,
+                        help=f'所有行程合計的評估記憶體上限 MB (預設 {MEMORY_BUDGET_MB})')
+    parser.add_argument('--output', type=str, default=None,
+                        help='最佳門檻輸出檔，可直接給 breath_simulator_v2.py --thresholds 使用')
+    args = parser.parse_args()
+
+    sessions = []
+    names = []
+    for path in expand_paths(args.recordings):
+        if not os.path.exists(labels_path(path)):
+            print(f"⚠️ 略過 {path}: 找不到標註檔 {labels_path(path)}")
+            continue
+        features, hops_per_block = session_features(path, args.hop_ms, args.refresh)
+        features['expected'] = load_labels(labels_path(path), features.pop('times'))
+        features['hops_per_block'] = hops_per_block
+        sessions.append(features)
+        names.append(path)
+        print(f"📂 {path}: {features['rms'].size} 個視窗")
+    if not sessions:
+        print("❌ 沒有可用的標註錄製檔")
+        return 1
+
+    if args.search == 'grid':
+        candidates = grid_candidates(args.grid_steps)
+    else:
+        candidates = random_candidates(args.samples, args.seed)
+    candidates = with_defaults(candidates)
+    total = len(candidates['amp_min'])
+    chunk_size, workers = memory_plan(sessions, max(1, args.workers), args.memory_mb)
+    print(f"🔍 評估 {total} 組門檻，{workers} 個行程，每次 {chunk_size} 組")
+
+    started = time.perf_counter()
+    correct = evaluate_all(sessions, candidates, workers, chunk_size)
+    elapsed = time.perf_counter() - started
+
+    windows = np.array([session['rms'].size for session in sessions])
+    accuracy = correct.sum(axis=1) / windows.sum()
+    best = int(np.argmax(accuracy))
+    thresholds = {name: values[best].item() for name, values in candidates.items()}
+    thresholds['inhale_blocks'] = int(thresholds['inhale_blocks'])
+
+    print(f"⏱️ {elapsed:.2f} 秒 ({total / elapsed:.0f} 組/秒)")
+    print(f"📊 預設門檻正確率 {accuracy[0]:.1%}，最佳 {accuracy[best]:.1%}")
+    for name, value in thresholds.items():
+        print(f"  {name}: {value:.4g}")
+    per_session = correct[best] / windows
+    for name, value in zip(names, per_session):
+        print(f"  {name}: {value:.1%}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'thresholds': thresholds, 'accuracy': float(accuracy[best]),
+                       'default_accuracy': float(accuracy[0]),
+                       'sessions': dict(zip(names, per_session.tolist()))}, f, indent=2, ensure_ascii=False)
+        print(f"💾 已寫入 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+import numpy as np
+
+
+class SlidingWindow:
+    """
+    固定大小的 NumPy 環形緩衝區，以 hop 為單位滑動並增量更新特徵
+    window_size: 分析視窗長度（取樣數）
+    hop_size: 每次決策間隔（取樣數），必須整除 window_size
+    """
+
+    def __init__(self, window_size, hop_size):
+        if hop_size <= 0 or window_size % hop_size != 0:
+            raise ValueError(f"hop_size ({hop_size}) 必須整除 window_size ({window_size})")
+
+        self.window_size = window_size
+        self.hop_size = hop_size
+        self.n_hops = window_size // hop_size
+
+        # 資料寫兩份（鏡像），讓整個視窗永遠是連續的切片，不需要複製
+        self._data = np.zeros(2 * window_size)
+        self._pos = 0          # 下一個寫入位置，也是視窗中最舊的取樣
+        self._pending = 0      # 目前 hop 已累積的取樣數
+        self._filled = 0       # 已寫入的取樣總數（上限 window_size）
+        self.count = 0         # 累計寫入的取樣數；yield 時為視窗最後一筆取樣的序號 + 1
+
+        # 每個 hop 的部分統計量
+        self._hop_sq = np.zeros(self.n_hops)
+        self._hop_peak = np.zeros(self.n_hops)
+        self._hop_zc = np.zeros(self.n_hops, dtype=np.int64)
+        self._hop_edge = np.zeros(self.n_hops, dtype=bool)  # 與前一個 hop 交界是否過零
+        self._hop_index = 0
+
+        # 整個視窗的累計量
+        self._sum_sq = 0.0
+        self._zero_crossings = 0
+        self._last_sign = 0.0
+        self._has_last = False
+
+    @property
+    def ready(self):
+        """視窗是否已填滿"""
+        return self._filled >= self.window_size
+
+    def view(self):
+        """回傳目前視窗（由舊到新）的唯讀連續切片"""
+        window = self._data[self._pos:self._pos + self.window_size]
+        window.flags.writeable = False
+        return window
+
+    def features(self):
+        """回傳目前視窗的 (rms, amp, zcr)"""
+        rms = np.sqrt(max(self._sum_sq, 0.0) / self.window_size)
+        amp = self._hop_peak.max()
+        oldest = self._hop_index
+        crossings = self._zero_crossings - int(self._hop_edge[oldest])
+        zcr = crossings / (self.window_size - 1)
+        return rms, amp, zcr
+
+    def push(self, samples):
+        """
+        寫入新取樣；每湊滿一個 hop 且視窗已滿時產生一次 (rms, amp, zcr)
+        這是產生器，呼叫端在每次 yield 時可透過 view() 取得對應視窗，透過 count 對應到取樣時間戳
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        offset = 0
+        total = samples.size
+        while offset < total:
+            take = min(self.hop_size - self._pending, total - offset)
+            start = self._pos + self._pending
+            segment = samples[offset:offset + take]
+            self._data[start:start + take] = segment
+            self._data[start + self.window_size:start + self.window_size + take] = segment
+            self._pending += take
+            self.count += take
+            offset += take
+
+            if self._pending == self.hop_size:
+                self._complete_hop()
+                if self.ready:
+                    yield self.features()
+
+    def _complete_hop(self):
+        """把剛湊滿的 hop 併入視窗累計量，並淘汰最舊的 hop"""
+        block = self._data[self._pos:self._pos + self.hop_size]
+        signs = np.sign(block)
+
+        square = float(np.dot(block, block))
+        peak = float(np.max(np.abs(block)))
+        crossings = int(np.count_nonzero(signs[1:] != signs[:-1]))
+        edge = self._has_last and signs[0] != self._last_sign
+        crossings += int(edge)
+
+        k = self._hop_index
+        self._sum_sq += square - self._hop_sq[k]
+        self._zero_crossings += crossings - int(self._hop_zc[k])
+        self._hop_sq[k] = square
+        self._hop_peak[k] = peak
+        self._hop_zc[k] = crossings
+        self._hop_edge[k] = edge
+
+        self._last_sign = signs[-1]
+        self._has_last = True
+        self._hop_index = (k + 1) % self.n_hops
+        if self._hop_index == 0:
+            # 每繞一圈重新加總，避免浮點累計誤差
+            self._sum_sq = float(self._hop_sq.sum())
+
+        self._pos = (self._pos + self.hop_size) % self.window_size
+        self._pending = 0
+        self._filled = min(self._filled + self.hop_size, self.window_size)
+
+
+class MultiChannelWindow:
+    """
+    多通道的環形緩衝區 (channels, 2 * window_size)，各通道以 hop 為單位獨立前進
+    寫入及取出視窗都以索引陣列一次處理多個通道
+    """
+
+    def __init__(self, channels, window_size, hop_size):
+        if hop_size <= 0 or window_size % hop_size != 0:
+            raise ValueError(f"hop_size ({hop_size}) 必須整除 window_size ({window_size})")
+
+        self.channels = channels
+        self.window_size = window_size
+        self.hop_size = hop_size
+        # 與 SlidingWindow 相同寫兩份，每個通道的視窗都是 [pos, pos + window_size)
+        self._data = np.zeros((channels, 2 * window_size))
+        self._pos = np.zeros(channels, dtype=np.int64)
+        self._filled = np.zeros(channels, dtype=np.int64)
+        self._window_offsets = np.arange(window_size)
+        self._hop_offsets = np.arange(hop_size)
+
+    def push_hops(self, rows, blocks):
+        """rows: 通道編號 (K,)；blocks: 各通道的一個 hop 取樣 (K, hop_size)"""
+        cols = self._pos[rows, None] + self._hop_offsets
+        self._data[rows[:, None], cols] = blocks
+        self._data[rows[:, None], cols + self.window_size] = blocks
+        self._pos[rows] = (self._pos[rows] + self.hop_size) % self.window_size
+        self._filled[rows] = np.minimum(self._filled[rows] + self.hop_size, self.window_size)
+
+    def ready(self, rows):
+        """各通道視窗是否已填滿"""
+        return self._filled[rows] >= self.window_size
+
+    def views(self, rows):
+        """回傳各通道目前視窗（由舊到新）堆疊成的 (K, window_size) 陣列"""
+        return self._data[rows[:, None], self._pos[rows, None] + self._window_offsets]
+
+
+def batch_features(windows):
+    """對堆疊的視窗 (K, window_size) 一次計算 (rms, amp, zcr)"""
+    size = windows.shape[1]
+    rms = np.sqrt(np.einsum('ij,ij->i', windows, windows) / size)
+    amp = np.abs(windows).max(axis=1)
+    signs = np.sign(windows)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (size - 1)
+    return rms, amp, zcr
+
+
+def hop_samples(samplerate, window_size, hop_ms):
+    """
+    把 hop 毫秒數換算成取樣數；必須整除視窗長度，取最接近要求間隔的因數（一樣近時取較短的）
+    實際間隔可能與要求不同，呼叫端應顯示實際使用的間隔
+    """
+    requested = samplerate * hop_ms / 1000
+    return min((h for h in range(1, window_size + 1) if window_size % h == 0),
+               key=lambda h: (abs(h - requested), h))
+
+
+def window_features(samples, window_size, hop_size):
+    """
+    一次計算整段訊號所有 hop 位置視窗的 (rms, amp, zcr)，結果與 SlidingWindow 逐步產生的相同
+    回傳三個陣列，第 k 個視窗結束於第 window_size + k * hop_size 筆取樣
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.size < window_size:
+        empty = np.empty(0)
+        return empty, empty, empty
+    starts = np.arange(0, samples.size - window_size + 1, hop_size)
+
+    squares = np.concatenate(([0.0], np.cumsum(samples ** 2)))
+    rms = np.sqrt(np.maximum(squares[starts + window_size] - squares[starts], 0.0) / window_size)
+
+    windows = np.lib.stride_tricks.sliding_window_view(np.abs(samples), window_size)[::hop_size]
+    amp = windows.max(axis=1)
+
+    signs = np.sign(samples)
+    crossings = np.concatenate(([0], np.cumsum(signs[1:] != signs[:-1])))
+    zcr = (crossings[starts + window_size - 1] - crossings[starts]) / (window_size - 1)
+    return rms, amp, zcr
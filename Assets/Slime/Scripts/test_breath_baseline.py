@@ -0,0 +1,78 @@
+import json
+import math
+import numpy as np
+import pytest
+from breath_baseline import AdaptiveBaseline
+
+
+def seed(calibration, value=2000, n=200):
+    return calibration.feed(np.full(n, value, dtype=np.int32))
+
+
+def test_seed_then_normalize():
+    calibration = AdaptiveBaseline(seed_samples=200, cache_path=None)
+    assert calibration.feed(np.full(150, 2000, dtype=np.int32)).size == 0
+    assert not calibration.ready
+    # 湊滿初始校正後，同一批剩下的取樣直接正規化
+    norm = calibration.feed(np.array([2000] * 50 + [2000 + 4095, 2000 - 4095 * 2]))
+    assert calibration.seeded and calibration.adc_range == 1023
+    assert calibration.baseline == 2000.0
+    np.testing.assert_allclose(norm, [1.0, -1.0])
+
+
+def test_detects_12_bit_adc():
+    calibration = AdaptiveBaseline(seed_samples=10, cache_path=None)
+    calibration.feed(np.array([2000] * 9 + [3000]))
+    assert calibration.adc_range == 4095
+
+
+def test_tracks_drift_with_time_constant():
+    calibration = AdaptiveBaseline(seed_samples=200, tau=10.0, cache_path=None)
+    seed(calibration, 2000)
+    # 基準值漂移到 2100：安靜視窗的平均偏差持續回饋，一個時間常數後追上約 63%
+    target = 2100.0
+    for _ in range(1000):
+        offset = (target - calibration.baseline) / calibration.adc_range
+        calibration.track(offset, 0.01)
+    assert calibration.baseline == pytest.approx(2000 + 100 * (1 - math.exp(-1)), rel=1e-6)
+    assert calibration.drift == pytest.approx(calibration.baseline - 2000)
+    for _ in range(10000):
+        calibration.track((target - calibration.baseline) / calibration.adc_range, 0.01)
+    assert calibration.baseline == pytest.approx(target, abs=0.01)
+
+
+def test_track_before_seed_is_ignored():
+    calibration = AdaptiveBaseline(cache_path=None)
+    calibration.track(0.5, 1.0)
+    assert (calibration.baseline, calibration.drift) == (0.0, 0.0)
+
+
+def test_cache_round_trip_per_device(tmp_path):
+    path = str(tmp_path / 'cache' / 'adc_calibration.json')
+    first = AdaptiveBaseline(seed_samples=10, cache_path=path, device='10.0.0.2:8080')
+    assert not first.cached
+    seed(first, 3000, 10)
+    first.track(0.01, 10.0)
+    first.save()
+
+    other = AdaptiveBaseline(seed_samples=10, cache_path=path, device='10.0.0.3:8080')
+    assert not other.cached and not other.ready
+
+    again = AdaptiveBaseline(seed_samples=10, cache_path=path, device='10.0.0.2:8080')
+    assert again.cached and again.ready
+    assert (again.adc_range, again.baseline) == (4095, first.baseline)
+    # 有快取時初始校正期間也立刻正規化，完成後改用新的基準值，但不重新判斷 ADC 位元數
+    norm = again.feed(np.full(10, 1000, dtype=np.int32))
+    np.testing.assert_allclose(norm, (1000 - first.baseline) / 4095)
+    assert again.seeded and (again.baseline, again.adc_range) == (1000.0, 4095)
+    with open(path, encoding='utf-8') as f:
+        assert set(json.load(f)) == {'10.0.0.2:8080'}
+
+
+def test_corrupt_cache_is_ignored(tmp_path):
+    path = tmp_path / 'adc_calibration.json'
+    path.write_text('{not json')
+    calibration = AdaptiveBaseline(seed_samples=10, cache_path=str(path), device='esp32')
+    assert not calibration.cached
+    seed(calibration, 500, 10)
+    assert json.loads(path.read_text())['esp32']['adc_range'] == 1023
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+from breath_clock import ClockSync, SampleClock
+
+RATE = 500
+
+
+def test_first_batch_ends_at_arrival():
+    clock = SampleClock(RATE)
+    stamps = clock.stamp(5, 10.0)
+    np.testing.assert_allclose(stamps, 10.0 - np.arange(4, -1, -1) / RATE)
+    assert (clock.last, clock.delay, clock.count) == (10.0, 0.0, 5)
+    assert clock.stamp(0, 11.0).size == 0
+
+
+def test_late_batches_are_not_pushed_forward():
+    """Wi-Fi 緩衝後一次到達的批次仍以取樣率排列，延遲記在 delay"""
+    clock = SampleClock(RATE)
+    clock.stamp(50, 1.0)
+    late = clock.stamp(50, 1.5)
+    # 最多以 (1 + slew) 倍取樣率追趕
+    np.testing.assert_allclose(np.diff(late), (1 + clock.slew) / RATE)
+    assert late[-1] == pytest.approx(1.0 + 50 * (1 + clock.slew) / RATE)
+    assert clock.delay == pytest.approx(1.5 - late[-1])
+
+
+def test_early_batches_are_pulled_back_to_arrival():
+    clock = SampleClock(RATE)
+    clock.stamp(50, 1.0)
+    early = clock.stamp(50, 1.05)  # 50 筆應需 0.1 秒
+    assert early[-1] == 1.05 and clock.delay == 0.0
+    np.testing.assert_allclose(np.diff(early), 0.05 / 50)
+
+
+def test_stamps_are_monotonic_with_jitter():
+    rng = np.random.default_rng(0)
+    clock = SampleClock(RATE)
+    stamps = []
+    t = arrival = 0.0
+    for _ in range(300):
+        n = int(rng.integers(1, 40))
+        t += n / RATE
+        arrival = max(arrival, t + rng.exponential(0.02))  # 到達時間本身單調
+        stamps.append(clock.stamp(n, arrival))
+        assert stamps[-1][-1] <= arrival
+    stamps = np.concatenate(stamps)
+    assert (np.diff(stamps) >= 0).all()
+    assert stamps.size == clock.count
+
+
+def test_lost_samples_skip_time():
+    clock = SampleClock(RATE)
+    clock.stamp(10, 1.0)
+    stamps = clock.stamp(10, 1.04, lost=10)
+    assert stamps.size == 10
+    assert stamps[0] == pytest.approx(1.0 + 11 * 0.02 / 10)
+    assert clock.count == 30
+
+
+def test_rate_is_estimated_after_rate_span():
+    clock = SampleClock(RATE, rate_span=2.0)
+    actual = 490.0
+    for i in range(1, 401):
+        clock.stamp(10, i * 10 / actual)
+    assert clock.rate == pytest.approx(actual, rel=1e-3)
+    assert clock.nominal_rate == RATE
+
+
+def exchange(sync, t0, offset, up, down, processing=0.001):
+    """模擬一次 ping/pong：遠端時脈 = 本地 + offset，up/down 為單程延遲"""
+    ping_id = sync.begin(t0)
+    t1 = t0 + up + offset
+    t2 = t1 + processing
+    t3 = t2 - offset + down
+    return sync.complete(t1, t2, t3, ping_id)
+
+
+def test_clock_sync_offset_and_rtt():
+    sync = ClockSync()
+    assert exchange(sync, 100.0, offset=-42.0, up=0.01, down=0.01)
+    assert sync.offset == pytest.approx(-42.0)
+    assert sync.rtt == pytest.approx(0.02)
+    assert sync.to_remote(100.0) == pytest.approx(58.0)
+    assert sync.to_local(58.0) == pytest.approx(100.0)
+    assert sync.exchanges == 1
+
+
+def test_clock_sync_keeps_min_rtt_offset():
+    """不對稱的排隊延遲使 offset 偏差，保留 RTT 最小的一次"""
+    sync = ClockSync(history=3)
+    exchange(sync, 0.0, offset=5.0, up=0.002, down=0.002)
+    exchange(sync, 2.0, offset=5.0, up=0.2, down=0.002)
+    assert sync.rtt == pytest.approx(0.202)
+    assert sync.min_rtt == pytest.approx(0.004)
+    assert sync.offset == pytest.approx(5.0)
+    # 最佳的一次超出 history 之後改用剩下中最好的
+    exchange(sync, 4.0, offset=5.0, up=0.05, down=0.01)
+    exchange(sync, 6.0, offset=5.0, up=0.1, down=0.01)
+    assert sync.min_rtt == pytest.approx(0.06)
+    assert sync.offset == pytest.approx(5.02)
+
+
+def test_clock_sync_schedule_and_timeout():
+    sync = ClockSync(interval=2.0, timeout=1.0)
+    assert sync.due(0.0)
+    ping_id = sync.begin(0.0)
+    assert not sync.due(0.5)
+    assert sync.time_until_due(0.5) == pytest.approx(0.5)
+    # 逾時視為遺失，之後的 pong 被忽略
+    assert not sync.due(1.5)
+    assert sync.lost == 1
+    assert sync.time_until_due(1.5) == pytest.approx(0.5)
+    assert sync.due(2.0)
+    assert not sync.complete(1.0, 1.0, 2.0, ping_id)
+    assert sync.offset is None
+
+
+def test_clock_sync_ignores_mismatched_id():
+    sync = ClockSync()
+    ping_id = sync.begin(0.0)
+    assert not sync.complete(0.1, 0.1, 0.2, (ping_id + 1) & 0xFFFF)
+    assert sync.complete(0.1, 0.1, 0.2, ping_id)
+    assert sync.offset == pytest.approx(0.0)
+    assert not sync.complete(0.1, 0.1, 0.2)
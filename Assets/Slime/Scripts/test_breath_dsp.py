@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from breath_dsp import SharedRing
+
+
+@pytest.fixture
+def ring():
+    ring = SharedRing(8, 2, counters=('samples',))
+    yield ring
+    ring.close()
+
+
+def rows(start, n):
+    return np.column_stack((np.arange(start, start + n), -np.arange(start, start + n))).astype(np.float64)
+
+
+def test_put_get_wraps_around(ring):
+    total = 0
+    for n in (3, 5, 7, 1, 8, 6):
+        assert ring.put(rows(total, n)) == n
+        assert ring.qsize() == n
+        np.testing.assert_array_equal(ring.get(), rows(total, n))
+        total += n
+    assert ring.qsize() == 0 and ring.dropped == 0
+    assert ring.get().shape == (0, 2)
+
+
+def test_reader_falling_behind_drops_newest(ring):
+    assert ring.put(rows(0, 5)) == 5
+    # 讀取端沒有跟上：只寫入剩下的空間，較新的資料丟棄並計數
+    assert ring.put(rows(5, 6)) == 3
+    assert ring.dropped == 3
+    assert ring.put(rows(11, 1)) == 0
+    assert ring.dropped == 4
+    np.testing.assert_array_equal(ring.get(), rows(0, 8))
+    # 讀取後可以繼續寫入，位置跨過緩衝區結尾
+    assert ring.put(rows(20, 4)) == 4
+    np.testing.assert_array_equal(ring.get(), rows(20, 4))
+    assert ring.dropped == 4
+
+
+def test_attached_ring_shares_data_and_counters(ring):
+    reader = SharedRing.attach(ring.spec)
+    try:
+        assert not reader.owner
+        ring.put(rows(0, 6))
+        ring.set('samples', 1234)
+        np.testing.assert_array_equal(reader.get(), rows(0, 6))
+        assert reader.counter('samples') == 1234
+        # 讀取位置也是共享的
+        assert ring.qsize() == 0
+        ring.put(rows(6, 4))
+        np.testing.assert_array_equal(reader.get(), rows(6, 4))
+    finally:
+        reader.close()
+
+
+def test_put_accepts_flat_rows(ring):
+    assert ring.put([1.0, 2.0, 3.0, 4.0]) == 2
+    np.testing.assert_array_equal(ring.get(), [[1.0, 2.0], [3.0, 4.0]])
@@ -0,0 +1,172 @@
+import json
+import selectors
+import socket
+import time
+import pytest
+from breath_fanout import UnityHub
+from breath_simulator_v2 import BreathSimulatorV2
+
+
+class Events:
+    """記錄 UnityHub 的回呼"""
+
+    def __init__(self):
+        self.connected = []
+        self.messages = []
+        self.disconnected = []
+
+    def hub(self, **kwargs):
+        return UnityHub('127.0.0.1', 0, on_connect=self.connected.append,
+                        on_message=lambda subscriber, message, received: self.messages.append((subscriber, message)),
+                        on_disconnect=lambda subscriber, was_controller: self.disconnected.append(
+                            (subscriber, was_controller)),
+                        log=lambda text: None, **kwargs)
+
+
+@pytest.fixture
+def selector():
+    selector = selectors.DefaultSelector()
+    yield selector
+    selector.close()
+
+
+def start(hub, selector):
+    hub.listen()
+    hub.attach(selector)
+    return hub.server.getsockname()[1]
+
+
+def pump(selector, until, timeout=2.0):
+    """執行事件迴圈直到 until() 成立"""
+    deadline = time.monotonic() + timeout
+    while not until():
+        assert time.monotonic() < deadline, "等待逾時"
+        for key, _ in selector.select(0.01):
+            key.data(key.fileobj)
+
+
+def connect(hub, selector, port, count, rcvbuf=None):
+    clients = []
+    for _ in range(count):
+        client = socket.socket()
+        if rcvbuf:
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        client.connect(('127.0.0.1', port))
+        clients.append(client)
+        expected = len(hub.subscribers) + 1
+        pump(selector, lambda: len(hub.subscribers) == expected)
+    return clients
+
+
+def test_controller_promotion(selector):
+    events = Events()
+    hub = events.hub()
+    port = start(hub, selector)
+    clients = connect(hub, selector, port, 3)
+    first, second, third = hub.subscribers
+    assert hub.controller is first and events.connected == [first, second, third]
+
+    clients[1].close()  # 非控制端離線不影響控制端
+    pump(selector, lambda: len(hub.subscribers) == 2)
+    assert events.disconnected == [(second, False)] and hub.controller is first
+
+    clients[0].close()
+    pump(selector, lambda: len(hub.subscribers) == 1)
+    assert events.disconnected[-1] == (first, True) and hub.controller is third
+
+    # 之後的新連線排在後面，不會取代控制端
+    clients += connect(hub, selector, port, 1)
+    assert hub.controller is third
+    for client in clients:
+        client.close()
+    hub.close_all()
+
+
+def test_rejects_clients_over_limit(selector):
+    events = Events()
+    hub = events.hub(max_clients=2)
+    port = start(hub, selector)
+    clients = connect(hub, selector, port, 2)
+    extra = socket.create_connection(('127.0.0.1', port))
+    pump(selector, lambda: hub.rejected == 1)
+    extra.settimeout(1.0)
+    assert extra.recv(1) == b''
+    assert len(hub.subscribers) == 2
+    for client in clients + [extra]:
+        client.close()
+    hub.close_all()
+
+
+def test_slow_client_is_dropped_without_stalling_others(selector):
+    events = Events()
+    hub = events.hub(max_pending=64 * 1024)
+    port = start(hub, selector)
+    fast, = connect(hub, selector, port, 1)
+    slow, = connect(hub, selector, port, 1, rcvbuf=4096)
+    hub.subscribers[1].sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    fast.setblocking(False)
+
+    chunk = b'x' * 16383 + b'\n'
+    received = bytearray()
+    sent = 0
+    while hub.slow_dropped == 0:
+        assert sent < 200, "慢速連線沒有被中斷"
+        assert hub.broadcast(chunk) >= 1
+        sent += 1
+        # 快速訂閱者持續讀取，事件迴圈送出它的暫存資料
+        for key, _ in selector.select(0):
+            key.data(key.fileobj)
+        try:
+            received += fast.recv(1 << 20)
+        except BlockingIOError:
+            pass
+
+    assert events.disconnected[0][0].address[1] == slow.getsockname()[1]
+    assert [subscriber.address[1] for subscriber in hub.subscribers] == [fast.getsockname()[1]]
+    pump(selector, lambda: not hub.subscribers[0].pending)
+    fast.setblocking(True)
+    fast.settimeout(1.0)
+    while len(received) < sent * len(chunk):
+        received += fast.recv(1 << 20)
+    assert bytes(received) == chunk * sent
+    fast.close()
+    slow.close()
+    hub.close_all()
+
+
+def read_messages(client, count):
+    client.settimeout(1.0)
+    data = b''
+    while data.count(b'\n') < count:
+        data += client.recv(65536)
+    return [json.loads(line) for line in data.splitlines()]
+
+
+def test_only_controller_character_state_is_accepted(selector):
+    simulator = BreathSimulatorV2(mode='unity_control', unity_port=0)
+    simulator.unity = UnityHub('127.0.0.1', 0, on_connect=simulator.on_unity_connect,
+                               on_message=simulator.on_unity_message, on_disconnect=simulator.on_unity_disconnect,
+                               log=lambda text: None)
+    port = start(simulator.unity, selector)
+    controller, viewer = connect(simulator.unity, selector, port, 2)
+    assert read_messages(controller, 1)[0]['controller'] is True
+    assert read_messages(viewer, 1)[0]['controller'] is False
+
+    viewer.sendall(b'{"type":"character_state","state":"enlarged"}\n')
+    pump(selector, lambda: simulator.metrics.counters.get('unity_control_rejected') == 1)
+    assert simulator.unity_character_state != 'enlarged' and not simulator.pump_is_on
+
+    controller.sendall(b'{"type":"character_state","state":"enlarged"}\n')
+    pump(selector, lambda: simulator.unity_character_state == 'enlarged')
+    assert simulator.pump_is_on
+
+    # 控制端離線後由觀眾畫面接手，並收到新的模式資訊
+    controller.close()
+    pump(selector, lambda: len(simulator.unity.subscribers) == 1)
+    assert read_messages(viewer, 1)[0]['controller'] is True
+    viewer.sendall(b'{"type":"character_state","state":"normal"}\n')
+    pump(selector, lambda: simulator.unity_character_state == 'normal')
+    assert not simulator.pump_is_on
+    viewer.close()
+    simulator.unity.close_all()
+    simulator.console.close()
@@ -0,0 +1,208 @@
+import socket
+import timeit
+import numpy as np
+import pytest
+from breath_ingest import (ACK_SYNC, BINARY_REQUEST, PACKET_DTYPE, PACKET_SAMPLES, PACKET_SIZE, PACKET_SYNC,
+                           SMALL_CHUNK_BYTES, TIME_SYNC, AdcPacketReader, AdcStreamReader, _parse_lines_scalar,
+                           _parse_lines_vectorized, open_adc_reader, parse_adc_lines)
+
+PARSERS = {
+    'scalar': lambda chunk: _parse_lines_scalar(chunk.tobytes()),
+    'vectorized': _parse_lines_vectorized,
+}
+
+
+@pytest.fixture(params=sorted(PARSERS))
+def parse(request):
+    """逐行及向量化兩種解析都要與 int() 相同"""
+    def parse(data):
+        values, malformed = PARSERS[request.param](np.frombuffer(data, dtype=np.uint8))
+        return values.tolist(), malformed
+    return parse
+
+
+def baseline_parse(data):
+    """改寫前逐行 int() 的解析方式"""
+    return [int(line) for line in data.split(b'\n')[:-1] if line.strip()]
+
+
+def test_parse_plain_and_crlf(parse):
+    assert parse(b'0\n4095\r\n123\n') == ([0, 4095, 123], 0)
+
+
+@pytest.mark.parametrize('line, value', [
+    (b' 456\n', 456),
+    (b'789 \r\n', 789),
+    (b'\t12\n', 12),
+    (b'+7\n', 7),
+    (b'-3\n', -3),
+    (b'  0012 \t\r\n', 12),
+])
+def test_parse_accepts_what_int_accepts(parse, line, value):
+    assert parse(line) == ([value], 0)
+
+
+def test_parse_blank_lines_are_skipped(parse):
+    assert parse(b'\n \r\n\t\n5\n') == ([5], 0)
+
+
+@pytest.mark.parametrize('line', [b'ab\n', b'1 2\n', b'+\n', b'-\n', b'+-1\n', b'1234567\n', b'0000012\n', b'1_0\n',
+                                  b'12x\r\n'])
+def test_parse_malformed(parse, line):
+    assert parse(line) == ([], 1)
+
+
+def test_parse_matches_int(parse):
+    """隨機資料與逐行 int() 的結果相同"""
+    rng = np.random.default_rng(0)
+    alphabet = np.frombuffer(b'0123456789 \t\r+-x', dtype=np.uint8)
+    for _ in range(500):
+        lines = [bytes(rng.choice(alphabet, rng.integers(0, 8))) for _ in range(rng.integers(1, 6))]
+        expected, malformed = [], 0
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                if len(line.strip().lstrip(b'+-')) > 6:
+                    raise ValueError
+                expected.append(int(line))
+            except ValueError:
+                malformed += 1
+        assert parse(b'\n'.join(lines) + b'\n') == (expected, malformed)
+
+
+def test_parse_dispatches_by_chunk_size():
+    for n in (1, SMALL_CHUNK_BYTES // 6, SMALL_CHUNK_BYTES // 6 + 1, 1000):
+        data = b'2048\r\n' * (n - 1) + b' 7\n'
+        values, malformed = parse_adc_lines(np.frombuffer(data, dtype=np.uint8))
+        assert values.tolist() == baseline_parse(data) and malformed == 0
+
+
+def test_small_chunks_are_not_much_slower_than_int():
+    """事件迴圈每次通常只讀到幾行；逐行路徑不應比原本的 int() 慢一個數量級"""
+    for n in (1, 5, 50):
+        data = b'2048\r\n' * n
+        chunk = np.frombuffer(data, dtype=np.uint8)
+        ours = min(timeit.repeat(lambda: parse_adc_lines(chunk), number=200, repeat=5))
+        baseline = min(timeit.repeat(lambda: baseline_parse(data), number=200, repeat=5))
+        assert ours < 10 * baseline, f"{n} 行: {ours / 200 * 1e6:.1f} µs vs int() {baseline / 200 * 1e6:.1f} µs"
+
+
+def test_stream_reader_joins_split_lines():
+    a, b = socket.socketpair()
+    with a, b:
+        reader = AdcStreamReader(b, recv_size=8)
+        a.sendall(b'100\r\n20')
+        assert reader.read().tolist() == [100]
+        a.sendall(b'0\n 3')
+        assert reader.read().tolist() == [200]
+        a.sendall(b'\n')
+        assert reader.read().tolist() == [3]
+        a.close()
+        assert reader.read().size == 0
+        assert reader.closed
+        assert reader.samples_received == 3 and reader.malformed_samples == 0
+
+
+# === 二進位取樣封包 ===
+
+def packet(seq, samples=None, sync=PACKET_SYNC):
+    record = np.zeros(1, dtype=PACKET_DTYPE)
+    record['sync'] = sync
+    record['seq'] = seq
+    record['samples'] = np.arange(seq * PACKET_SAMPLES, (seq + 1) * PACKET_SAMPLES) & 0xFFF \
+        if samples is None else samples
+    return record.tobytes()
+
+
+def time_packet(reply, t1, t2):
+    words = [t1 & 0xFFFF, t1 >> 16, t2 & 0xFFFF, t2 >> 16] + [0] * (PACKET_SAMPLES - 4)
+    return packet(reply, words, TIME_SYNC)
+
+
+def feed(reader, data, step):
+    values = []
+    for start in range(0, len(data), step):
+        chunk = data[start:start + step]
+        reader._view[reader._carry:reader._carry + len(chunk)] = chunk
+        values.append(reader.feed(len(chunk)))
+    return np.concatenate(values).tolist()
+
+
+def expected_samples(seqs):
+    return [v & 0xFFF for seq in seqs for v in range(seq * PACKET_SAMPLES, (seq + 1) * PACKET_SAMPLES)]
+
+
+@pytest.mark.parametrize('step', [1, 7, PACKET_SIZE, PACKET_SIZE + 5, 4096])
+def test_packet_reader_any_split(step):
+    reader = AdcPacketReader(None, recv_packets=4)
+    data = b''.join(packet(seq) for seq in range(20))
+    assert feed(reader, data, min(step, reader.recv_size)) == expected_samples(range(20))
+    assert (reader.lost_samples, reader.sequence_gaps, reader.malformed_samples) == (0, 0, 0)
+
+
+def test_packet_reader_resyncs_after_garbage():
+    reader = AdcPacketReader(None)
+    # 開頭及封包之間的雜訊，以及整個遺失的封包 2
+    data = b'\x01\x02\x03' + packet(0) + b'\xff' * 5 + packet(1) + packet(3)
+    assert feed(reader, data, len(data)) == expected_samples([0, 1, 3])
+    assert reader.malformed_samples == 2
+    assert (reader.sequence_gaps, reader.lost_samples) == (1, PACKET_SAMPLES)
+
+
+def test_packet_reader_sequence_gaps_and_wraparound():
+    reader = AdcPacketReader(None)
+    seqs = [65533, 65534, 65535, 0, 1, 5, 6]
+    data = b''.join(packet(seq, np.zeros(PACKET_SAMPLES)) for seq in seqs)
+    assert len(feed(reader, data[:3 * PACKET_SIZE], PACKET_SIZE)) == 3 * PACKET_SAMPLES
+    # 跨批次延續序號
+    feed(reader, data[3 * PACKET_SIZE:], PACKET_SIZE)
+    assert reader.sequence_gaps == 1
+    assert reader.lost_samples == 3 * PACKET_SAMPLES
+
+
+def test_packet_reader_control_packets():
+    reader = AdcPacketReader(None)
+    data = packet(0) + packet(ord('s'), sync=ACK_SYNC) + time_packet(0, 1000, 1500) + packet(1)
+    assert feed(reader, data, 11) == expected_samples([0, 1])
+    assert reader.acks == ['s']
+    assert reader.time_replies == [(0.001, 0.0015, 0)]
+    assert reader.sequence_gaps == 0
+
+
+def test_packet_reader_unwraps_micros():
+    reader = AdcPacketReader(None)
+    near_wrap = (1 << 32) - 100
+    data = time_packet(0, near_wrap, 50) + time_packet(1, 200, 300) + time_packet(2, 1 << 31, (1 << 31) + 1)
+    feed(reader, data, len(data))
+    t1s = [t1 for t1, _, _ in reader.time_replies]
+    t2s = [t2 for _, t2, _ in reader.time_replies]
+    wrap = (1 << 32) / 1e6
+    assert t1s[0] == pytest.approx(near_wrap / 1e6)
+    assert t2s[0] == pytest.approx(wrap + 50e-6)
+    assert t1s[1] == pytest.approx(wrap + 200e-6)
+    assert t2s[2] == pytest.approx(wrap + ((1 << 31) + 1) / 1e6)
+    assert sorted(t1s) == t1s
+
+
+def test_open_adc_reader_negotiates_binary():
+    a, b = socket.socketpair()
+    with a, b:
+        # 協商前仍在送 ASCII，BIN1 之後的封包要保留
+        a.sendall(b'12\n34\nBIN1\n' + packet(0) + packet(1)[:10])
+        reader = open_adc_reader(b, timeout=1.0)
+        assert a.recv(1) == BINARY_REQUEST
+        assert reader.format == 'binary'
+        a.sendall(packet(1)[10:])
+        assert reader.read().tolist() == expected_samples([1])
+        assert reader.samples_received == 2 * PACKET_SAMPLES
+
+
+def test_open_adc_reader_falls_back_to_ascii():
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(b'12\n34\n5')
+        reader = open_adc_reader(b, timeout=0.1)
+        assert reader.format == 'ascii'
+        a.sendall(b'6\n')
+        assert reader.read().tolist() == [56]
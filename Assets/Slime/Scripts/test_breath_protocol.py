@@ -0,0 +1,150 @@
+import math
+import threading
+from breath_protocol import (BREATH_UPDATE, BREATH_UPDATE_V1, FRAME_HEADER, FRAME_MARKER, KIND_BREATH_UPDATE, FrameDecoder,
+                             OutboundQueue, breath_update_message, encode_message, encode_messages, encode_telemetry)
+
+UPDATE = {'type': 'breath_update', 'state': 'likely_INHALE', 'source': 'breath_detection', 'timestamp': 12.5,
+          'window_time': 100.25, 'decision_time': 100.5}
+MODE = {'type': 'mode_setup', 'mode': 'breath_detection', 'description': '真實呼吸檢測'}
+
+
+def feed_bytewise(decoder, data):
+    messages = []
+    for i in range(len(data)):
+        messages.extend(decoder.feed(data[i:i + 1]))
+    return messages
+
+
+def test_json_and_binary_round_trip():
+    data = encode_messages([MODE, UPDATE, {'type': 'pong'}], binary=True)
+    assert data[len(encode_message(MODE))] == FRAME_MARKER
+    assert FrameDecoder().feed(data) == [MODE, UPDATE, {'type': 'pong'}]
+
+
+def test_partial_frames_split_at_every_byte():
+    """拆成單一位元組送入 (包含多位元組 UTF-8 字元及二進位 header 被切斷)"""
+    telemetry = encode_telemetry(2, 1.5, 3.0, 0.25, 7.0)
+    data = encode_messages([MODE, UPDATE], binary=True) + telemetry + encode_message(UPDATE)
+    decoder = FrameDecoder()
+    messages = feed_bytewise(decoder, data)
+    assert messages[:2] == [MODE, UPDATE]
+    assert messages[2]['type'] == 'telemetry' and messages[2]['state'] == 'likely_EXHALE'
+    assert messages[3] == UPDATE
+    assert decoder.errors == 0
+
+
+def test_legacy_json_without_newline():
+    """舊版Unity連續送出 JSON 物件而不換行"""
+    decoder = FrameDecoder()
+    assert decoder.feed(b'{"type":"ping"}{"type":"char') == [{'type': 'ping'}]
+    assert decoder.feed(b'acter_state","state":"inhale"}') == [{'type': 'character_state', 'state': 'inhale'}]
+
+
+def test_legacy_binary_breath_update():
+    payload = BREATH_UPDATE_V1.pack(1, 0, 3.0)
+    frame = FRAME_HEADER.pack(FRAME_MARKER, KIND_BREATH_UPDATE, len(payload)) + payload
+    assert FrameDecoder().feed(frame) == [{'type': 'breath_update', 'state': 'likely_INHALE', 'source': 'keyboard',
+                                           'timestamp': 3.0}]
+
+
+def test_missing_times_encode_as_nan_and_are_omitted():
+    message = {k: UPDATE[k] for k in ('type', 'state', 'source', 'timestamp')}
+    data = encode_message(message, binary=True)
+    _, _, _, window_time, decision_time = BREATH_UPDATE.unpack_from(data, FRAME_HEADER.size)
+    assert math.isnan(window_time) and math.isnan(decision_time)
+    assert FrameDecoder().feed(data) == [message]
+
+
+def test_breath_update_message_carries_window_and_decision_time():
+    message = breath_update_message('likely_EXHALE', 'breath_detection', (100.25, 100.5))
+    assert (message['window_time'], message['decision_time']) == (100.25, 100.5)
+    assert FrameDecoder().feed(encode_message(message, binary=True)) == [message]
+    now = breath_update_message('undecided', 'keyboard')
+    assert now['window_time'] == now['decision_time']
+
+
+def test_invalid_json_is_counted_and_skipped():
+    decoder = FrameDecoder()
+    assert decoder.feed(b'{"type": oops}\n[1, 2]\n\xff\xfe\n{"type":"ping"}\n') == [{'type': 'ping'}]
+    assert decoder.errors == 3
+
+
+def test_invalid_binary_frame_is_counted_and_skipped():
+    bad_state = FRAME_HEADER.pack(FRAME_MARKER, KIND_BREATH_UPDATE, 10) + bytes([9, 0]) + bytes(8)
+    unknown_kind = FRAME_HEADER.pack(FRAME_MARKER, 99, 2) + b'\x00\x00'
+    decoder = FrameDecoder()
+    assert decoder.feed(bad_state + unknown_kind + b'{"type":"ping"}\n') == [{'type': 'ping'}]
+    assert decoder.errors == 2
+
+
+def test_max_buffer_discards_unterminated_data():
+    decoder = FrameDecoder(max_buffer=64)
+    assert decoder.feed(b'{"type":"x","pad":"' + b'a' * 100) == []
+    assert decoder.errors == 1
+    # 丟棄後可以繼續接收完整的消息
+    assert decoder.feed(b'{"type":"ping"}\n') == [{'type': 'ping'}]
+
+
+def test_max_buffer_waits_for_declared_binary_length():
+    decoder = FrameDecoder(max_buffer=64)
+    header = FRAME_HEADER.pack(FRAME_MARKER, KIND_BREATH_UPDATE, 200)
+    assert decoder.feed(header + bytes(100)) == []
+    assert decoder.errors == 1
+
+
+def test_outbound_queue_coalesces_state_and_bounds_control():
+    queue = OutboundQueue(max_control=2)
+    for i in range(3):
+        queue.put({'type': 'breath_update', 'n': i})
+        queue.put({'type': 'pong', 'n': i})
+    assert queue.qsize() == 3
+    assert queue.drain() == [{'type': 'pong', 'n': 1}, {'type': 'pong', 'n': 2}, {'type': 'breath_update', 'n': 2}]
+    assert (queue.coalesced, queue.dropped) == (2, 1)
+    assert queue.drain() == []
+
+
+def test_outbound_queue_keeps_latest_of_each_coalesced_type():
+    """breath_update 與 telemetry 各自只保留最新一則，不互相取代"""
+    queue = OutboundQueue()
+    frames = [encode_telemetry(0, i, 0.0, 0.0, float(i)) for i in range(3)]
+    queue.put({'type': 'breath_update', 'n': 0})
+    for frame in frames:
+        queue.put({'type': 'telemetry', 'frame': frame})
+    queue.put(MODE)
+    queue.put({'type': 'breath_update', 'n': 1})
+    messages = queue.drain()
+    assert messages == [MODE, {'type': 'breath_update', 'n': 1}, {'type': 'telemetry', 'frame': frames[-1]}]
+    assert queue.coalesced == 3 and queue.dropped == 0
+    assert FrameDecoder().feed(encode_messages(messages))[-1]['rms'] == 2.0
+
+
+def test_outbound_queue_custom_coalesced_types():
+    queue = OutboundQueue(coalesced_types=('breath_update',))
+    queue.put({'type': 'telemetry', 'frame': b'a'})
+    queue.put({'type': 'telemetry', 'frame': b'b'})
+    assert queue.qsize() == 2 and queue.coalesced == 0
+
+
+def test_outbound_queue_from_several_threads():
+    queue = OutboundQueue(max_control=10000)
+
+    def produce(k):
+        for i in range(1000):
+            queue.put({'type': 'pong', 'k': k, 'i': i})
+            queue.put({'type': 'breath_update', 'k': k, 'i': i})
+    threads = [threading.Thread(target=produce, args=(k,)) for k in range(4)]
+    for thread in threads:
+        thread.start()
+    drained = []
+    while any(thread.is_alive() for thread in threads):
+        drained.extend(queue.drain())
+    for thread in threads:
+        thread.join()
+    drained.extend(queue.drain())
+    pongs = [m for m in drained if m['type'] == 'pong']
+    assert len(pongs) == 4000 and queue.dropped == 0
+    # 同一個執行緒的控制消息依序送出
+    for k in range(4):
+        assert [m['i'] for m in pongs if m['k'] == k] == list(range(1000))
+    updates = sum(m['type'] == 'breath_update' for m in drained)
+    assert updates + queue.coalesced == 4000
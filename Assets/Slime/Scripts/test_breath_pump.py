@@ -0,0 +1,48 @@
+import threading
+import time
+from breath_pump import PUMP_OFF, PUMP_ON, PumpChannel
+
+
+def recording_channel(min_interval):
+    sent = []
+    event = threading.Event()
+
+    def send(command):
+        sent.append(command)
+        event.set()
+
+    return PumpChannel(send, min_interval), sent, event
+
+
+def test_toggles_within_min_interval_are_coalesced():
+    pump, sent, event = recording_channel(min_interval=0.2)
+    pump.request(True)
+    assert event.wait(1.0)
+    # 最小間隔內來回切換：最後回到已送出的狀態，不再送出
+    pump.request(False)
+    pump.request(True)
+    time.sleep(0.3)
+    assert sent == [PUMP_ON]
+    assert pump.requests == 3 and pump.commands_sent == 1
+    pump.close()
+
+
+def test_close_flushes_last_state_immediately():
+    pump, sent, event = recording_channel(min_interval=10.0)
+    pump.request(True)
+    assert event.wait(1.0)
+    pump.request(False)
+    pump.close()
+    assert sent == [PUMP_ON, PUMP_OFF]
+
+
+def test_acknowledge_measures_latency_and_clears_in_flight():
+    pump, sent, event = recording_channel(min_interval=0.0)
+    assert pump.latency_percentiles() is None
+    pump.request(True)
+    assert event.wait(1.0)
+    assert pump.in_flight == 1
+    pump.acknowledge(PUMP_ON)
+    assert pump.in_flight == 0
+    assert len(pump.latencies) == 1 and pump.latency_percentiles() is not None
+    pump.close()
@@ -0,0 +1,111 @@
+import os
+import numpy as np
+import pytest
+from breath_recorder import (HEADER_SIZE, INDEX_DTYPE, INDEX_STRIDE, RECORD_DECISION, RECORD_DTYPE, RECORD_PUMP,
+                             RECORD_SAMPLE, SessionRecorder, SessionRecording)
+
+SAMPLERATE = 500
+
+
+def write_session(path, batches=150, grow_records=8):
+    """寫入取樣、判斷及氣泵紀錄，回傳預期的 (時間戳, 種類, 值)；小的 grow_records 讓檔案多次擴大重新映射"""
+    rng = np.random.default_rng(2)
+    recorder = SessionRecorder(path, SAMPLERATE, start_time=1000.0, grow_records=grow_records)
+    recorder.set_calibration(2048.0, 512.0)
+    expected = []
+    t = 1000.0
+    for i in range(batches):
+        n = int(rng.integers(1, 120))
+        samples = rng.normal(size=n).astype(np.float32)
+        t += n / SAMPLERATE
+        if i % 2:
+            times = t - np.arange(n - 1, -1, -1) / SAMPLERATE
+            recorder.record_samples(samples, t, SAMPLERATE, times)
+        else:
+            recorder.record_samples(samples, t, SAMPLERATE)
+            times = t - np.arange(n - 1, -1, -1) / SAMPLERATE
+        expected.extend(zip(times, [RECORD_SAMPLE] * n, samples))
+        if i % 3 == 0:
+            recorder.record_decision(t, 'likely_INHALE', 0.5)
+            expected.append((t, RECORD_DECISION, 0.5))
+        if i % 5 == 0:
+            recorder.record_pump(t, True)
+            expected.append((t, RECORD_PUMP, 0.0))
+    return recorder, expected
+
+
+def test_round_trip_across_remaps(tmp_path):
+    path = str(tmp_path / 'session.brec')
+    recorder, expected = write_session(path)
+    assert recorder.capacity > 8
+    recorder.close()
+    recorder.close()  # 重複關閉無害
+
+    assert os.path.getsize(path) == HEADER_SIZE + len(expected) * RECORD_DTYPE.itemsize
+    recording = SessionRecording(path)
+    assert len(recording) == len(expected)
+    assert (recording.samplerate, recording.baseline, recording.adc_range, recording.start_time) == \
+        (SAMPLERATE, 2048.0, 512.0, 1000.0)
+    t, kind, value = (np.array(column) for column in zip(*expected))
+    np.testing.assert_array_equal(recording.records['t'], t)
+    np.testing.assert_array_equal(recording.records['kind'], kind)
+    np.testing.assert_array_equal(recording.records['value'], value.astype(np.float32))
+
+    sample_t, samples = recording.samples()
+    assert samples.dtype == np.float64 and sample_t.size == np.count_nonzero(kind == RECORD_SAMPLE)
+    decision_t, codes = recording.decisions()
+    assert set(codes.tolist()) == {1} and decision_t.size == np.count_nonzero(kind == RECORD_DECISION)
+    recording.close()
+
+
+def test_index_sidecar_matches_rebuilt_index(tmp_path):
+    path = str(tmp_path / 'session.brec')
+    recorder, expected = write_session(path)
+    recorder.close()
+    assert len(expected) > 2 * INDEX_STRIDE
+
+    written = SessionRecording(path)
+    assert written.index.size == len(expected) // INDEX_STRIDE
+    on_disk = np.fromfile(path + '.idx', dtype=INDEX_DTYPE)
+    np.testing.assert_array_equal(written.index, on_disk[:written.index.size])
+
+    os.remove(path + '.idx')
+    rebuilt = SessionRecording(path)
+    np.testing.assert_array_equal(rebuilt.index['record'], written.index['record'])
+    # 寫入時的索引可能略為高估，不會低估
+    assert (written.index['t_max'] >= rebuilt.index['t_max']).all()
+
+    times = written.records['t']
+    for t in [times[0] - 1, times[0], *np.linspace(times[0], times[-1], 37), times[-1], times[-1] + 1]:
+        expected_index = int(np.argmax(times >= t)) if (times >= t).any() else times.size
+        assert written.seek(t) == expected_index
+        assert rebuilt.seek(t) == expected_index
+
+
+def test_truncated_index_is_rebuilt(tmp_path):
+    path = str(tmp_path / 'session.brec')
+    recorder, expected = write_session(path)
+    recorder.close()
+    with open(path + '.idx', 'r+b') as f:
+        f.truncate(INDEX_DTYPE.itemsize)
+    recording = SessionRecording(path)
+    assert recording.index.size == len(expected) // INDEX_STRIDE
+    assert recording.seek(recording.records['t'][-1]) <= len(expected) - 1
+
+
+def test_reads_recording_that_was_not_closed(tmp_path):
+    """程式異常結束時檔案仍有預留空間，只讀取檔頭 count 以內的紀錄"""
+    path = str(tmp_path / 'session.brec')
+    recorder, expected = write_session(path, batches=20)
+    assert os.path.getsize(path) > HEADER_SIZE + len(expected) * RECORD_DTYPE.itemsize
+    recording = SessionRecording(path)
+    assert len(recording) == len(expected)
+    recording.close()
+    recorder.close()
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'not_a_recording.brec'
+    path.write_bytes(b'\0' * (HEADER_SIZE + RECORD_DTYPE.itemsize))
+    with pytest.raises(ValueError):
+        SessionRecording(str(path))
@@ -0,0 +1,26 @@
+import numpy as np
+from breath_tuning import BYTES_PER_CELL, CHUNK_SIZE, evaluate_all, memory_plan, random_candidates, with_defaults
+
+
+def session(windows, seed):
+    rng = np.random.default_rng(seed)
+    return {'rms': rng.random(windows) * 0.5, 'amp': rng.random(windows) * 0.5, 'zcr': rng.random(windows) * 0.3,
+            'expected': rng.integers(0, 3, windows).astype(np.uint8), 'hops_per_block': 25}
+
+
+def test_memory_plan_stays_within_budget():
+    for windows, workers, memory_mb in [(1000, 8, 1024), (360000, 8, 1024), (360000, 64, 1024),
+                                        (3600000, 64, 1024), (100000000, 64, 1024), (5000, 4, 1)]:
+        chunk_size, used = memory_plan([session(10, 0), {'rms': np.empty(windows)}], workers, memory_mb)
+        assert 1 <= chunk_size <= CHUNK_SIZE and 1 <= used <= workers
+        # 只有一組也超過上限時，至少保留一個行程逐組評估
+        assert chunk_size * used * BYTES_PER_CELL * windows <= memory_mb * 2 ** 20 or (chunk_size, used) == (1, 1)
+    assert memory_plan([session(1000, 0)], 8) == (CHUNK_SIZE, 8)
+
+
+def test_chunk_size_does_not_change_results():
+    sessions = [session(3000, 1), session(500, 2)]
+    candidates = with_defaults(random_candidates(100, 0))
+    expected = evaluate_all(sessions, candidates, 1, chunk_size=CHUNK_SIZE)
+    np.testing.assert_array_equal(evaluate_all(sessions, candidates, 1, chunk_size=7), expected)
+    assert expected.shape == (101, 2)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from breath_window import SlidingWindow, batch_features, hop_samples, window_features
+
+
+@pytest.mark.parametrize('hop_ms, expected', [(10, 5), (25, 5), (50, 25), (100, 25), (250, 125), (1000, 125), (1, 1)])
+def test_hop_samples_nearest_divisor(hop_ms, expected):
+    assert hop_samples(500, 125, hop_ms) == expected
+
+
+def test_sliding_window_rejects_non_divisor_hop():
+    with pytest.raises(ValueError):
+        SlidingWindow(125, 12)
+
+
+def test_sliding_window_matches_batch_and_offline_features():
+    rng = np.random.default_rng(1)
+    samples = rng.normal(size=1000)
+    window = SlidingWindow(125, 25)
+    streamed, views = [], []
+    # 不規則的區塊大小，確認跨 hop 的累計量正確
+    for chunk in np.split(samples, [7, 100, 101, 333, 640, 900]):
+        for features in window.push(chunk):
+            streamed.append(features)
+            views.append(window.view().copy())
+    streamed = np.array(streamed)
+
+    offline = np.column_stack(window_features(samples, 125, 25))
+    batch = np.column_stack(batch_features(np.array(views)))
+    assert streamed.shape == offline.shape == batch.shape
+    np.testing.assert_allclose(streamed, offline, atol=1e-9)
+    np.testing.assert_allclose(streamed, batch, atol=1e-9)
+    assert window.count == samples.size
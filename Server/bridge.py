@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import contextlib
+import json
+
+from main import HEARTBEAT_INTERVAL, MAX_LINE, PORT, encode, wait_closed
+
+# Connects the existing endpoints to the relay in main.py, which only speaks the hello/session protocol:
+#   sensor: joins the session as the sensor and, while a Unity peer is in the session, connects to
+#           breath_simulator_v2.py's Unity port as a Unity client would. The simulator therefore sees
+#           the remote Unity connect and disconnect and sends it mode_setup and the current state.
+#           Run it next to the simulator, which must use JSON framing (no --unity_binary).
+#   unity:  listens locally for BreathControllerV2 (point pythonHost/pythonPort at it) and joins the
+#           session as the Unity client for as long as Unity stays connected.
+# Frames are copied line by line in both directions; the relay's own frames are not passed on.
+RELAY_TYPES = ('welcome', 'peer_status', 'heartbeat')
+RETRY_INTERVAL = 1.0
+
+
+def relay_frame(line):
+    """Decode the relay's own frames (welcome, peer_status, heartbeat); None for relayed data."""
+    if not any(kind.encode() in line for kind in RELAY_TYPES):  # Cheap filter before decoding
+        return None
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return None
+    if isinstance(message, dict) and message.get('type') in RELAY_TYPES:
+        return message
+    return None
+
+
+def peer_connected(message):
+    """Whether a relay frame reports the other peer of the session as connected (None if it says nothing)."""
+    if message.get('type') == 'welcome':
+        return message.get('peer_connected')
+    if message.get('type') == 'peer_status':
+        return message.get('connected')
+    return None
+
+
+async def copy_lines(reader, writer, on_relay_frame=None):
+    """
+    Copy frames until reader closes.
+    on_relay_frame: reader is the relay; its own frames go to this callback instead, and returning True stops
+    """
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        if on_relay_frame:
+            message = relay_frame(line)
+            if message is not None:
+                if on_relay_frame(message):
+                    return
+                continue
+        writer.write(line)
+        await writer.drain()
+
+
+async def send_heartbeats(writer, interval):
+    while True:
+        await asyncio.sleep(interval)
+        writer.write(encode({'type': 'heartbeat'}))
+        await writer.drain()
+
+
+async def close(writer):
+    writer.close()
+    await wait_closed(writer)
+
+
+async def run_until_first(*coroutines):
+    """Run coroutines until one finishes, then cancel the rest."""
+    tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception():
+                print(f"Bridge connection failed: {task.exception()!r}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class Bridge:
+    def __init__(self, role, session, relay_host, relay_port, local_host, local_port,
+                 heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.role = role
+        self.session = session
+        self.relay = (relay_host, relay_port)
+        self.local = (local_host, local_port)
+        self.heartbeat_interval = heartbeat_interval
+        self.current = None  # unity role: task serving the active Unity connection
+
+    async def join(self):
+        """Connect to the relay and say hello; raises OSError when the relay is unavailable."""
+        reader, writer = await asyncio.open_connection(*self.relay, limit=MAX_LINE)
+        writer.write(encode({'type': 'hello', 'role': self.role, 'session': self.session, 'heartbeat': True}))
+        await writer.drain()
+        return reader, writer
+
+    async def run_sensor(self):
+        while True:
+            try:
+                relay_reader, relay_writer = await self.join()
+            except OSError as e:
+                print(f"Relay {self.relay[0]}:{self.relay[1]} unavailable: {e!r}")
+                await asyncio.sleep(RETRY_INTERVAL)
+                continue
+            print(f"Joined session {self.session} as sensor")
+            await run_until_first(self.serve_sensor(relay_reader, relay_writer),
+                                  send_heartbeats(relay_writer, self.heartbeat_interval))
+            await close(relay_writer)
+            print(f"Left session {self.session}")
+            await asyncio.sleep(RETRY_INTERVAL)
+
+    async def serve_sensor(self, relay_reader, relay_writer):
+        """Connect to the simulator whenever Unity is in the session; returns when the relay closes."""
+        while True:
+            # Wait for the Unity peer; the relay forwards nothing else while it is away
+            while True:
+                line = await relay_reader.readline()
+                if not line:
+                    return
+                message = relay_frame(line)
+                if message is not None and peer_connected(message):
+                    break
+            try:
+                local_reader, local_writer = await asyncio.open_connection(*self.local, limit=MAX_LINE)
+            except OSError as e:
+                print(f"Simulator {self.local[0]}:{self.local[1]} unavailable: {e!r}")
+                return  # Rejoin so the Unity side sees the sensor leave and come back
+            print(f"Unity joined session {self.session}, connected to the simulator")
+            await run_until_first(
+                copy_lines(relay_reader, local_writer, lambda message: peer_connected(message) is False),
+                copy_lines(local_reader, relay_writer))
+            await close(local_writer)
+            if relay_reader.at_eof():
+                return
+            print(f"Unity left session {self.session}, disconnected from the simulator")
+
+    async def run_unity(self):
+        """Accept BreathControllerV2; a new connection replaces the previous one."""
+        async def accept(local_reader, local_writer):
+            if self.current:
+                self.current.cancel()
+            self.current = asyncio.current_task()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.serve_unity(local_reader, local_writer)
+
+        server = await asyncio.start_server(accept, *self.local, limit=MAX_LINE)
+        print(f"Waiting for Unity on {self.local[0]}:{self.local[1]}")
+        async with server:
+            await server.serve_forever()
+
+    async def serve_unity(self, local_reader, local_writer):
+        try:
+            relay_reader, relay_writer = await self.join()
+        except OSError as e:
+            print(f"Relay {self.relay[0]}:{self.relay[1]} unavailable: {e!r}")
+            await close(local_writer)
+            return
+        print(f"Unity connected, joined session {self.session}")
+        try:
+            await run_until_first(copy_lines(relay_reader, local_writer, lambda message: False),
+                                  copy_lines(local_reader, relay_writer),
+                                  send_heartbeats(relay_writer, self.heartbeat_interval))
+        finally:
+            await close(local_writer)
+            await close(relay_writer)
+            print(f"Unity disconnected, left session {self.session}")
+
+    async def run(self):
+        await (self.run_sensor() if self.role == 'sensor' else self.run_unity())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Connect the breath simulator or Unity to the relay server')
+    parser.add_argument('role', choices=['sensor', 'unity'])
+    parser.add_argument('--session', required=True, help='Session id shared by both bridges')
+    parser.add_argument('--relay_host', default='localhost')
+    parser.add_argument('--relay_port', type=int, default=PORT)
+    parser.add_argument('--local_host', default='localhost',
+                        help='sensor: simulator host to connect to; unity: address to listen on')
+    parser.add_argument('--local_port', type=int, default=7777,
+                        help='sensor: simulator --unity_port; unity: BreathControllerV2 pythonPort (default 7777)')
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL, help='Heartbeat interval in seconds')
+    args = parser.parse_args()
+    bridge = Bridge(args.role, args.session, args.relay_host, args.relay_port, args.local_host, args.local_port,
+                    args.heartbeat)
+    try:
+        asyncio.run(bridge.run())
+    except KeyboardInterrupt:
+        print("Bridge stopped.")
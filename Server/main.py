@@ -1,31 +1,212 @@
-import socket
-import threading
+import argparse
+import asyncio
+import contextlib
+import json
 import time
 
 HOST = '0.0.0.0'  # Listen on all interfaces
 PORT = 5005       # Port to listen on (must match Unity client)
 
-def handle_client(conn, addr):
-    print(f"Connected by {addr}")
+HEARTBEAT_INTERVAL = 1.0        # Seconds between heartbeats sent to every peer
+HELLO_TIMEOUT = 5.0             # Seconds a new connection has to identify itself
+MAX_WRITE_BUFFER = 64 * 1024    # Bytes queued per connection before messages are dropped
+MAX_LINE = 64 * 1024            # Longest accepted frame
+ROLES = ('sensor', 'unity')
+
+# Protocol: newline-delimited JSON frames.
+# The first frame of every connection must be
+#   {"type": "hello", "role": "sensor" | "unity", "session": "<id>", "heartbeat": true}
+# after which every frame is forwarded unchanged to the other peer of the same session.
+# "heartbeat": true opts the peer into idle detection: it must send something
+# (for example {"type": "heartbeat"}) at least once per idle timeout.
+# The simulator, the ESP32 firmware and BreathControllerV2 do not speak this protocol themselves;
+# bridge.py joins them to a session (sensor: next to breath_simulator_v2.py, unity: next to Unity).
+
+
+def encode(message):
+    return (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def is_heartbeat(line):
+    """True only for frames whose type is "heartbeat"; other frames mentioning it are still relayed."""
+    if b'"heartbeat"' not in line:  # Cheap filter before decoding
+        return False
     try:
+        message = json.loads(line)
+    except ValueError:
+        return False
+    return isinstance(message, dict) and message.get('type') == 'heartbeat'
+
+
+async def wait_closed(writer):
+    with contextlib.suppress(OSError):
+        await writer.wait_closed()
+
+
+class Peer:
+    """One connected client with a bounded outbound buffer."""
+
+    def __init__(self, writer, role, session_id, heartbeat, max_write_buffer):
+        self.writer = writer
+        self.role = role
+        self.session_id = session_id
+        self.heartbeat = heartbeat
+        self.max_write_buffer = max_write_buffer
+        self.addr = writer.get_extra_info('peername')
+        self.last_seen = time.monotonic()
+        self.dropped = 0
+
+    def send(self, data):
+        """Queue data without blocking; drop it if the peer is not keeping up."""
+        if self.writer.is_closing():
+            return False
+        if self.writer.transport.get_write_buffer_size() > self.max_write_buffer:
+            self.dropped += 1
+            return False
+        self.writer.write(data)
+        return True
+
+    def close(self, abort=False):
+        """Request the connection to close; the task serving the peer waits for it in aclose()."""
+        if abort:
+            # Idle peers may never read their buffered data, so do not wait to flush it
+            self.writer.transport.abort()
+        elif not self.writer.is_closing():
+            self.writer.close()
+
+    async def aclose(self):
+        self.close()
+        await wait_closed(self.writer)
+
+
+class Session:
+    """Pairs one sensor with one Unity client."""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.peers = dict.fromkeys(ROLES)
+
+    def other(self, role):
+        return self.peers['unity' if role == 'sensor' else 'sensor']
+
+    def empty(self):
+        return not any(self.peers.values())
+
+
+class BreathHub:
+    def __init__(self, heartbeat_interval=HEARTBEAT_INTERVAL, idle_timeout=None,
+                 max_write_buffer=MAX_WRITE_BUFFER):
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout or 3 * heartbeat_interval
+        self.max_write_buffer = max_write_buffer
+        self.sessions = {}
+
+    def peers(self):
+        for session in self.sessions.values():
+            for peer in session.peers.values():
+                if peer:
+                    yield peer
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        try:
+            hello = json.loads(await asyncio.wait_for(reader.readline(), HELLO_TIMEOUT))
+            role = hello['role']
+            session_id = str(hello['session'])
+            if hello.get('type') != 'hello' or role not in ROLES:
+                raise ValueError(hello)
+        except (asyncio.TimeoutError, ValueError, KeyError, TypeError, ConnectionError) as e:
+            print(f"Rejected {addr}: {e!r}")
+            writer.close()
+            await wait_closed(writer)
+            return
+
+        peer = Peer(writer, role, session_id, bool(hello.get('heartbeat')), self.max_write_buffer)
+        session = self.sessions.setdefault(session_id, Session(session_id))
+        previous = session.peers[role]
+        if previous:
+            # The old connection is stale (client reconnected), so drop it without flushing
+            print(f"Replacing {role} of session {session_id} ({previous.addr})")
+            previous.close(abort=True)
+        session.peers[role] = peer
+        print(f"Connected {role} {addr} to session {session_id}")
+
+        other = session.other(role)
+        peer.send(encode({'type': 'welcome', 'session': session_id, 'role': role,
+                          'peer_connected': other is not None}))
+        if other:
+            other.send(encode({'type': 'peer_status', 'role': role, 'connected': True}))
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                peer.last_seen = time.monotonic()
+                if is_heartbeat(line):
+                    continue  # Heartbeat replies are not forwarded
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                other = session.other(role)
+                if other:
+                    other.send(line)
+        except (ConnectionError, ValueError, asyncio.LimitOverrunError) as e:
+            print(f"Connection with {addr} failed: {e!r}")
+        except asyncio.CancelledError:
+            # Server shutting down. Nothing awaits this task, and re-raising makes Python 3.11's
+            # stream callback log a spurious traceback for every open connection.
+            pass
+        finally:
+            if session.peers[role] is peer:
+                session.peers[role] = None
+                other = session.other(role)
+                if other:
+                    other.send(encode({'type': 'peer_status', 'role': role, 'connected': False}))
+                if session.empty():
+                    del self.sessions[session_id]
+            await peer.aclose()
+            print(f"Connection with {addr} closed ({role}, session {session_id}, dropped {peer.dropped}).")
+
+    async def heartbeat_loop(self):
         while True:
-            status = "Server is running"
-            conn.sendall(status.encode('utf-8'))
-            time.sleep(1)  # Send status every second
-    except (ConnectionResetError, BrokenPipeError):
-        print(f"Connection with {addr} closed.")
-    finally:
-        conn.close()
-
-def start_server():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
-        s.listen()
-        print(f"Server listening on {HOST}:{PORT}")
-        while True:
-            conn, addr = s.accept()
-            client_thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-            client_thread.start()
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            message = encode({'type': 'heartbeat', 'status': 'Server is running',
+                              'timestamp': time.time(), 'sessions': len(self.sessions)})
+            for peer in list(self.peers()):
+                if peer.heartbeat and now - peer.last_seen > self.idle_timeout:
+                    print(f"Closing idle {peer.role} {peer.addr} (session {peer.session_id})")
+                    peer.close(abort=True)
+                else:
+                    peer.send(message)
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_client, host, port, limit=MAX_LINE, backlog=1024)
+        print(f"Server listening on {host}:{port}")
+        async with server:
+            heartbeat = asyncio.create_task(self.heartbeat_loop())
+            try:
+                await server.serve_forever()
+            finally:
+                heartbeat.cancel()
+
+
+def start_server(host=HOST, port=PORT, **options):
+    try:
+        asyncio.run(BreathHub(**options).serve(host, port))
+    except KeyboardInterrupt:
+        print("Server stopped.")
+
 
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Multi-session breath relay server')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL, help='Heartbeat interval in seconds')
+    parser.add_argument('--idle_timeout', type=float, default=None,
+                        help='Close opted-in peers silent for this long (default 3 heartbeats)')
+    parser.add_argument('--max_write_buffer', type=int, default=MAX_WRITE_BUFFER,
+                        help='Per-connection outbound buffer limit in bytes')
+    args = parser.parse_args()
+    start_server(args.host, args.port, heartbeat_interval=args.heartbeat,
+                 idle_timeout=args.idle_timeout, max_write_buffer=args.max_write_buffer)